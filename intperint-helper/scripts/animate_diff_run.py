@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
-# animate_diff_run.py – simple video maker via img2img frames + ffmpeg
-import argparse, os, sys, shutil, json, random
+# animate_diff_run.py – video maker: AnimateDiff (all frames in one call) piped straight into ffmpeg
+import argparse, os, sys, json, random, subprocess, tempfile
 from pathlib import Path
 
 def choose_torch_device(prefer: str):
@@ -11,66 +11,97 @@ def choose_torch_device(prefer: str):
         return "cuda"
     return "cpu"
 
+def load_motion_adapter(path: str, dtype):
+    from diffusers import MotionAdapter
+    if Path(path).is_dir():
+        return MotionAdapter.from_pretrained(path, torch_dtype=dtype, local_files_only=True)
+    # single .ckpt/.safetensors motion module
+    return MotionAdapter.from_single_file(path, torch_dtype=dtype)
+
+def open_encoder(out_mp4: Path, w: int, h: int, fps: int, log_path: Path):
+    # raw RGB24 frames on stdin -> H.264; no PNG round-trip
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{w}x{h}', '-r', str(fps),
+           '-i', '-', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-movflags', '+faststart', str(out_mp4)]
+    log = open(log_path, 'wb')
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=log), log
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument('--init', required=True)
     ap.add_argument('--prompt', required=True)
-    ap.add_argument('--motion', default=None)
+    ap.add_argument('--motion', default=None, help='AnimateDiff motion adapter dir or .safetensors/.ckpt')
     ap.add_argument('--frames', type=int, default=16)
     ap.add_argument('--out', required=True)
-    ap.add_argument('--model_dir', required=True)
+    ap.add_argument('--model_dir', default=os.environ.get('ANIM_BASE_DIR'), help='SD1.5 base model dir (env ANIM_BASE_DIR)')
     ap.add_argument('--device', default='mps', choices=['mps','cpu','cuda'])
     ap.add_argument('--steps', type=int, default=20)
     ap.add_argument('--strength', type=float, default=0.6)
     ap.add_argument('--seed', type=int, default=None)
+    ap.add_argument('--fps', type=int, default=12)
+    ap.add_argument('--encode_timeout', type=float, default=300, help='seconds ffmpeg may take after the last frame')
     args = ap.parse_args()
-
-    tmpdir = Path('/tmp/intperint_anim_frames')
-    if tmpdir.exists():
-        shutil.rmtree(tmpdir)
-    tmpdir.mkdir(parents=True, exist_ok=True)
+    if not args.model_dir:
+        print('Missing --model_dir (or ANIM_BASE_DIR)', file=sys.stderr); return 2
 
     out_p = Path(args.out); out_p.parent.mkdir(parents=True, exist_ok=True)
     seed = args.seed if args.seed is not None else random.randint(1,2**31-1)
 
     try:
+        import numpy as np
         import torch
-        from diffusers import StableDiffusionImg2ImgPipeline, DiffusionPipeline
+        from diffusers import StableDiffusionImg2ImgPipeline, AnimateDiffVideoToVideoPipeline
         from PIL import Image
     except Exception as e:
         print('Missing deps:', e, file=sys.stderr); return 2
 
     device = choose_torch_device(args.device)
+    dtype = torch.float16 if device != 'cpu' else torch.float32
+    gen_device = device if device != 'mps' else 'cpu'
     print(f"[anim] device={device} frames={args.frames} seed={seed}")
 
-    pipe = None
-    try:
-        pipe = StableDiffusionImg2ImgPipeline.from_pretrained(args.model_dir)
-    except Exception:
-        pipe = DiffusionPipeline.from_pretrained(args.model_dir)
+    img0 = Image.open(args.init).convert('RGB')
+    w, h = img0.width // 8 * 8, img0.height // 8 * 8
+    img0 = img0.resize((w, h))
 
-    try:
+    if args.motion:
+        adapter = load_motion_adapter(args.motion, dtype)
+        pipe = AnimateDiffVideoToVideoPipeline.from_pretrained(args.model_dir, motion_adapter=adapter, torch_dtype=dtype, local_files_only=True)
         pipe = pipe.to(device)
-    except Exception as e:
-        print('Warn: move to device failed:', e)
+        # The init image repeated over time is the source clip; the motion module animates it
+        out = pipe(prompt=args.prompt, video=[img0] * args.frames, strength=args.strength, num_inference_steps=args.steps,
+                   generator=torch.Generator(gen_device).manual_seed(seed), output_type='np')
+        frames = out.frames[0]
+    else:
+        # No motion module: per-frame img2img fallback (kept in memory)
+        pipe = StableDiffusionImg2ImgPipeline.from_pretrained(args.model_dir, torch_dtype=dtype, local_files_only=True).to(device)
+        frames = []
+        for i in range(args.frames):
+            gen = torch.Generator(gen_device).manual_seed(seed + i)
+            frames.append(pipe(prompt=f"{args.prompt} frame {i}", image=img0, strength=args.strength,
+                               num_inference_steps=args.steps, generator=gen, output_type='np').images[0])
 
-    img0 = Image.open(args.init).convert('RGB')
-    for i in range(args.frames):
-        gen = torch.Generator(device if device!='cpu' else 'cpu').manual_seed(seed + i)
-        prompt_i = f"{args.prompt} frame {i}"
+    # Per-run work dir: concurrent jobs never share partial output
+    with tempfile.TemporaryDirectory(prefix='intperint_anim_', dir=str(out_p.parent)) as work:
+        tmp_mp4 = Path(work) / 'video.mp4'
+        fh, fw = frames[0].shape[0], frames[0].shape[1]
+        proc, log = open_encoder(tmp_mp4, fw, fh, args.fps, Path(work) / 'ffmpeg.log')
+        rc = None
         try:
-            out_img = pipe(prompt=prompt_i, image=img0, strength=args.strength, num_inference_steps=args.steps, generator=gen).images[0]
-        except Exception:
-            out_img = pipe(prompt=prompt_i, num_inference_steps=args.steps, generator=gen).images[0]
-        frame_path = tmpdir / f"frame_{i:04d}.png"
-        out_img.save(str(frame_path))
-        print('wrote', frame_path)
-
-    ffmpeg = f'ffmpeg -y -framerate 12 -i "{tmpdir}/frame_%04d.png" -c:v libx264 -pix_fmt yuv420p "{out_p}"'
-    rc = os.system(ffmpeg)
-    if rc != 0:
-        print('ffmpeg failed rc', rc, file=sys.stderr); return 5
-    print(json.dumps({"status":"ok","out":str(out_p)}))
+            for f in frames:
+                proc.stdin.write((np.asarray(f) * 255).round().clip(0, 255).astype('uint8').tobytes())
+            proc.stdin.close()
+            rc = proc.wait(timeout=args.encode_timeout)
+        except (BrokenPipeError, subprocess.TimeoutExpired) as e:
+            print('ffmpeg encode failed:', e, file=sys.stderr)
+        finally:
+            if rc is None:  # broken pipe, timeout or interrupt: don't leave ffmpeg behind
+                proc.kill()
+                proc.wait()
+            log.close()
+        if rc != 0:
+            print('ffmpeg failed rc', rc, (Path(work) / 'ffmpeg.log').read_text(errors='replace')[-500:], file=sys.stderr); return 5
+        os.replace(tmp_mp4, out_p)
+    print(json.dumps({"status":"ok","out":str(out_p),"frames":len(frames),"seed":seed}))
     return 0
 
 if __name__ == '__main__':
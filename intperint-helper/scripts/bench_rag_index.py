@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""bench_rag_index.py - recall@k vs latency of rag_worker index types on a synthetic corpus.
+  python3 bench_rag_index.py --n 200000 --dim 384 --queries 500
+Vectors are clustered gaussians, L2-normalized like the real embeddings; the
+exact flat index is the ground truth. ivf_pq includes rag_worker's exact
+re-ranking of the PQ candidates. One JSON line per (index, search param):
+{"index":"ivf_pq","spec":"IVF..,PQ..","param":{"nprobe":16},"recall":0.93,"ms_per_query":0.21,"build_s":..,"index_mb":..}
+"""
+import argparse, json, sys, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from rag_worker import ann_search, build_index, index_factory_string, resolve_index_type, search_params  # noqa: E402
+
+
+def synthetic(n, dim, clusters, seed):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype('float32')
+    x = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype('float32')
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    return x
+
+
+def run(index, queries, k, params, vectors=None):
+    import numpy as np
+    out = np.empty((len(queries), k), dtype='int64')
+    t0 = time.perf_counter()
+    for i in range(len(queries)):  # one at a time, like rag_worker serve
+        out[i] = ann_search(index, queries[i:i + 1], k, params, vectors)[1][0]
+    return out, (time.perf_counter() - t0) * 1000 / len(queries)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--n', type=int, default=200_000)
+    ap.add_argument('--dim', type=int, default=384)
+    ap.add_argument('--clusters', type=int, default=1000)
+    ap.add_argument('--queries', type=int, default=500)
+    ap.add_argument('--k', type=int, default=10)
+    ap.add_argument('--types', nargs='+', default=['ivf_flat', 'ivf_pq', 'hnsw'])
+    ap.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64])
+    ap.add_argument('--ef_search', type=int, nargs='+', default=[16, 64, 256])
+    args = ap.parse_args()
+    try:
+        import faiss, numpy as np
+    except Exception as e:
+        print(json.dumps({"op":"error","error":f"deps missing: {e}"}))
+        return 2
+
+    x = synthetic(args.n, args.dim, args.clusters, 0)
+    q = synthetic(args.queries, args.dim, args.clusters, 1)
+    ids = np.arange(args.n, dtype='int64')
+
+    for kind in ['flat'] + args.types:
+        if resolve_index_type(kind, args.n) != kind:
+            print(json.dumps({"index":kind,"skipped":f"n={args.n} too small"}))
+            continue
+        t0 = time.perf_counter()
+        index = build_index(x, ids, kind)
+        build_s = time.perf_counter() - t0
+        mb = len(faiss.serialize_index(index)) / 2**20
+        sweep = {'flat': [None], 'hnsw': args.ef_search}.get(kind, args.nprobe)
+        for p in sweep:
+            params = search_params(index, nprobe=p, ef_search=p)
+            # ivf_pq is measured the way rag_worker queries it: with exact re-ranking
+            found, ms = run(index, q, args.k, params, x if kind == 'ivf_pq' else None)
+            if kind == 'flat':
+                truth = found
+            recall = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(found, truth)])
+            print(json.dumps({"index":kind,"spec":index_factory_string(kind, args.n, args.dim),
+                              "param":{} if p is None else {"ef_search" if kind == 'hnsw' else "nprobe": p},
+                              "recall":round(float(recall), 4),"ms_per_query":round(ms, 4),
+                              "build_s":round(build_s, 2),"index_mb":round(mb, 1)}), flush=True)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,124 +1,762 @@
 #!/usr/bin/env python3
 """rag_worker.py
 Sub-ops:
-  index: --root <folder>
-  query: --root <folder> --query <text> --topk N
-Outputs single JSON line for query: {"op":"done","chunks":[{"text":"...","source":"..."}]}
-Index artifacts are stored inside <root>/.intperint_index/{faiss.index,meta.json}
+  index: --root <folder> [--index_type auto|flat|ivf_flat|ivf_pq|hnsw]
+  query: --root <folder> --query <text> --topk N [--neighbors N] [--nprobe N] [--ef_search N]
+  serve: [--socket /tmp/intperint-rag.sock] [--max_roots 4]
+Outputs single JSON line for query:
+  {"op":"done","chunks":[{"text":"...","source":"...","score":0.8,"id":12,"start":0,"end":640}]}
+text is the matched chunk and start/end its utf-8 byte range in the source;
+--neighbors adds "context" (+ context_start/context_end) spanning the
+adjacent chunks of the same file. Chunks are read from the mmapped store,
+never from the source files.
+serve keeps the model and up to --max_roots indexes resident and answers
+JSON lines on a UNIX socket, same shape as the helper's rag ops:
+  {"op":"rag_query","folder":"...","query":"...","topk":5,"neighbors":0,"id":1}
+  -> {"op":"done","chunks":[...],"batch":3,"timing_ms":{"embed":..,"search":..,"fetch":..},"id":1}
+  {"op":"rag_index","folder":"...","index_type":"auto"} / {"op":"ping"}
+  (rag_query also takes "nprobe" / "ef_search")
+Index artifacts are stored inside <root>/.intperint_index/:
+  faiss.index    inner-product index keyed by chunk id (see --index_type)
+  manifest.json  per file: mtime_ns, size, sha256, file id and chunk id range
+  chunks.bin     utf-8 chunk texts (append-only; once more chunks are dead than
+                 live, all three store files are compacted and ids renumbered)
+  chunks.idx     one fixed-size record per chunk id (see REC)
+  vectors.f32    float32 embedding per chunk id, used to (re)build the index
+Re-indexing only re-chunks and re-embeds files whose content changed and
+drops the vectors of deleted files. Files are read and chunked in a process
+pool (--workers) with a bounded number in flight, embedded in batches of
+EMBED_FLUSH chunks and added as they come, so memory does not grow with the
+corpus. index prints {"op":"progress",...} lines before the final result.
+Index types: flat (exact), ivf_flat, ivf_pq (IVF + 8-bit product quantization),
+hnsw. auto picks flat up to AUTO_FLAT_MAX chunks, ivf_flat up to
+AUTO_IVF_FLAT_MAX, ivf_pq beyond. IVF/PQ are trained on a sample of at most
+TRAIN_SAMPLE stored vectors and retrained once the corpus grows or shrinks
+RETRAIN_GROWTH-fold; HNSW is rebuilt when chunks are removed. ivf_pq hits are
+re-scored exactly from the mmapped vectors.f32 (PQ_RERANK x topk candidates).
 """
-import argparse, json, sys, os, re
+import argparse, hashlib, itertools, json, math, sys, os, re, struct, time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
 
 IDX_DIR_NAME = '.intperint_index'
+MODEL_NAME = 'all-MiniLM-L6-v2'
+MANIFEST_VERSION = 2
+DOC_SUFFIXES = {'.txt', '.md'}
+EMBED_FLUSH = 1024  # chunks embedded and added per step
+INFLIGHT_PER_WORKER = 4  # files read/chunked ahead per pool worker (backpressure)
+PROGRESS_S = 1.0
+
+INDEX_TYPES = ('auto', 'flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+# auto: exact search while it is cheap, then IVF (supports remove_ids, so
+# incremental updates stay cheap); PQ once raw float32 vectors get too big
+AUTO_FLAT_MAX = 50_000
+AUTO_IVF_FLAT_MAX = 1_000_000
+PQ_MIN = 10_000             # PQ codebooks need ~40 points per centroid
+TRAIN_SAMPLE = 100_000      # max vectors used to train IVF/PQ
+RETRAIN_GROWTH = 4          # rebuild IVF once the corpus grew/shrank this much since training
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+PQ_RERANK = 4               # ivf_pq: fetch k*PQ_RERANK candidates, re-score exactly from vectors.f32
+
+# chunks.idx record: text offset, text length, file id, source byte range
+REC = struct.Struct('<QIIQQ')
+REC_DTYPE = [('off', '<u8'), ('len', '<u4'), ('fid', '<u4'), ('start', '<u8'), ('end', '<u8')]
 
 TOKEN_SPLIT_RE = re.compile(r'(?<=\.)\s+|\n+')
 
 
-def build_chunks(text: str, max_chars=800):
-    parts = TOKEN_SPLIT_RE.split(text)
-    buf = []
-    cur = ''
-    for p in parts:
+def chunk_spans(text: str, max_chars=800):
+    """build_chunks() plus the utf-8 byte range [start, end) each chunk covers in `text`."""
+    out = []
+    cur, c0, c1 = '', 0, 0
+    pos = bpos = 0
+    for m in itertools.chain(TOKEN_SPLIT_RE.finditer(text), (None,)):
+        p = text[pos:m.start() if m else len(text)]
+        b1 = bpos + len(p.encode('utf-8'))
         if len(cur) + len(p) + 1 > max_chars:
             if cur.strip():
-                buf.append(cur.strip())
-            cur = p
+                out.append((cur.strip(), c0, c1))
+            cur, c0, c1 = p, bpos, b1
         else:
+            if not cur:
+                c0 = bpos
             cur += (' ' if cur else '') + p
+            c1 = b1
+        if m is not None:
+            bpos = b1 + len(m.group().encode('utf-8'))
+            pos = m.end()
     if cur.strip():
-        buf.append(cur.strip())
-    return buf
+        out.append((cur.strip(), c0, c1))
+    return out
+
+
+def build_chunks(text: str, max_chars=800):
+    return [c for c, _, _ in chunk_spans(text, max_chars)]
+
+
+def iter_docs(root: Path):
+    for dirpath, dirnames, filenames in os.walk(root):
+        if IDX_DIR_NAME in dirnames:
+            dirnames.remove(IDX_DIR_NAME)
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() in DOC_SUFFIXES:
+                yield Path(dirpath) / name
+
+
+def _fsync(path: Path):
+    with open(path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+# A run writes replacements as '<name>.tmp' and publishes them in _commit()
+STORE_FILES = ('chunks.bin', 'chunks.idx', 'vectors.f32', 'faiss.index')
+
+
+def _commit(out_dir: Path, manifest):
+    """Publish the '.tmp' files of this run together with the manifest.
+    Renaming the synced manifest to manifest.json.next is the commit point:
+    _recover() rolls an interrupted commit forward and otherwise drops the
+    '.tmp' files, so the next run never sees a half-written index."""
+    tmp = out_dir/'manifest.json.tmp'
+    tmp.write_bytes(json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+    _fsync(tmp)
+    os.replace(tmp, out_dir/'manifest.json.next')
+    _roll_forward(out_dir)
+
+
+def _roll_forward(out_dir: Path):
+    for name in STORE_FILES:
+        tmp = out_dir/(name + '.tmp')
+        if tmp.exists():
+            os.replace(tmp, out_dir/name)
+    os.replace(out_dir/'manifest.json.next', out_dir/'manifest.json')
+
+
+def _recover(out_dir: Path):
+    if (out_dir/'manifest.json.next').exists():
+        _roll_forward(out_dir)
+    for name in STORE_FILES + ('manifest.json',):
+        (out_dir/(name + '.tmp')).unlink(missing_ok=True)
+
+
+class ChunkStore:
+    """chunks.bin + chunks.idx + vectors.f32. Chunk ids are dense and appended
+    (until compact() renumbers them), so the record of id i lives at
+    i * REC.size and its embedding at row i. Keeping the vectors lets any index
+    type be (re)built without re-embedding."""
+
+    def __init__(self, out_dir: Path):
+        self.bin_path = out_dir / 'chunks.bin'
+        self.idx_path = out_dir / 'chunks.idx'
+        self.vec_path = out_dir / 'vectors.f32'
+
+    def open_append(self, next_id: int, bin_size: int, dim):
+        # Drop anything a crashed run wrote past the last committed manifest
+        for p, n in ((self.bin_path, bin_size), (self.idx_path, next_id * REC.size), (self.vec_path, next_id * (dim or 0) * 4)):
+            with open(p, 'ab') as f:
+                f.truncate(n)
+        self._bin = open(self.bin_path, 'ab')
+        self._idx = open(self.idx_path, 'ab')
+        self._vec = open(self.vec_path, 'ab')
+        self.bin_size = bin_size
+
+    def append(self, text: str, fid: int, start: int, end: int):
+        data = text.encode('utf-8')
+        self._idx.write(REC.pack(self.bin_size, len(data), fid, start, end))
+        self._bin.write(data)
+        self.bin_size += len(data)
+
+    def append_vectors(self, vecs):
+        self._vec.write(vecs.astype('<f4', copy=False).tobytes())
+
+    def vectors(self, dim: int):
+        import numpy as np
+        return np.memmap(self.vec_path, dtype='<f4', mode='r').reshape(-1, dim)
+
+    def close(self):
+        for f in (self._bin, self._idx, self._vec):
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+    def open_read(self):
+        """Map both files read-only; queries then touch only the pages they hit."""
+        import mmap, numpy as np
+        self.recs = np.memmap(self.idx_path, dtype=REC_DTYPE, mode='r')
+        with open(self.bin_path, 'rb') as f:
+            self.bin = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
 
+    def text(self, i: int) -> str:
+        r = self.recs[i]
+        off = int(r['off'])
+        return self.bin[off:off + int(r['len'])].decode('utf-8')
 
-def do_index(root: Path):
+    def compact(self, files, dim: int):
+        """Copy the chunks of `files` (manifest entries) into '.tmp' store files,
+        renumbered densely in id order, and rewrite each entry's 'ids'. The
+        store reads the new files from then on; _commit() publishes them.
+        Returns (bin_size, next_id)."""
+        import numpy as np
+        recs = np.memmap(self.idx_path, dtype=REC_DTYPE, mode='r')
+        vecs = self.vectors(dim)
+        paths = [p.with_name(p.name + '.tmp') for p in (self.bin_path, self.idx_path, self.vec_path)]
+        size = next_id = 0
+        with open(self.bin_path, 'rb') as fb, open(paths[0], 'wb') as ob, open(paths[1], 'wb') as oi, open(paths[2], 'wb') as ov:
+            for ent in sorted(files.values(), key=lambda e: e['ids'][0]):
+                ids = _file_ids(ent)
+                for r in recs[ids.start:ids.stop]:
+                    n = int(r['len'])
+                    fb.seek(int(r['off']))
+                    ob.write(fb.read(n))
+                    oi.write(REC.pack(size, n, int(r['fid']), int(r['start']), int(r['end'])))
+                    size += n
+                ov.write(np.ascontiguousarray(vecs[ids.start:ids.stop]).tobytes())
+                ent['ids'][0] = next_id
+                next_id += len(ids)
+            for f in (ob, oi, ov):
+                f.flush()
+                os.fsync(f.fileno())
+        self.bin_path, self.idx_path, self.vec_path = paths
+        return size, next_id
+
+
+def load_manifest(out_dir: Path):
+    try:
+        m = json.loads((out_dir/'manifest.json').read_text())
+    except (OSError, ValueError):
+        return None
+    if m.get('version') != MANIFEST_VERSION or m.get('model') != MODEL_NAME or not (out_dir/'faiss.index').exists():
+        return None
+    return m
+
+
+def _file_ids(ent):
+    first, count = ent['ids']
+    return range(first, first + count)
+
+
+def resolve_index_type(kind: str, n: int) -> str:
+    if kind == 'auto':
+        kind = 'flat' if n <= AUTO_FLAT_MAX else 'ivf_flat' if n <= AUTO_IVF_FLAT_MAX else 'ivf_pq'
+    if kind == 'ivf_pq' and n < PQ_MIN:
+        kind = 'ivf_flat'
+    if kind == 'ivf_flat' and n < 39 * 4:
+        kind = 'flat'  # too few vectors to cluster
+    return kind
+
+
+def index_factory_string(kind: str, n: int, dim: int) -> str:
+    if kind == 'flat':
+        return 'IDMap2,Flat'
+    if kind == 'hnsw':
+        return f'IDMap2,HNSW{HNSW_M},Flat'
+    # ~4*sqrt(n) inverted lists, with at least 39 training points each
+    nlist = max(1, min(int(4 * math.sqrt(n)), n // 39, 65536))
+    if kind == 'ivf_flat':
+        return f'IVF{nlist},Flat'
+    # 8-bit codes over ~4-dim sub-vectors: dim/4 bytes per vector instead of dim*4
+    m = next(m for m in range(max(1, dim // 4), 0, -1) if dim % m == 0)
+    return f'IVF{nlist},PQ{m}'
+
+
+def build_index(vecs, ids, kind: str):
+    """Fresh index of `kind` over rows `ids` of `vecs` (a memmap is fine; rows
+    are copied in slices). IVF/PQ are trained on a random sample."""
+    import faiss, numpy as np
+    n, dim = len(ids), vecs.shape[1]
+    index = faiss.index_factory(dim, index_factory_string(kind, n, dim), faiss.METRIC_INNER_PRODUCT)
+    if kind == 'hnsw':
+        faiss.downcast_index(index.index).hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        sample = np.sort(np.random.default_rng(0).choice(ids, size=min(n, TRAIN_SAMPLE), replace=False))
+        index.train(np.ascontiguousarray(vecs[sample]))
+    for k in range(0, n, 65536):
+        part = np.asarray(ids[k:k + 65536], dtype='int64')
+        index.add_with_ids(np.ascontiguousarray(vecs[part]), part)
+    return index
+
+
+def search_params(index, nprobe=None, ef_search=None):
+    """Per-call search parameters (thread-safe, unlike setting index.nprobe)."""
+    import faiss
+    if faiss.try_extract_index_ivf(index) is not None:
+        return faiss.SearchParametersIVF(nprobe=int(nprobe or DEFAULT_NPROBE))
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search or DEFAULT_EF_SEARCH))
+    return None
+
+
+def ann_search(index, q, k: int, params=None, vectors=None):
+    """index.search for a single query; with `vectors` (rows by chunk id) the
+    candidates of a lossy PQ index are re-scored with the exact vectors."""
+    import numpy as np
+    if vectors is None:
+        return index.search(q, k, params=params)
+    D, I = index.search(q, k * PQ_RERANK, params=params)
+    cand = np.sort(I[0][I[0] >= 0])  # sorted ids: sequential reads from the mmap
+    exact = np.asarray(vectors[cand] @ q[0], dtype='float32')
+    top = np.argsort(-exact)[:k]
+    D2, I2 = np.full((1, k), -np.inf, dtype='float32'), np.full((1, k), -1, dtype='int64')
+    D2[0, :len(top)], I2[0, :len(top)] = exact[top], cand[top]
+    return D2, I2
+
+
+def read_chunks(path: str, old_sha):
+    """Process-pool task: (sha256, chunk spans) of a file; spans is None when
+    the content still hashes to `old_sha`, and the result None if unreadable."""
+    try:
+        data = Path(path).read_bytes()
+    except OSError:
+        return None
+    sha = hashlib.sha256(data).hexdigest()
+    if sha == old_sha:
+        return sha, None
+    # Offsets are into the utf-8 re-encoding, i.e. the file itself for valid utf-8
+    return sha, chunk_spans(data.decode('utf-8', errors='ignore'))
+
+
+def index_root(root: Path, get_model, index_type=None, workers=None, progress=None):
+    """Bring the index of `root` up to date. Returns (rc, result dict);
+    `get_model` is only called when something needs embedding. `index_type`
+    (one of INDEX_TYPES) sticks in the manifest until changed. `workers`
+    processes read and chunk files (1 = inline); `progress` receives
+    {"op":"progress",...} dicts at most every PROGRESS_S seconds."""
+    import faiss, numpy as np
+    out_dir = root/IDX_DIR_NAME
+    out_dir.mkdir(parents=True, exist_ok=True)
+    _recover(out_dir)
+    manifest = load_manifest(out_dir)
+    if manifest is None:
+        # First run, old meta.json layout or a different model: start over
+        for name in ('faiss.index', 'meta.json', 'chunks.bin', 'chunks.idx', 'vectors.f32'):
+            (out_dir/name).unlink(missing_ok=True)
+        manifest = {'version': MANIFEST_VERSION, 'model': MODEL_NAME, 'dim': None, 'next_id': 0, 'next_fid': 0,
+                    'bin_size': 0, 'dead': 0, 'index_type': 'auto', 'index': None, 'files': {}}
+    manifest['index_type'] = index_type or manifest['index_type']
+    files = manifest['files']
+
+    model = None
+    # No index yet: vectors only go to vectors.f32 and the index is built at the end
+    index = faiss.read_index(str(out_dir/'faiss.index')) if manifest['index'] else None
+    store = ChunkStore(out_dir)
+    store.open_append(manifest['next_id'], manifest['bin_size'], manifest['dim'])
+    pending_texts, pending_ids = [], []
+    seen, stale, inflight = set(), [], {}
+    stats = {'files_scanned': 0, 'files_changed': 0, 'chunks_added': 0, 'chunks_embedded': 0}
+    t0 = last = time.monotonic()
+
+    def report(phase, force=False):
+        nonlocal last
+        now = time.monotonic()
+        if progress and (force or now - last >= PROGRESS_S):
+            last = now
+            progress({"op":"progress","phase":phase,**stats,"inflight":len(inflight),"elapsed_s":round(now - t0, 2)})
+
+    def flush():
+        nonlocal model
+        if model is None:
+            model = get_model()
+        vecs = model.encode(pending_texts, convert_to_numpy=True, show_progress_bar=False, batch_size=64, normalize_embeddings=True)
+        vecs = vecs.astype('float32')
+        manifest['dim'] = vecs.shape[1]
+        store.append_vectors(vecs)
+        if index is not None:
+            index.add_with_ids(vecs, np.asarray(pending_ids, dtype='int64'))
+        stats['chunks_embedded'] += len(pending_ids)
+        pending_texts.clear(); pending_ids.clear()
+
+    def consume(rel, st, res):
+        if res is None:
+            return  # unreadable right now: keep what was indexed before
+        sha, spans = res
+        ent = files.get(rel)
+        if spans is None:
+            ent['mtime_ns'], ent['size'] = st.st_mtime_ns, st.st_size  # touched, not edited
+            return
+        if ent:
+            stale.extend(_file_ids(ent))
+            fid = ent['fid']
+        else:
+            fid = manifest['next_fid']
+            manifest['next_fid'] += 1
+        first = manifest['next_id']
+        for k, (text, start, end) in enumerate(spans):
+            store.append(text, fid, start, end)
+            pending_texts.append(text); pending_ids.append(first + k)
+        manifest['next_id'] = first + len(spans)
+        files[rel] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'sha256': sha, 'fid': fid, 'ids': [first, len(spans)]}
+        stats['files_changed'] += 1
+        stats['chunks_added'] += len(spans)
+        if len(pending_texts) >= EMBED_FLUSH:
+            flush()
+        report('ingest')
+
+    def drain(return_when):
+        done, _ = wait(inflight, return_when=return_when)
+        for f in done:
+            consume(*inflight.pop(f), f.result())
+
+    # discovery -> pool(read + chunk) -> bounded embedding batches -> index.add.
+    # At most INFLIGHT_PER_WORKER files per worker are in flight, so memory
+    # stays flat however large the corpus is.
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    try:
+        for path in iter_docs(root):
+            rel = str(path.relative_to(root))
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            seen.add(rel)
+            stats['files_scanned'] += 1
+            ent = files.get(rel)
+            if ent and ent['mtime_ns'] == st.st_mtime_ns and ent['size'] == st.st_size:
+                report('ingest')
+                continue
+            old_sha = ent['sha256'] if ent else None
+            if workers <= 1:
+                consume(rel, st, read_chunks(str(path), old_sha))
+                continue
+            if pool is None:
+                pool = ProcessPoolExecutor(workers)
+            inflight[pool.submit(read_chunks, str(path), old_sha)] = (rel, st)
+            if len(inflight) >= workers * INFLIGHT_PER_WORKER:
+                drain(FIRST_COMPLETED)
+        if inflight:
+            drain(ALL_COMPLETED)
+        if pending_texts:
+            flush()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        store.close()
+
+    deleted = [rel for rel in files if rel not in seen]
+    for rel in deleted:
+        stale.extend(_file_ids(files.pop(rel)))
+    if stale and index is not None:
+        if manifest['index']['type'] == 'hnsw':
+            index = None  # HNSW can't remove_ids: rebuild from the stored vectors
+        else:
+            index.remove_ids(np.asarray(stale, dtype='int64'))
+    report('ingest', force=True)
+
+    live = np.fromiter((i for ent in files.values() for i in _file_ids(ent)), dtype='int64')
+    live.sort()
+    if not len(live):
+        return 3, {"op":"error","error":"no texts"}
+    manifest['bin_size'] = store.bin_size
+    manifest['dead'] += len(stale)
+    # Once most stored chunks are dead, drop them from all three store files;
+    # ids change, so the index is rebuilt from the compacted vectors
+    compacted = manifest['dead'] > len(live)
+    if compacted:
+        report('compact', force=True)
+        manifest['bin_size'], manifest['next_id'] = store.compact(files, manifest['dim'])
+        manifest['dead'] = 0
+        live = np.arange(manifest['next_id'], dtype='int64')
+    kind = resolve_index_type(manifest['index_type'], len(live))
+    cur = manifest['index']
+    rebuild = (compacted or index is None or cur['type'] != kind or
+               (kind.startswith('ivf') and not cur['trained_n'] / RETRAIN_GROWTH <= len(live) <= cur['trained_n'] * RETRAIN_GROWTH))
+    if rebuild:
+        report('build_index', force=True)
+        index = build_index(store.vectors(manifest['dim']), live, kind)
+        manifest['index'] = {'type': kind, 'trained_n': len(live)}
+    # Appended chunks and vectors lie past the sizes in the old manifest, so
+    # they are invisible until _commit(); a crash before it only costs a
+    # re-embed next run
+    faiss.write_index(index, str(out_dir/'faiss.index.tmp'))
+    _fsync(out_dir/'faiss.index.tmp')
+    _commit(out_dir, manifest)
+    return 0, {"op":"done","chunks_indexed":int(index.ntotal),"files":len(files),"changed":stats['files_changed'],
+               "deleted":len(deleted),"chunks_added":stats['chunks_added'],"chunks_removed":len(stale),
+               "index_type":kind,"rebuilt":rebuild,"compacted":compacted,"elapsed_s":round(time.monotonic() - t0, 2)}
+
+
+def do_index(root: Path, index_type=None, workers=None):
     try:
         import faiss, numpy as np
         from sentence_transformers import SentenceTransformer
     except Exception as e:
         print(json.dumps({"op":"error","error":f"deps missing: {e}"}))
         return 2
-    model = SentenceTransformer('all-MiniLM-L6-v2')
+    rc, res = index_root(root, lambda: SentenceTransformer(MODEL_NAME), index_type, workers,
+                         progress=lambda ev: print(json.dumps(ev), flush=True))
+    print(json.dumps(res))
+    return rc
 
-    texts = []
-    sources = []
-    for path in root.rglob('*'):
-        if path.is_dir():
-            continue
-        if path.suffix.lower() not in {'.txt', '.md'}:
+
+def files_by_fid(manifest):
+    return {ent['fid']: (rel, *ent['ids']) for rel, ent in manifest['files'].items()}
+
+
+def fetch_chunks(store: ChunkStore, files, scores, ids, neighbors=0):
+    """Hits as result dicts. With neighbors > 0, `context` joins up to that many
+    chunks of the same file on each side of the hit."""
+    chunks = []
+    for score, i in zip(scores, ids):
+        if i < 0:
             continue
+        i = int(i)
+        r = store.recs[i]
+        rel, first, count = files.get(int(r['fid']), ('', i, 1))
+        hit = {'text': store.text(i), 'source': rel, 'score': float(score), 'id': i,
+               'start': int(r['start']), 'end': int(r['end'])}
+        if neighbors > 0:
+            lo, hi = max(first, i - neighbors), min(first + count, i + neighbors + 1)
+            hit['context'] = ' '.join(store.text(j) for j in range(lo, hi))
+            hit['context_start'], hit['context_end'] = int(store.recs[lo]['start']), int(store.recs[hi - 1]['end'])
+        chunks.append(hit)
+    return chunks
+
+
+class LoadedIndex:
+    """faiss index + mmapped chunk store + fid table of one root."""
+
+    def __init__(self, out_dir: Path, manifest, stamp):
+        import faiss
+        self.index = faiss.read_index(str(out_dir/'faiss.index'))
+        self.files = files_by_fid(manifest)
+        self.store = ChunkStore(out_dir).open_read()
+        self.kind = manifest['index']['type']
+        self.vectors = self.store.vectors(manifest['dim']) if self.kind == 'ivf_pq' else None
+        self.stamp = stamp
+
+    def search(self, q, k: int, nprobe=None, ef_search=None):
+        return ann_search(self.index, q, k, search_params(self.index, nprobe, ef_search), self.vectors)
+
+    @staticmethod
+    def stamp_of(root: Path):
         try:
-            data = path.read_text(errors='ignore')
-        except Exception:
-            continue
-        for chunk in build_chunks(data):
-            texts.append(chunk)
-            sources.append(str(path.relative_to(root)))
-    if not texts:
-        print(json.dumps({"op":"error","error":"no texts"}))
-        return 3
-    embeds = model.encode(texts, convert_to_numpy=True, show_progress_bar=False, batch_size=64, normalize_embeddings=True)
-    dim = embeds.shape[1]
-    index = faiss.IndexFlatIP(dim)
-    index.add(embeds)
-    out_dir = root/IDX_DIR_NAME
-    out_dir.mkdir(parents=True, exist_ok=True)
-    faiss.write_index(index, str(out_dir/'faiss.index'))
-    (out_dir/'meta.json').write_text(json.dumps({'sources':sources}, ensure_ascii=False))
-    print(json.dumps({"op":"done","chunks_indexed":len(texts)}))
-    return 0
+            return (root/IDX_DIR_NAME/'manifest.json').stat().st_mtime_ns
+        except OSError:
+            return None
 
+    @classmethod
+    def open(cls, root: Path):
+        stamp = cls.stamp_of(root)
+        manifest = load_manifest(root/IDX_DIR_NAME)
+        return None if manifest is None else cls(root/IDX_DIR_NAME, manifest, stamp)
 
-def do_query(root: Path, query: str, topk: int):
+
+def do_query(root: Path, query: str, topk: int, neighbors: int = 0, nprobe=None, ef_search=None):
     try:
         import faiss, numpy as np
         from sentence_transformers import SentenceTransformer
     except Exception as e:
         print(json.dumps({"op":"error","error":f"deps missing: {e}"}))
         return 2
-    out_dir = root/IDX_DIR_NAME
-    if not (out_dir/'faiss.index').exists():
+    li = LoadedIndex.open(root)
+    if li is None:
         print(json.dumps({"op":"error","error":"index not found"}))
         return 4
-    index = faiss.read_index(str(out_dir/'faiss.index'))
-    meta = json.loads((out_dir/'meta.json').read_text())
-    sources = meta['sources']
-    model = SentenceTransformer('all-MiniLM-L6-v2')
+    model = SentenceTransformer(MODEL_NAME)
     q_emb = model.encode([query], convert_to_numpy=True, normalize_embeddings=True)
-    D, I = index.search(q_emb, topk)
-    chunks = []
-    for score, idx in zip(D[0], I[0]):
-        if idx < 0 or idx >= len(sources):
-            continue
-        # For brevity, we don't keep original chunk text separately; re-load file (inefficient but acceptable for prototype)
-        rel = sources[idx]
-        file_path = root/rel
+    D, I = li.search(q_emb, topk, nprobe, ef_search)
+    print(json.dumps({"op":"done","chunks":fetch_chunks(li.store, li.files, D[0], I[0], neighbors)}))
+    return 0
+
+
+class EmbedBatcher:
+    """Single thread owning query embedding: requests that arrive while a
+    batch is forming (up to `wait_ms`) share one model.encode call."""
+
+    def __init__(self, model, max_batch=32, wait_ms=3.0):
+        import queue, threading
+        self.model, self.max_batch, self.wait = model, max_batch, wait_ms / 1000.0
+        self.q = queue.Queue()
+        threading.Thread(target=self._run, name='rag-embed', daemon=True).start()
+
+    def embed(self, text: str):
+        """(vector [1, dim], encode ms, batch size)"""
+        import threading
+        slot = {'done': threading.Event()}
+        self.q.put((text, slot))
+        slot['done'].wait()
+        if 'error' in slot:
+            raise slot['error']
+        return slot['vec'], slot['ms'], slot['n']
+
+    def _run(self):
+        import queue, time
+        while True:
+            batch = [self.q.get()]
+            deadline = time.perf_counter() + self.wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.q.get(timeout=max(0.0, deadline - time.perf_counter())))
+                except queue.Empty:
+                    break
+            t0 = time.perf_counter()
+            try:
+                vecs = self.model.encode([t for t, _ in batch], convert_to_numpy=True, show_progress_bar=False,
+                                         batch_size=len(batch), normalize_embeddings=True)
+                err = None
+            except Exception as e:
+                err = e
+            ms = (time.perf_counter() - t0) * 1000
+            for k, (_, slot) in enumerate(batch):
+                if err is not None:
+                    slot['error'] = err
+                else:
+                    slot['vec'], slot['ms'], slot['n'] = vecs[k:k + 1], ms, len(batch)
+                slot['done'].set()
+
+
+class RagServer:
+    """Warm model + LRU of loaded roots behind the JSON-lines socket."""
+
+    def __init__(self, model, max_roots=4, batch=32, batch_wait_ms=3.0):
+        import collections, threading
+        self.model = model
+        self.batcher = EmbedBatcher(model, batch, batch_wait_ms)
+        self.max_roots = max_roots
+        self.roots = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.index_locks = collections.defaultdict(threading.Lock)
+
+    def get_index(self, root: Path):
+        """(LoadedIndex or None, load ms). Reloads when the manifest changed on disk."""
+        import time
+        key = str(root.resolve())
+        stamp = LoadedIndex.stamp_of(root)
+        with self.lock:
+            li = self.roots.get(key)
+            if li is not None and li.stamp == stamp:
+                self.roots.move_to_end(key)
+                return li, 0.0
+        t0 = time.perf_counter()
+        li = LoadedIndex.open(root)
+        ms = (time.perf_counter() - t0) * 1000
+        with self.lock:
+            if li is None:
+                self.roots.pop(key, None)
+            else:
+                self.roots[key] = li
+                self.roots.move_to_end(key)
+                while len(self.roots) > self.max_roots:
+                    self.roots.popitem(last=False)
+        return li, ms
+
+    def handle(self, req):
+        import time
+        op = req.get('op')
+        if op == 'ping':
+            with self.lock:
+                return {"op":"done","model":MODEL_NAME,"roots":{k: li.kind for k, li in self.roots.items()}}
+        folder = req.get('folder') or req.get('root')
+        root = Path(os.path.expanduser(folder)) if folder else None
+        if root is None or not root.exists():
+            return {"op":"error","error":"root missing"}
+        if op in ('rag_index', 'index'):
+            with self.index_locks[str(root.resolve())]:
+                # Inline chunking: forking a process pool from this threaded server is unsafe
+                return index_root(root, lambda: self.model, req.get('index_type'), workers=1)[1]
+        if op not in ('rag_query', 'query'):
+            return {"op":"error","error":f"unknown op {op}"}
+        if not req.get('query'):
+            return {"op":"error","error":"query missing"}
+        li, load_ms = self.get_index(root)
+        if li is None:
+            return {"op":"error","error":"index not found"}
+        t0 = time.perf_counter()
+        vec, encode_ms, n = self.batcher.embed(req['query'])
+        t1 = time.perf_counter()
+        D, I = li.search(vec, int(req.get('topk', 5)), req.get('nprobe'), req.get('ef_search'))
+        t2 = time.perf_counter()
+        chunks = fetch_chunks(li.store, li.files, D[0], I[0], int(req.get('neighbors', 0)))
+        t3 = time.perf_counter()
+        # embed includes the wait for the batch to form; encode is the shared model call
+        timing = {'embed': (t1 - t0) * 1000, 'encode': encode_ms, 'search': (t2 - t1) * 1000,
+                  'fetch': (t3 - t2) * 1000, 'load': load_ms}
+        return {"op":"done","chunks":chunks,"batch":n,"timing_ms":{k: round(v, 3) for k, v in timing.items()}}
+
+
+def do_serve(sock_path: str, max_roots: int, batch: int, batch_wait_ms: float):
+    try:
+        import faiss, numpy as np
+        from sentence_transformers import SentenceTransformer
+    except Exception as e:
+        print(json.dumps({"op":"error","error":f"deps missing: {e}"}))
+        return 2
+    import signal, socketserver
+    rag = RagServer(SentenceTransformer(MODEL_NAME), max_roots, batch, batch_wait_ms)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                req = {}
+                try:
+                    req = json.loads(line)
+                    resp = rag.handle(req)
+                except Exception as e:
+                    resp = {"op":"error","error":str(e)}
+                if isinstance(req, dict) and 'id' in req:
+                    resp['id'] = req['id']
+                self.wfile.write((json.dumps(resp, ensure_ascii=False) + '\n').encode('utf-8'))
+                self.wfile.flush()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    def stop(*_):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    Path(sock_path).unlink(missing_ok=True)
+    with Server(sock_path, Handler) as srv:
+        os.chmod(sock_path, 0o600)
+        print(json.dumps({"op":"serving","socket":sock_path,"model":MODEL_NAME}), flush=True)
         try:
-            snippet = file_path.read_text(errors='ignore')[:400].replace('\n',' ')
-        except Exception:
-            snippet = ''
-        chunks.append({'text': snippet, 'source': rel, 'score': float(score)})
-    print(json.dumps({"op":"done","chunks":chunks}))
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            Path(sock_path).unlink(missing_ok=True)
     return 0
 
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument('subop', choices=['index','query'])
-    ap.add_argument('--root', required=True)
+    ap.add_argument('subop', choices=['index','query','serve'])
+    ap.add_argument('--root')
     ap.add_argument('--query')
     ap.add_argument('--topk', type=int, default=5)
+    ap.add_argument('--neighbors', type=int, default=0, help='adjacent chunks per side returned as context')
+    ap.add_argument('--index_type', choices=INDEX_TYPES, help='index: ANN structure (default: keep current, auto on first run)')
+    ap.add_argument('--workers', type=int, default=int(os.environ.get('RAG_WORKERS', '0')), help='index: read/chunk processes (0 = cpu count, 1 = inline)')
+    ap.add_argument('--nprobe', type=int, help=f'query: IVF lists probed (default {DEFAULT_NPROBE})')
+    ap.add_argument('--ef_search', type=int, help=f'query: HNSW efSearch (default {DEFAULT_EF_SEARCH})')
+    ap.add_argument('--socket', default=os.environ.get('RAG_SOCK', '/tmp/intperint-rag.sock'), help='serve: UDS path (env RAG_SOCK)')
+    ap.add_argument('--max_roots', type=int, default=int(os.environ.get('RAG_MAX_ROOTS', '4')), help='serve: resident indexes (LRU)')
+    ap.add_argument('--batch', type=int, default=32, help='serve: max queries per embedding call')
+    ap.add_argument('--batch_wait_ms', type=float, default=3.0, help='serve: how long a batch may wait to fill')
     args = ap.parse_args()
+    if args.subop == 'serve':
+        return do_serve(args.socket, args.max_roots, args.batch, args.batch_wait_ms)
+    if not args.root:
+        print(json.dumps({"op":"error","error":"root missing"}))
+        return 1
     root = Path(os.path.expanduser(args.root))
     if not root.exists():
         print(json.dumps({"op":"error","error":"root missing"}))
         return 1
     if args.subop == 'index':
-        return do_index(root)
+        return do_index(root, args.index_type, args.workers)
     else:
         if not args.query:
             print(json.dumps({"op":"error","error":"query missing"}))
             return 1
-        return do_query(root, args.query, args.topk)
+        return do_query(root, args.query, args.topk, args.neighbors, args.nprobe, args.ef_search)
 
 if __name__ == '__main__':
     raise SystemExit(main())
@@ -579,7 +579,11 @@ static void serve_client(int cfd, const std::string& cfg) {
                         std::string folder = json_get_string(req, "folder");
                         std::string query = json_get_string(req, "query");
                         std::string topk = std::to_string(json_get_int(req, "topk", 5));
-                        std::map<std::string,std::string> kv {{"SUBOP", subop},{"RAG_ROOT", folder},{"QUERY", escape_quotes(query)},{"TOPK", topk}};
+                        std::string neighbors = std::to_string(json_get_int(req, "neighbors", 0));
+                        // 0 = rag_worker の既定値
+                        std::string nprobe = std::to_string(json_get_int(req, "nprobe", 0));
+                        std::string ef_search = std::to_string(json_get_int(req, "ef_search", 0));
+                        std::map<std::string,std::string> kv {{"SUBOP", subop},{"RAG_ROOT", folder},{"QUERY", escape_quotes(query)},{"TOPK", topk},{"NEIGHBORS", neighbors},{"NPROBE", nprobe},{"EF_SEARCH", ef_search}};
                         std::string cmd = build_cmd(tmpl, kv);
                         fs::path log = fs::path(outputs_base_from_cfg(cfg))/"rag.log";
                         int rc = run_system_logged(cmd, log);
@@ -0,0 +1,213 @@
+import sys
+import threading
+import zlib
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('faiss')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+import rag_worker as rw  # noqa: E402
+
+
+class FakeEncoder:
+    """Bag of hashed words, L2-normalized: the same text always maps to the
+    same vector and texts sharing words score higher."""
+    dim = 32
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts, **kw):
+        self.calls.append(len(texts))
+        out = np.zeros((len(texts), self.dim), dtype='float32')
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                out[row, zlib.crc32(word.strip('.').encode()) % self.dim] += 1.0
+        out /= np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-6)
+        return out
+
+
+def _doc(topic, n=40):
+    return ' '.join(f'{topic} sentence {j} talks about {topic}.' for j in range(n))
+
+
+def _index(root, enc, **kw):
+    rc, res = rw.index_root(root, lambda: enc, workers=kw.pop('workers', 1), **kw)
+    assert rc == 0, res
+    return res
+
+
+def _query(root, enc, text, k=3, **kw):
+    li = rw.LoadedIndex.open(root)
+    D, I = li.search(enc.encode([text]), k, **kw)
+    return rw.fetch_chunks(li.store, li.files, D[0], I[0])
+
+
+def test_incremental_change_and_delete(tmp_path):
+    enc = FakeEncoder()
+    for name in ('apple', 'banana', 'cherry'):
+        (tmp_path / f'{name}.txt').write_text(_doc(name))
+    first = _index(tmp_path, enc)
+    assert first['changed'] == 3 and first['rebuilt']
+
+    (tmp_path / 'banana.txt').write_text(_doc('durian'))
+    (tmp_path / 'cherry.txt').unlink()
+    enc.calls.clear()
+    res = _index(tmp_path, enc)
+    assert (res['changed'], res['deleted'], res['files']) == (1, 1, 2)
+    # Only the edited file is re-embedded
+    assert sum(enc.calls) == res['chunks_added']
+    assert res['chunks_removed'] == 2 * first['chunks_added'] // 3
+    assert _query(tmp_path, enc, 'durian')[0]['source'] == 'banana.txt'
+    assert all('cherry' not in c['text'] for c in _query(tmp_path, enc, 'cherry', k=10))
+
+    # Nothing changed: nothing is embedded
+    enc.calls.clear()
+    assert _index(tmp_path, enc)['changed'] == 0 and enc.calls == []
+
+
+def test_compaction_renumbers_store_files(tmp_path):
+    enc = FakeEncoder()
+    for name in ('apple', 'banana', 'cherry', 'durian'):
+        (tmp_path / f'{name}.txt').write_text(_doc(name))
+    _index(tmp_path, enc)
+    for name in ('apple', 'banana', 'cherry'):
+        (tmp_path / f'{name}.txt').unlink()
+    res = _index(tmp_path, enc)
+    assert res['compacted']
+    out_dir = tmp_path / rw.IDX_DIR_NAME
+    manifest = rw.load_manifest(out_dir)
+    live = res['chunks_indexed']
+    assert manifest['files']['durian.txt']['ids'] == [0, live] and manifest['next_id'] == live
+    assert (out_dir / 'chunks.idx').stat().st_size == live * rw.REC.size
+    assert (out_dir / 'vectors.f32').stat().st_size == live * FakeEncoder.dim * 4
+    assert not list(out_dir.glob('*.tmp')) and not (out_dir / 'manifest.json.next').exists()
+    hit = _query(tmp_path, enc, 'durian')[0]
+    assert hit['source'] == 'durian.txt' and 'durian' in hit['text']
+
+
+def test_fetch_chunks_neighbors_stay_in_file(tmp_path):
+    enc = FakeEncoder()
+    (tmp_path / 'a.txt').write_text(_doc('apple', n=100))
+    (tmp_path / 'b.txt').write_text(_doc('banana'))
+    _index(tmp_path, enc)
+    li = rw.LoadedIndex.open(tmp_path)
+    first, count = rw.load_manifest(tmp_path / rw.IDX_DIR_NAME)['files']['a.txt']['ids']
+    assert count >= 3
+    data = (tmp_path / 'a.txt').read_bytes()
+
+    mid = first + 1
+    hit, = rw.fetch_chunks(li.store, li.files, [1.0], [mid], neighbors=1)
+    assert hit['text'] == li.store.text(mid) and data[hit['start']:hit['end']].decode() == hit['text']
+    assert hit['context'] == ' '.join(li.store.text(j) for j in (mid - 1, mid, mid + 1))
+    assert (hit['context_start'], hit['context_end']) == (int(li.store.recs[mid - 1]['start']), int(li.store.recs[mid + 1]['end']))
+
+    # At the end of a file the context does not spill into the next one
+    last = first + count - 1
+    hit, = rw.fetch_chunks(li.store, li.files, [1.0], [last], neighbors=2)
+    assert hit['context'] == ' '.join(li.store.text(j) for j in (last - 2, last - 1, last))
+    assert 'banana' not in hit['context']
+    assert rw.fetch_chunks(li.store, li.files, [0.0], [-1]) == []
+
+
+def _clustered(n, dim, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((20, dim)).astype('float32')
+    x = centers[rng.integers(0, 20, n)] + 0.3 * rng.standard_normal((n, dim)).astype('float32')
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def test_ivf_nprobe_and_hnsw_ef_search():
+    import faiss
+    x, q = _clustered(4000, 32, 0), _clustered(20, 32, 1)
+    ids = np.arange(len(x), dtype='int64')
+    truth = rw.build_index(x, ids, 'flat').search(q, 5)[1]
+
+    ivf = rw.build_index(x, ids, 'ivf_flat')
+    nlist = faiss.extract_index_ivf(ivf).nlist
+    assert rw.search_params(ivf).nprobe == rw.DEFAULT_NPROBE
+    assert rw.search_params(ivf, nprobe=3).nprobe == 3
+    # Probing every list is exhaustive, one list is not
+    assert (rw.ann_search(ivf, q, 5, rw.search_params(ivf, nprobe=nlist))[1] == truth).all()
+    assert rw.ann_search(ivf, q, 5, rw.search_params(ivf, nprobe=1))[1].shape == (20, 5)
+
+    hnsw = rw.build_index(x, ids, 'hnsw')
+    assert rw.search_params(hnsw).efSearch == rw.DEFAULT_EF_SEARCH
+    assert rw.search_params(hnsw, ef_search=200).efSearch == 200
+    found = rw.ann_search(hnsw, q, 5, rw.search_params(hnsw, ef_search=200))[1]
+    assert np.mean([len(set(a) & set(b)) / 5 for a, b in zip(found, truth)]) > 0.9
+    assert rw.search_params(rw.build_index(x, ids, 'flat')) is None
+
+
+def test_index_type_sticks_and_query_params_pass_through(tmp_path):
+    enc = FakeEncoder()
+    for k in range(4):
+        (tmp_path / f'd{k}.txt').write_text(_doc(f'topic{k}', n=200))
+    assert _index(tmp_path, enc, index_type='hnsw')['index_type'] == 'hnsw'
+    (tmp_path / 'd0.txt').write_text(_doc('fresh'))
+    res = _index(tmp_path, enc)
+    assert res['index_type'] == 'hnsw' and res['rebuilt']  # HNSW can't remove ids
+    assert _query(tmp_path, enc, 'fresh', ef_search=16)[0]['source'] == 'd0.txt'
+
+
+def test_rag_server_batches_concurrent_queries(tmp_path, monkeypatch):
+    monkeypatch.setattr(rw, 'ProcessPoolExecutor', None)  # the server indexes inline, never forks
+    enc = FakeEncoder()
+    (tmp_path / 'a.txt').write_text(_doc('apple'))
+    (tmp_path / 'b.txt').write_text(_doc('banana'))
+    rag = rw.RagServer(enc, batch=8, batch_wait_ms=200)
+    assert rag.handle({'op': 'rag_index', 'folder': str(tmp_path)})['op'] == 'done'
+    rag.handle({'op': 'rag_query', 'folder': str(tmp_path), 'query': 'warm up'})
+    enc.calls.clear()
+
+    out = [None] * 4
+    start = threading.Barrier(4)
+
+    def ask(k):
+        start.wait()
+        out[k] = rag.handle({'op': 'rag_query', 'folder': str(tmp_path), 'query': ['apple', 'banana'][k % 2], 'topk': 2})
+
+    threads = [threading.Thread(target=ask, args=(k,)) for k in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(enc.calls) == 4 and len(enc.calls) < 4
+    assert max(r['batch'] for r in out) > 1
+    assert [r['chunks'][0]['source'] for r in out] == ['a.txt', 'b.txt', 'a.txt', 'b.txt']
+    assert rag.handle({'op': 'rag_query', 'folder': str(tmp_path / 'missing'), 'query': 'x'})['error'] == 'root missing'
+    assert rag.handle({'op': 'rag_query', 'folder': str(tmp_path)})['error'] == 'query missing'
+
+
+def test_streaming_ingest_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.setattr(rw, 'EMBED_FLUSH', 7)  # many small embedding batches
+    monkeypatch.setattr(rw, 'INFLIGHT_PER_WORKER', 1)
+    roots = {}
+    for mode, workers in (('serial', 1), ('stream', 2)):
+        root = tmp_path / mode
+        (root / 'sub').mkdir(parents=True)
+        for k in range(12):
+            (root / ('sub' if k % 3 else '') / f'd{k}.md').write_text(_doc(f'topic{k}', n=10 + 7 * k))
+        events = []
+        rw.index_root(root, lambda: FakeEncoder(), workers=workers, progress=events.append)
+        assert events and events[-1]['op'] == 'progress'
+        roots[mode] = root
+
+    def per_file(root):
+        out_dir = root / rw.IDX_DIR_NAME
+        manifest = rw.load_manifest(out_dir)
+        store = rw.ChunkStore(out_dir).open_read()
+        vecs = store.vectors(manifest['dim'])
+        # Chunk ids depend on completion order, so compare file by file
+        return {rel: ([store.text(i) for i in rw._file_ids(ent)], np.asarray(vecs[rw._file_ids(ent)]).tolist(),
+                      ent['sha256'])
+                for rel, ent in manifest['files'].items()}
+
+    serial, stream = per_file(roots['serial']), per_file(roots['stream'])
+    assert len(serial) == 12 and serial == stream
+    enc = FakeEncoder()
+    for k in (0, 5, 11):
+        assert (_query(roots['serial'], enc, f'topic{k}', k=5)[0]['text']
+                == _query(roots['stream'], enc, f'topic{k}', k=5)[0]['text'])
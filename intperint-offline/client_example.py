@@ -9,6 +9,15 @@ s = LocalOnlySession()
 r = s.post("http://127.0.0.1:8000/generate_text", json={"prompt": "Hello offline world", "mode": "draft"})
 print("/generate_text draft:", r.json())
 
+# streamed draft: NDJSON {"op":"token",...} events, then {"op":"done",...}
+with s.post("http://127.0.0.1:8000/generate_text", json={"prompt": "Hello offline world", "mode": "draft", "stream": True}, stream=True) as r:
+    for line in r.iter_lines():
+        if line:
+            ev = json.loads(line)
+            if ev["op"] == "token":
+                print(ev["data"], end="", flush=True)
+    print()
+
 # analyze_image (requires API server running, uploads mock)
 img_path = Path("uploads/mock.png")
 img_path.parent.mkdir(parents=True, exist_ok=True)
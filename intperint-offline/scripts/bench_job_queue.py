@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for JobQueue: enqueue / dequeue / status ops/sec.
+
+Compares the pooled WAL connection against the previous behaviour
+(one sqlite3.connect per call, rollback journal).
+
+    python scripts/bench_job_queue.py --n 2000
+"""
+import argparse
+import json
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from src.job_queue import JobQueue  # noqa: E402
+
+
+class ConnectPerCallJobQueue(JobQueue):
+    """Baseline: open and close a connection for every operation."""
+
+    @contextmanager
+    def _conn(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+def bench(cls, db_path: Path, n: int) -> dict:
+    jq = cls(db_path)
+    res = {}
+
+    t0 = time.perf_counter()
+    ids = [jq.enqueue("bench", {"i": i, "prompt": "x" * 64}) for i in range(n)]
+    res["enqueue_ops"] = n / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    for jid in ids:
+        jq.status(jid)
+    res["status_ops"] = n / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    claimed = 0
+    while jq.dequeue(types=["bench"], worker_id="bench") is not None:
+        claimed += 1
+    res["dequeue_ops"] = claimed / (time.perf_counter() - t0)
+    return {k: round(v, 1) for k, v in res.items()}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=2000)
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as d:
+        before = bench(ConnectPerCallJobQueue, Path(d) / "before.sqlite3", args.n)
+        after = bench(JobQueue, Path(d) / "after.sqlite3", args.n)
+    speedup = {k: round(after[k] / before[k], 2) for k in before}
+    print(json.dumps({"n": args.n, "before": before, "after": after, "speedup": speedup}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Aggregate tokens/sec of a running llm20 service at several concurrency levels.
+
+Start the service first (scripts/start_all_offline.sh), then:
+
+    python scripts/bench_llm20_batch.py --concurrency 1 4 16 --max-tokens 128
+
+Tokens are counted from the streamed {"op":"token"} events. Compare
+LLM20_BATCH_SLOTS=1 (no batching) against the default to see the effect
+of continuous batching. Requests rejected with 429 are reported separately.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from src.utils import LocalOnlySession  # noqa: E402
+
+URL = "http://127.0.0.1:8001/gen"
+
+
+def one_request(session: LocalOnlySession, prompt: str, max_tokens: int) -> tuple[int, float, bool]:
+    t0 = time.perf_counter()
+    first = None
+    n = 0
+    with session.post(URL, json={"prompt": prompt, "max_tokens": max_tokens, "stream": True}, stream=True) as r:
+        if r.status_code == 429:
+            return 0, 0.0, False
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if not line:
+                continue
+            ev = json.loads(line)
+            if ev.get("op") == "token":
+                n += 1
+                if first is None:
+                    first = time.perf_counter() - t0
+    return n, first or 0.0, True
+
+
+def run_level(concurrency: int, requests_per_client: int, max_tokens: int) -> dict:
+    tokens = []
+    ttft = []
+    rejected = [0]
+    lock = threading.Lock()
+
+    def client(idx: int):
+        s = LocalOnlySession()
+        for j in range(requests_per_client):
+            n, first, ok = one_request(s, f"Write a short note #{idx}-{j} about offline inference.", max_tokens)
+            with lock:
+                if ok:
+                    tokens.append(n)
+                    ttft.append(first)
+                else:
+                    rejected[0] += 1
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    ttft.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(tokens),
+        "rejected_429": rejected[0],
+        "tokens": sum(tokens),
+        "tokens_per_s": round(sum(tokens) / elapsed, 2) if elapsed > 0 else 0.0,
+        "ttft_p50_s": round(ttft[len(ttft) // 2], 3) if ttft else None,
+        "elapsed_s": round(elapsed, 2),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    ap.add_argument("--requests", type=int, default=2, help="requests per client")
+    ap.add_argument("--max-tokens", type=int, default=128)
+    args = ap.parse_args()
+    health = LocalOnlySession().get("http://127.0.0.1:8001/health").json()
+    print(json.dumps({"health": health}))
+    for c in args.concurrency:
+        print(json.dumps(run_level(c, args.requests, args.max_tokens)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""VLM throughput (images/sec) against batch size, bypassing the result cache.
+
+Needs transformers, torch, Pillow and a LLaVA checkpoint in LLAVA_DIR:
+
+    VLM_DTYPE=bf16 VLM_THREADS=8 python scripts/bench_vlm.py --batch 1 2 4 8 --n 16
+    python scripts/bench_vlm.py --images ~/Pictures/samples --max-new-tokens 64
+
+Without --images, random 336x336 images are generated in a temp dir.
+The first (warm-up) batch is excluded from the timings.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def synthetic_images(out_dir: Path, n: int) -> list[Path]:
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(n):
+        p = out_dir / f"img_{i:03d}.png"
+        Image.fromarray(rng.integers(0, 256, (336, 336, 3), dtype=np.uint8)).save(p)
+        paths.append(p)
+    return paths
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--batch", type=int, nargs="+", default=[1, 2, 4, 8])
+    ap.add_argument("--n", type=int, default=16, help="images per batch size")
+    ap.add_argument("--images", type=Path, help="directory of .png/.jpg images")
+    ap.add_argument("--max-new-tokens", type=int, default=64)
+    ap.add_argument("--prompt", default="Describe the image in one sentence.")
+    args = ap.parse_args()
+    os.environ["VLM_MAX_NEW_TOKENS"] = str(args.max_new_tokens)
+    from src import vlm_worker as vw  # reads VLM_* at import
+
+    if not vw.ENGINE.available():
+        print(json.dumps({"error": f"no usable VLM (transformers/torch/Pillow or {vw.MODEL_DIR}/config.json missing)"}))
+        return 1
+    with tempfile.TemporaryDirectory() as d:
+        if args.images:
+            paths = sorted(p for p in args.images.iterdir() if p.suffix.lower() in {".png", ".jpg", ".jpeg"})
+            paths = (paths * (args.n // max(1, len(paths)) + 1))[:args.n]
+        else:
+            paths = synthetic_images(Path(d), args.n)
+        vw.ENGINE.load()
+        print(json.dumps({"model_dir": vw.MODEL_DIR, "device": vw.ENGINE.device,
+                          "dtype": str(vw.ENGINE.model.dtype), "threads": vw.THREADS}))
+        for bs in args.batch:
+            vw.ENGINE.batch_size = bs
+            vw.ENGINE.generate(paths[:bs], [args.prompt] * bs)  # warm-up
+            t0 = time.perf_counter()
+            vw.ENGINE.generate(paths, [args.prompt] * len(paths))
+            elapsed = time.perf_counter() - t0
+            print(json.dumps({"batch": bs, "images": len(paths), "elapsed_s": round(elapsed, 2),
+                              "images_per_s": round(len(paths) / elapsed, 3)}))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
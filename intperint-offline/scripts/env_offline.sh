@@ -15,12 +15,45 @@ export LLM20_MODEL="{{MODEL_PATH_W8KXL_20B}}"
 export LLM20_THREADS="8"
 export LLM20_NGL="35"
 export LLM20_CTX="4096"
+export LLM20_WORKERS="1"     # inference threads (one llama context each is not thread-safe)
+export LLM20_QUEUE_MAX="8"   # waiting requests before /gen answers 429
+export LLM20_BATCH_SLOTS="4" # sequences decoded together (KV for CTX tokens each); 1 disables batching
+export LLM20_BATCH_WINDOW_MS="10"
+export LLM20_PREFIX_CACHE_MB="2048"  # saved KV state for repeated prompt prefixes; 0 disables
 
 export DEEPSEEK67_MODEL="{{MODEL_PATH_DEEPSEEK_67B}}"
 export LLM67_THREADS="8"
 export LLM67_NGL="35"
 export LLM67_CTX="4096"
+export LLM67_IDLE_UNLOAD="900"   # seconds idle before the resident 67B model is released (0 = never)
+export LLM67_PRELOAD="0"         # 1 = load the model at worker start
 
 export SDXL_MODEL_DIR="{{SDXL_MODEL_DIR}}"
 export ANIM_MOTION="{{ANIMATEDIFF_MOTION}}"
+export ANIM_BASE_DIR="{{SD15_MODEL_DIR}}"  # SD1.5 base the motion adapter runs on
+export FFMPEG_BIN="ffmpeg"                 # frames are piped to it as raw RGB
+export DIFFUSION_PIPE_CACHE="1"  # loaded image pipelines kept per diffusion worker (LRU)
+export DIFFUSION_VIDEO_PIPE_CACHE="1"  # loaded AnimateDiff pipelines, cached separately from image ones
+export DIFFUSION_WARMUP="0"      # 1 = load SDXL and run one step at worker start
 export LLAVA_DIR="{{LLAVA_MODEL_DIR}}"
+export UPLOAD_MAX_MB="32"           # /analyze_image upload cap (413 above it)
+export VLM_CACHE_MAX_MB="64"       # on-disk VLM result cache budget (oldest evicted first)
+export VLM_CACHE_MEM_ITEMS="512"   # in-memory LRU entries in front of the disk cache
+export VLM_STATS_STALE_S="300"     # /metrics/vlm_cache ignores worker stats older than this
+export VLM_DTYPE="auto"            # auto|fp32|bf16|fp16 (auto = fp32 on CPU, fp16 on GPU/MPS)
+export VLM_THREADS="0"             # torch CPU threads for the VLM (0 = default)
+export VLM_BATCH="4"               # analyze_image jobs per forward pass
+export VLM_PRELOAD="0"             # 1 = load LLaVA at worker start
+export DIFFUSION_BATCH_JOBS="4"    # compatible generate_image jobs claimed together
+export DIFFUSION_MAX_BATCH="4"     # images per pipeline call (lower if VRAM is short)
+export JOBQ_PROGRESS_INTERVAL="0.5"  # min seconds between progress writes per job
+export JOBQ_AGING_S="60"           # queued jobs gain one priority level per N seconds (0 = strict priority)
+export JOBQ_MAX_RUNNING=""         # per-type caps, e.g. "generate_video=1,generate_text_heavy=1"
+export JOBQ_MAX_GPU_JOBS="0"       # cap on running image/video/heavy-text/vlm jobs together (0 = none)
+export JOBQ_LEASE_S="60"           # claim lease, renewed by running workers every lease/3
+export JOBQ_MAX_ATTEMPTS="3"       # claims before a job whose worker keeps dying is failed
+export JOBQ_RETRY_BACKOFF_S="10"   # requeue delay, doubled per attempt (max JOBQ_RETRY_BACKOFF_MAX_S)
+export JOBQ_RETAIN_S="604800"      # finished jobs older than this move to jobs_archive
+export JOBQ_MAINTENANCE_S="600"    # API runs lease recovery + archiving this often (0 = off)
+export JOBQ_RESULT_CACHE_TTL_S="86400"  # identical seeded requests reuse a finished job this long
+export JOBQ_RESULT_CACHE_MAX="10000"    # newest finished jobs eligible for reuse
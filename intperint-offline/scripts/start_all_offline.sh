@@ -16,6 +16,9 @@ nohup python src/deepseek67_worker.py > logs/deepseek67.out 2>&1 & echo $! > log
 # Diffusion worker
 nohup python src/diffusion_worker.py > logs/diffusion.out 2>&1 & echo $! > logs/diffusion.pid
 
+# VLM worker (analyze_image jobs, batched)
+nohup python -m src.vlm_worker > logs/vlm.out 2>&1 & echo $! > logs/vlm.pid
+
 # Orchestrator API (port 8000)
 nohup python -m uvicorn src.api_server:app --host 127.0.0.1 --port 8000 --reload=false --access-log=false > logs/api.out 2>&1 & echo $! > logs/api.pid
 
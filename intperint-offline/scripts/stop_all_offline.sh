@@ -2,7 +2,7 @@
 set -euo pipefail
 cd "$(dirname "$0")/.."
 
-for name in llm20 deepseek67 diffusion api; do
+for name in llm20 deepseek67 diffusion vlm api; do
   if [[ -f logs/${name}.pid ]]; then
     pid=$(cat logs/${name}.pid)
     if ps -p "$pid" > /dev/null 2>&1; then
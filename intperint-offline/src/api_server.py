@@ -1,15 +1,30 @@
 import os
+import re
 import sys
+import json
+import asyncio
+import hashlib
 import logging
+import tempfile
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Union
 
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
+import httpx
 import uvicorn
 
-from .job_queue import JobQueue
-from .utils import set_offline_env_defaults, ensure_dir, LocalOnlySession
+from .diffusion_params import image_params, image_batch_key, video_params
+from .job_queue import JobQueue, parse_priority, canonical_key
+from .notify import StatusHub
+from .utils import (
+    set_offline_env_defaults, ensure_dir, store_content_addressed, AsyncLocalOnlyClient, CircuitOpenError,
+    DEEPSEEK67_MODEL, SDXL_MODEL_DIR,
+)
 
 set_offline_env_defaults()
 
@@ -19,73 +34,284 @@ logger = logging.getLogger("api")
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 UPLOADS = ensure_dir(BASE_DIR / "uploads")
+# Lease recovery, archiving of old finished jobs and result-cache eviction (0 disables the task)
+MAINTENANCE_INTERVAL_S = float(os.environ.get("JOBQ_MAINTENANCE_S", "600"))
 
-app = FastAPI(title="intperint-offline API", version="0.1.0")
+
+async def _queue_maintenance():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL_S)
+        try:
+            reaped = await run_in_threadpool(jq.reap_expired)
+            moved = await run_in_threadpool(jq.compact)
+            evicted = await run_in_threadpool(jq.evict_result_cache)
+            if reaped or moved or evicted:
+                logger.info(f"job queue maintenance: requeued/failed={reaped} archived={moved} uncached={evicted}")
+        except Exception as e:
+            logger.warning(f"job queue maintenance failed: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(hub.start)
+    task = asyncio.create_task(_queue_maintenance()) if MAINTENANCE_INTERVAL_S > 0 else None
+    try:
+        yield
+    finally:
+        if task is not None:
+            task.cancel()
+        await llm20.aclose()
+
+
+app = FastAPI(title="intperint-offline API", version="0.1.0", lifespan=lifespan)
 jq = JobQueue()
-local_http = LocalOnlySession()
+hub = StatusHub(jq.channel)
+llm20 = AsyncLocalOnlyClient(
+    os.environ.get("LLM20_URL", "http://127.0.0.1:8001"),
+    timeout_s=float(os.environ.get("LLM20_TIMEOUT_S", "300")),
+    retries=int(os.environ.get("LLM20_RETRIES", "2")),
+)
+
+TERMINAL_STATUSES = {"done", "error", "cancelled"}
+MAX_WAIT_S = float(os.environ.get("API_MAX_WAIT_S", "60"))
+SSE_KEEPALIVE_S = 15.0
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_MB", "32")) << 20
+UPLOAD_CHUNK = 1 << 20
 
 
 class GenTextRequest(BaseModel):
     prompt: str
     mode: str = "draft"  # draft -> 20B microservice, heavy -> 67B job
     max_tokens: int = 256
+    stream: bool = False  # draft only: NDJSON token/done events
+    priority: Union[int, str] = "normal"  # heavy only: low|normal|high or 0..10
+    seed: Optional[int] = None  # heavy only: fixed seed makes the result cacheable
+    dedupe: bool = True  # heavy only: reuse an identical queued/running/cached job
 
 class GenImageRequest(BaseModel):
     prompt: str
     params: Dict[str, Any] = {}
+    priority: Union[int, str] = "normal"
+    dedupe: bool = True
 
 class GenVideoRequest(BaseModel):
     prompt: str
     params: Dict[str, Any] = {}
+    priority: Union[int, str] = "normal"
+
+
+def _submit(type_: str, payload: Dict[str, Any], identity: Dict[str, Any], dedupe: bool,
+            cacheable: bool, **kw: Any) -> Dict[str, Any]:
+    """Enqueue through the queue's dedupe layer. `identity` is what makes two
+    requests the same job (prompt, params, seed if given, model)."""
+    if not dedupe:
+        return {"job_id": jq.enqueue(type_, payload, **kw), "dedupe": "new"}
+    jid, how = jq.submit(type_, payload, dedupe_key=canonical_key(type_, identity), cacheable=cacheable, **kw)
+    out = {"job_id": jid, "dedupe": how}
+    if how == "cached":
+        out["status"] = "done"
+        out["result"] = jq.status(jid)["result"]
+    return out
+
+
+def _priority(value: Union[int, str]) -> int:
+    try:
+        return parse_priority(value)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def _busy_headers(headers) -> Dict[str, str]:
+    return {k: headers[k] for k in ("Retry-After", "X-Queue-Depth", "X-Queue-ETA-Ms") if k in headers}
+
+
+def _llm20_unavailable(e: Exception) -> JSONResponse:
+    retry_after = e.retry_after_s if isinstance(e, CircuitOpenError) else llm20.reset_after_s
+    logger.warning(f"llm20 unavailable: {e}")
+    return JSONResponse(
+        {"error": "llm20_unavailable", "detail": str(e)},
+        status_code=503,
+        headers={"Retry-After": str(max(1, int(retry_after)))},
+    )
+
+
+async def _draft_upstream(req: GenTextRequest, stream: bool):
+    """Forward a draft request to llm20. Returns a response for the client if
+    llm20 is busy/down/failing, otherwise (None, upstream response)."""
+    body = {"prompt": req.prompt, "max_tokens": req.max_tokens, "stream": stream}
+    try:
+        if stream:
+            r = await llm20.open_stream("POST", "/gen", json=body)
+        else:
+            r = await llm20.post("/gen", json=body)
+    except (CircuitOpenError, httpx.HTTPError) as e:
+        return _llm20_unavailable(e), None
+    if r.status_code == 200:
+        return None, r
+    if stream:
+        await r.aread()
+        await r.aclose()
+    if r.status_code == 429:
+        # llm20 admission queue is full: pass the back-pressure on to the client
+        return JSONResponse(r.json(), status_code=429, headers=_busy_headers(r.headers)), None
+    return JSONResponse({"error": "llm20_error", "status": r.status_code, "detail": r.text[:500]}, status_code=502), None
+
+
+async def _relay_lines(r):
+    try:
+        async for line in r.aiter_lines():
+            if line:
+                yield (line + "\n").encode("utf-8")
+    finally:
+        await r.aclose()
 
 
 @app.post("/generate_text")
 async def generate_text(req: GenTextRequest):
     if req.mode == "draft":
-        # Call 20B microservice locally
-        try:
-            r = local_http.post("http://127.0.0.1:8001/gen", json={"prompt": req.prompt, "max_tokens": req.max_tokens})
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            return {"text": f"[MOCK draft] {req.prompt[:64]}...", "note": str(e)}
+        # Call 20B microservice locally (async keep-alive pool, event loop stays free)
+        failed, r = await _draft_upstream(req, stream=req.stream)
+        if failed is not None:
+            return failed
+        if req.stream:
+            return StreamingResponse(_relay_lines(r), media_type="application/x-ndjson", background=BackgroundTask(r.aclose))
+        return r.json()
     elif req.mode == "heavy":
-        jid = jq.enqueue("generate_text_heavy", {"prompt": req.prompt, "max_tokens": req.max_tokens})
-        return {"job_id": jid}
+        payload = {"prompt": req.prompt, "max_tokens": req.max_tokens, "seed": req.seed}
+        identity = {**payload, "model": DEEPSEEK67_MODEL}
+        return _submit("generate_text_heavy", payload, identity, req.dedupe, cacheable=req.seed is not None,
+                       priority=_priority(req.priority))
     else:
         return {"error": "invalid_mode"}
 
 
 @app.post("/generate_image")
 async def generate_image(req: GenImageRequest):
-    jid = jq.enqueue("generate_image", {"prompt": req.prompt, "params": req.params})
-    return {"job_id": jid}
+    try:
+        params = image_params(req.params)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=422, detail=f"invalid params: {e}")
+    seeded = req.params.get("seed") is not None
+    # Without an explicit seed only in-flight duplicates (double submits) are merged
+    identity = {"prompt": req.prompt, "model": SDXL_MODEL_DIR,
+                "params": params if seeded else {k: v for k, v in params.items() if k != "seed"}}
+    return _submit("generate_image", {"prompt": req.prompt, "params": params}, identity, req.dedupe,
+                   cacheable=seeded, batch_key=image_batch_key(params), priority=_priority(req.priority))
 
 
 @app.post("/generate_video")
 async def generate_video(req: GenVideoRequest):
-    jid = jq.enqueue("generate_video", {"prompt": req.prompt, "params": req.params})
+    try:
+        params = video_params(req.params)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=422, detail=f"invalid params: {e}")
+    jid = jq.enqueue("generate_video", {"prompt": req.prompt, "params": params}, priority=_priority(req.priority))
     return {"job_id": jid}
 
 
+async def _store_upload(file: UploadFile) -> tuple[Path, str, int, bool]:
+    """Stream an upload to disk in chunks while hashing it (sha256) and store it
+    content-addressed under UPLOADS, so identical images are kept once.
+    Returns (path, digest, size, deduplicated)."""
+    h = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=ensure_dir(UPLOADS / ".tmp"))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=f"upload exceeds {UPLOAD_MAX_BYTES} bytes")
+                h.update(chunk)
+                f.write(chunk)
+        digest = h.hexdigest()
+        # Keep the extension (image decoders sniff it), never the client's name
+        suffix = re.sub(r"[^a-z0-9.]", "", Path(file.filename or "").suffix.lower())[:10]
+        dst, dedup = store_content_addressed(tmp, UPLOADS, digest, suffix)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return dst, digest, size, dedup
+
+
 @app.post("/analyze_image")
-async def analyze_image(file: UploadFile = File(...)):
-    # Save file locally and call local function in-process to avoid HTTP
-    data = await file.read()
-    dst = UPLOADS / file.filename
-    with open(dst, "wb") as f:
-        f.write(data)
+async def analyze_image(file: UploadFile = File(...), prompt: Optional[str] = Form(None), queue: bool = False):
+    """Analyze inline (one image at a time in this process), or with
+    ?queue=true hand the image to the VLM worker (batched with other pending
+    images) and return a job_id."""
+    if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"upload exceeds {UPLOAD_MAX_BYTES} bytes")
+    dst, digest, size, dedup = await _store_upload(file)
+    if queue:
+        # All analyze jobs run on the one LLaVA model, so they may share a batch
+        jid = jq.enqueue("analyze_image", {"path": str(dst), "image_sha256": digest, "prompt": prompt},
+                         batch_key="llava")
+        return {"job_id": jid, "image_sha256": digest, "bytes": size, "deduplicated": dedup}
     # Import locally to avoid importing if unused
     from .vlm_worker import analyze_image as vlm_analyze
-    res = vlm_analyze(str(dst))
-    return res
+    # Model inference is blocking: keep it off the event loop
+    res = await run_in_threadpool(vlm_analyze, str(dst), prompt, digest)
+    return {**res, "image_sha256": digest, "bytes": size, "deduplicated": dedup}
+
+
+def _is_final(st: Dict[str, Any]) -> bool:
+    # not_found responses carry no status and never change
+    return ("status" not in st) or st["status"] in TERMINAL_STATUSES
+
+
+@app.get("/metrics/vlm_cache")
+def vlm_cache_metrics():
+    from .vlm_worker import cache_stats
+    return cache_stats()
 
 
 @app.get("/job_status/{job_id}")
-async def job_status(job_id: str):
+async def job_status(job_id: str, wait: float = 0):
+    # wait>0: long-poll until the job's status changes (or `wait` seconds pass)
+    if wait <= 0:
+        return jq.status(job_id)
+    async with hub.subscribe(job_id) as events:
+        st = jq.status(job_id)
+        if _is_final(st):
+            return st
+        try:
+            await asyncio.wait_for(events.get(), timeout=min(wait, MAX_WAIT_S))
+        except asyncio.TimeoutError:
+            return st
     return jq.status(job_id)
 
 
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events: the current status, every transition, then the final status."""
+    async def stream():
+        async with hub.subscribe(job_id) as events:
+            st = jq.status(job_id)
+            yield _sse("status", st)
+            while not _is_final(st):
+                try:
+                    ev = await asyncio.wait_for(events.get(), timeout=SSE_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if ev.get("status") in TERMINAL_STATUSES:
+                    # One DB read for the final result
+                    st = jq.status(job_id)
+                    yield _sse("status", st)
+                else:
+                    yield _sse(ev.get("event", "status"), ev)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 @app.post("/cancel_job/{job_id}")
 async def cancel_job(job_id: str):
     ok = jq.cancel(job_id)
@@ -1,13 +1,15 @@
 import os
 import sys
 import time
+import re
 import json
 import logging
+import threading
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
-from .job_queue import JobQueue
-from .utils import set_offline_env_defaults, write_json, ensure_dir, run_cmd_with_timeout
+from .job_queue import JobQueue, JobCancelled, JobControl
+from .utils import set_offline_env_defaults, write_json, ensure_dir, run_cmd_with_timeout, worker_id, DEEPSEEK67_MODEL
 
 set_offline_env_defaults()
 
@@ -18,17 +20,118 @@ logger = logging.getLogger("deepseek67")
 BASE_DIR = Path(__file__).resolve().parent.parent
 OUT_DIR = BASE_DIR / "outputs" / "text"
 
-MODEL = os.environ.get("DEEPSEEK67_MODEL", str((BASE_DIR / "models" / "deepseek-67b.gguf").resolve()))
+MODEL = DEEPSEEK67_MODEL
 NGL = int(os.environ.get("LLM67_NGL", "35"))
 CTX = int(os.environ.get("LLM67_CTX", "4096"))
 THREADS = int(os.environ.get("LLM67_THREADS", "8"))
+IDLE_UNLOAD_S = float(os.environ.get("LLM67_IDLE_UNLOAD", "900"))  # 0 keeps the model forever
+MLOCK = os.environ.get("LLM67_MLOCK", "0") == "1"
+PRELOAD = os.environ.get("LLM67_PRELOAD", "0") == "1"
 
 LLAMA_CPP_MAIN = str((BASE_DIR / "llama.cpp" / "bin" / "main").resolve())
 
+JOB_TYPES = ["generate_text_heavy"]
 
-def process_job(jid: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+try:
+    from llama_cpp import Llama  # type: ignore
+except Exception:
+    Llama = None
+
+# llama.cpp prints e.g. "llama_print_timings:        load time =  1234.56 ms"
+_LOAD_TIME_RE = re.compile(r"load time\s*=\s*([\d.]+)\s*ms")
+_TOTAL_TIME_RE = re.compile(r"total time\s*=\s*([\d.]+)\s*ms")
+
+
+class ResidentModel:
+    """Keeps one llama-cpp-python model loaded across jobs.
+    Loaded lazily on first use with memory-mapped weights (optionally mlock'ed),
+    released by unload_if_idle() once unused for `idle_unload_s` seconds.
+    """
+    def __init__(self, model_path: str, idle_unload_s: float = IDLE_UNLOAD_S):
+        self.model_path = model_path
+        self.idle_unload_s = idle_unload_s
+        self._llm = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._llm is not None
+
+    def get(self) -> Tuple[Any, float]:
+        """Return (model, seconds spent loading it for this call)."""
+        with self._lock:
+            load_s = 0.0
+            if self._llm is None:
+                t0 = time.perf_counter()
+                self._llm = Llama(
+                    model_path=self.model_path,
+                    n_ctx=CTX,
+                    n_threads=THREADS,
+                    n_gpu_layers=NGL,
+                    use_mmap=True,
+                    use_mlock=MLOCK,
+                    verbose=False,
+                )
+                load_s = time.perf_counter() - t0
+                logger.info(f"Loaded {self.model_path} in {load_s:.1f}s")
+            self._last_used = time.monotonic()
+            return self._llm, load_s
+
+    def unload(self) -> None:
+        with self._lock:
+            self._llm = None
+
+    def unload_if_idle(self) -> bool:
+        if self._llm is None or self.idle_unload_s <= 0:
+            return False
+        if time.monotonic() - self._last_used < self.idle_unload_s:
+            return False
+        self.unload()
+        logger.info(f"Unloaded {self.model_path} after {self.idle_unload_s:.0f}s idle")
+        return True
+
+
+RESIDENT = ResidentModel(MODEL)
+
+
+def _metrics(load_s: Optional[float], gen_s: Optional[float], source: str) -> Dict[str, Any]:
+    return {
+        "source": source,
+        "load_s": round(load_s, 3) if load_s is not None else None,
+        "gen_s": round(gen_s, 3) if gen_s is not None else None,
+    }
+
+
+def process_job(jid: str, payload: Dict[str, Any], ctl: Optional[JobControl] = None) -> Dict[str, Any]:
+    """Run one heavy text job. With `ctl`, progress is reported per token and
+    a cancel stops generation (or kills the llama.cpp child) by raising
+    JobCancelled."""
     prompt = payload.get("prompt", "")
-    # Prefer llama.cpp CLI if exists
+    max_tokens = payload.get("max_tokens", 256)
+    seed = payload.get("seed")
+    # Prefer the resident in-process model: the weights stay loaded between jobs
+    if Llama is not None and Path(MODEL).exists():
+        try:
+            llm, load_s = RESIDENT.get()
+            t0 = time.perf_counter()
+            parts = []
+            kwargs = {"seed": seed} if seed is not None else {}
+            for n, chunk in enumerate(llm(prompt, max_tokens=max_tokens, stream=True, **kwargs), 1):
+                parts.append(chunk.get("choices", [{}])[0].get("text", ""))
+                if ctl is not None:
+                    ctl.report(n, max_tokens, phase="generate")
+            gen_s = time.perf_counter() - t0
+            text = "".join(parts)
+            metrics = _metrics(load_s, gen_s, "resident")
+            logger.info(f"job {jid} metrics={metrics}")
+            return {"text": text, "metrics": metrics}
+        except JobCancelled:
+            raise
+        except Exception as e:
+            logger.warning(f"resident llama-cpp-python failed, fallback to llama.cpp CLI: {e}")
+
+    # llama.cpp CLI reloads the GGUF on every run
     if Path(LLAMA_CPP_MAIN).exists() and Path(MODEL).exists():
         cmd = [
             LLAMA_CPP_MAIN,
@@ -39,47 +142,57 @@ def process_job(jid: str, payload: Dict[str, Any]) -> Dict[str, Any]:
             "-c", str(CTX),
             "-t", str(THREADS),
         ]
-        code, out, err = run_cmd_with_timeout(cmd, timeout=payload.get("timeout", 600), cwd=str(BASE_DIR))
+        if seed is not None:
+            cmd += ["-s", str(seed)]
+        t0 = time.perf_counter()
+        on_spawn = (lambda proc: ctl.on_cancel(proc.kill)) if ctl is not None else None
+        code, out, err = run_cmd_with_timeout(cmd, timeout=payload.get("timeout", 600), cwd=str(BASE_DIR), on_spawn=on_spawn)
+        wall_s = time.perf_counter() - t0
+        if ctl is not None:
+            ctl.check()
         logger.info(f"llama.cpp exited code={code}")
         if code == 0:
-            return {"text": out.strip()}
+            load_m = _LOAD_TIME_RE.search(err or "")
+            total_m = _TOTAL_TIME_RE.search(err or "")
+            load_s = float(load_m.group(1)) / 1000.0 if load_m else None
+            gen_s = (float(total_m.group(1)) / 1000.0 if total_m else wall_s) - (load_s or 0.0)
+            metrics = _metrics(load_s, gen_s, "cli")
+            logger.info(f"job {jid} metrics={metrics}")
+            return {"text": out.strip(), "metrics": metrics}
         else:
-            logger.warning(f"llama.cpp failed, fallback to llama-cpp-python mock: {err}")
-
-    # Fallback: python mock (offline)
-    try:
-        from llama_cpp import Llama
-        if Path(MODEL).exists():
-            llm = Llama(model_path=MODEL, n_ctx=CTX, n_threads=THREADS, n_gpu_layers=NGL)
-            res = llm(prompt, max_tokens=payload.get("max_tokens", 256))
-            text = res.get("choices", [{}])[0].get("text", "") if isinstance(res, dict) else str(res)
-        else:
-            text = f"[MOCK 67B] {prompt[:64]}..."
-    except Exception:
-        text = f"[MOCK 67B] {prompt[:64]}..."
-    return {"text": text}
+            logger.warning(f"llama.cpp failed, fallback to mock: {err}")
+
+    # Fallback: mock (offline)
+    return {"text": f"[MOCK 67B] {prompt[:64]}...", "metrics": _metrics(0.0, 0.0, "mock")}
 
 
 def main_loop():
     jq = JobQueue()
     ensure_dir(OUT_DIR)
-    logger.info("DeepSeek67 worker started (offline)")
+    wid = worker_id("deepseek67")
+    logger.info(f"DeepSeek67 worker started (offline) id={wid}")
+    if PRELOAD and Llama is not None and Path(MODEL).exists():
+        RESIDENT.get()
     while True:
-        item = jq.dequeue()
+        item = jq.dequeue(types=JOB_TYPES, worker_id=wid, block=True, timeout=30)
         if not item:
-            time.sleep(0.2)
+            RESIDENT.unload_if_idle()
             continue
         jid, type_, payload = item
-        if type_ != "generate_text_heavy":
-            jq.set_result(jid, "error", {"error": "invalid_type"})
+        if type_ not in JOB_TYPES:
+            jq.set_result(jid, "error", {"error": "invalid_type"}, wid)
             continue
         try:
-            result = process_job(jid, payload)
+            with jq.control(jid) as ctl:
+                result = process_job(jid, payload, ctl)
             out_path = OUT_DIR / f"{jid}.json"
             write_json(out_path, {"job_id": jid, "result": result})
-            jq.set_result(jid, "done", result)
+            # Placeholder text must not be served from the result cache later
+            jq.set_result(jid, "done", result, wid, cacheable=result["metrics"]["source"] != "mock")
+        except JobCancelled:
+            logger.info(f"job {jid} cancelled")
         except Exception as e:
-            jq.set_result(jid, "error", {"error": str(e)})
+            jq.set_result(jid, "error", {"error": str(e)}, wid)
 
 
 if __name__ == "__main__":
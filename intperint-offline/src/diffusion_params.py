@@ -0,0 +1,62 @@
+"""generate_image parameter handling shared by the API and the diffusion worker.
+
+The API normalizes params and computes the batch key at enqueue time, so this
+module must stay free of torch/diffusers imports.
+"""
+import os
+import random
+from typing import Any, Dict, Optional
+
+MAX_IMAGES_PER_JOB = int(os.environ.get("DIFFUSION_MAX_IMAGES_PER_JOB", "8"))
+DEFAULT_STEPS = 20
+DEFAULT_GUIDANCE = 5.0
+MAX_FRAMES = int(os.environ.get("ANIM_MAX_FRAMES", "32"))
+
+
+def _dim(value: Any) -> Optional[int]:
+    # Latents are 1/8 of the image size, so dimensions must be multiples of 8
+    if value is None:
+        return None
+    return min(2048, max(256, int(value) // 8 * 8))
+
+
+def image_params(params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Normalized generate_image params. Accepts the diffusers names
+    (num_inference_steps, num_images_per_prompt) as aliases. A missing seed
+    is drawn here so the job result can report it. Raises ValueError on
+    non-numeric values."""
+    p = params or {}
+    n = p.get("num_images_per_prompt", p.get("num_images", p.get("batch_size", 1)))
+    seed = p.get("seed")
+    return {
+        "steps": min(150, max(1, int(p.get("steps", p.get("num_inference_steps", DEFAULT_STEPS))))),
+        "width": _dim(p.get("width")),
+        "height": _dim(p.get("height")),
+        "guidance_scale": float(p.get("guidance_scale", DEFAULT_GUIDANCE)),
+        "num_images": min(MAX_IMAGES_PER_JOB, max(1, int(n))),
+        "seed": int(seed) if seed is not None else random.randrange(2 ** 31),
+        "negative_prompt": p.get("negative_prompt") or None,
+    }
+
+
+def image_batch_key(norm: Dict[str, Any], model: str = "sdxl") -> str:
+    """Jobs with equal keys can share one pipeline call: the UNet batch needs a
+    common resolution, step count and (scalar) guidance scale."""
+    return f"{model}:{norm['width']}x{norm['height']}:s{norm['steps']}:g{norm['guidance_scale']:g}"
+
+
+def video_params(params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Normalized generate_video params (AnimateDiff on an SD1.5 base, whose
+    native size is 512x512)."""
+    p = params or {}
+    seed = p.get("seed")
+    return {
+        "num_frames": min(MAX_FRAMES, max(2, int(p.get("num_frames", p.get("frames", 16))))),
+        "fps": min(60, max(1, int(p.get("fps", 8)))),
+        "steps": min(150, max(1, int(p.get("steps", p.get("num_inference_steps", DEFAULT_STEPS))))),
+        "width": _dim(p.get("width")) or 512,
+        "height": _dim(p.get("height")) or 512,
+        "guidance_scale": float(p.get("guidance_scale", 7.5)),
+        "seed": int(seed) if seed is not None else random.randrange(2 ** 31),
+        "negative_prompt": p.get("negative_prompt") or None,
+    }
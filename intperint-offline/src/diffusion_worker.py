@@ -1,12 +1,20 @@
+import gc
 import os
 import sys
 import time
+import shutil
+import tempfile
+import subprocess
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 
-from .job_queue import JobQueue
-from .utils import set_offline_env_defaults, ensure_dir, write_json
+from .diffusion_params import image_params, video_params
+from .job_queue import JobQueue, JobCancelled, JobControl
+from .utils import set_offline_env_defaults, ensure_dir, write_json, worker_id, SDXL_MODEL_DIR
 
 set_offline_env_defaults()
 
@@ -19,8 +27,20 @@ OUT_IMG = BASE_DIR / "outputs" / "image"
 OUT_VID = BASE_DIR / "outputs" / "video"
 UPLOADS = BASE_DIR / "uploads"
 
-SDXL_DIR = os.environ.get("SDXL_MODEL_DIR", str((BASE_DIR / "models" / "sdxl").resolve()))
+SDXL_DIR = SDXL_MODEL_DIR
 ANIM_MOTION = os.environ.get("ANIM_MOTION", str((BASE_DIR / "models" / "animatediff_motion").resolve()))
+# AnimateDiff motion adapters are trained against SD1.5, not SDXL
+ANIM_BASE_DIR = os.environ.get("ANIM_BASE_DIR", str((BASE_DIR / "models" / "sd15").resolve()))
+FFMPEG_BIN = os.environ.get("FFMPEG_BIN", "ffmpeg")
+
+JOB_TYPES = ["generate_image", "generate_video"]
+
+PIPE_CACHE_SIZE = int(os.environ.get("DIFFUSION_PIPE_CACHE", "1"))  # image pipelines kept loaded
+VIDEO_PIPE_CACHE_SIZE = int(os.environ.get("DIFFUSION_VIDEO_PIPE_CACHE", "1"))  # AnimateDiff pipelines kept loaded
+SCHEDULER = os.environ.get("DIFFUSION_SCHEDULER") or None  # diffusers scheduler class name
+WARMUP = os.environ.get("DIFFUSION_WARMUP", "0") == "1"
+BATCH_JOBS = int(os.environ.get("DIFFUSION_BATCH_JOBS", "4"))  # compatible image jobs claimed together
+MAX_BATCH_IMAGES = int(os.environ.get("DIFFUSION_MAX_BATCH", "4"))  # images per UNet batch
 
 # Torch will be provided via wheels offline. Use MPS if available.
 
@@ -31,75 +51,381 @@ except Exception:
     torch = None
     DiffusionPipeline = None
 
+try:
+    from diffusers import AnimateDiffPipeline, MotionAdapter  # type: ignore
+except Exception:
+    AnimateDiffPipeline = None
+    MotionAdapter = None
+
+
+class PipelineCache:
+    """Process-wide LRU of loaded pipelines keyed by (model dir, dtype, device, scheduler, motion adapter).
+    Keeps at most `max_size` pipelines; the least recently used one is dropped,
+    and device memory released, before the next one is loaded.
+    """
+    def __init__(self, max_size: int = PIPE_CACHE_SIZE):
+        self.max_size = max(1, max_size)
+        self._pipes: "OrderedDict[Tuple[str, str, str, str, str], Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_dir: str, dtype: Any, device: Any, scheduler: Optional[str] = None,
+            motion_adapter: Optional[str] = None) -> Any:
+        key = (str(model_dir), str(dtype), str(device), scheduler or "", motion_adapter or "")
+        with self._lock:
+            pipe = self._pipes.get(key)
+            if pipe is not None:
+                self._pipes.move_to_end(key)
+                return pipe
+            # Evict before loading so two models never sit in memory together
+            evicted = False
+            while len(self._pipes) >= self.max_size:
+                old_key, old_pipe = self._pipes.popitem(last=False)
+                del old_pipe
+                logger.info(f"Evicted pipeline {old_key}")
+                evicted = True
+            if evicted:
+                _release_device_memory()
+            t0 = time.perf_counter()
+            pipe = _load_pipeline(model_dir, dtype, device, scheduler, motion_adapter)
+            logger.info(f"Loaded pipeline {key} in {time.perf_counter() - t0:.1f}s")
+            self._pipes[key] = pipe
+            return pipe
+
+    def __len__(self) -> int:
+        return len(self._pipes)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pipes.clear()
+        _release_device_memory()
+
+
+def _load_pipeline(model_dir: str, dtype: Any, device: Any, scheduler: Optional[str],
+                   motion_adapter: Optional[str] = None) -> Any:
+    if motion_adapter:
+        adapter = MotionAdapter.from_pretrained(motion_adapter, torch_dtype=dtype, local_files_only=True)
+        pipe = AnimateDiffPipeline.from_pretrained(
+            model_dir,
+            motion_adapter=adapter,
+            torch_dtype=dtype,
+            local_files_only=True,
+        )
+    else:
+        pipe = DiffusionPipeline.from_pretrained(
+            model_dir,
+            torch_dtype=dtype,
+            use_safetensors=True,
+            local_files_only=True,
+        )
+    if scheduler:
+        import diffusers  # type: ignore
+        pipe.scheduler = getattr(diffusers, scheduler).from_config(pipe.scheduler.config)
+    return pipe.to(device)
 
-def txt2img(prompt: str, out_dir: Path, steps: int = 20, seed: int = 42) -> List[str]:
-    out_dir = ensure_dir(out_dir)
-    if torch is None or DiffusionPipeline is None or not Path(SDXL_DIR).exists():
-        # Mock mode: generate empty placeholder files
-        paths = []
-        for i in range(1):
-            p = out_dir / f"mock_{int(time.time())}.png"
-            with open(p, "wb") as f:
-                f.write(b"PNG\n")
-            paths.append(str(p))
-        return paths
 
+def _release_device_memory() -> None:
+    gc.collect()
+    if torch is not None and hasattr(torch, "mps") and torch.backends.mps.is_available():
+        torch.mps.empty_cache()
+
+
+PIPELINES = PipelineCache()
+# Video has its own cache so alternating image and video jobs don't keep
+# evicting each other's model
+VIDEO_PIPELINES = PipelineCache(VIDEO_PIPE_CACHE_SIZE)
+
+
+def _device_and_dtype() -> Tuple[Any, Any]:
     torch.backends.mps.allow_tf32 = True if hasattr(torch.backends, "mps") else False
     device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
+    return device, torch.float16 if device.type == "mps" else torch.float32
+
+
+def warmup() -> None:
+    """Load the SDXL pipeline and run one step so the first real job only pays for denoising."""
+    if torch is None or DiffusionPipeline is None or not Path(SDXL_DIR).exists():
+        return
+    device, dtype = _device_and_dtype()
+    t0 = time.perf_counter()
+    pipe = PIPELINES.get(SDXL_DIR, dtype, device, SCHEDULER)
+    pipe("warmup", num_inference_steps=1, output_type="latent")
+    logger.info(f"Warm-up done in {time.perf_counter() - t0:.1f}s")
+
+
+def _have_model() -> bool:
+    return torch is not None and DiffusionPipeline is not None and Path(SDXL_DIR).exists()
+
+
+def _generator(device: Any, seed: int) -> Any:
+    return torch.Generator(device=device).manual_seed(seed)
+
+
+def _step_callback(controls: List[Optional[JobControl]], total: int, offset: int = 0, phase: str = "denoise"):
+    """diffusers callback_on_step_end reporting step progress to every job in
+    the batch. Cancelled jobs just stop reporting; the pipeline is aborted
+    (JobCancelled) only once every job sharing it was cancelled."""
+    def callback(pipe, step, timestep, callback_kwargs):
+        for ctl in controls:
+            if ctl is not None and not ctl.cancelled:
+                try:
+                    ctl.report(offset + step + 1, total, phase=phase)
+                except JobCancelled:
+                    pass
+        if controls and all(ctl is not None and ctl.cancelled for ctl in controls):
+            raise JobCancelled(",".join(ctl.job_id for ctl in controls))
+        return callback_kwargs
+    return callback
 
-    pipe = DiffusionPipeline.from_pretrained(
-        SDXL_DIR,
-        torch_dtype=torch.float16 if device.type == "mps" else torch.float32,
-        use_safetensors=True,
-        local_files_only=True,
-    )
-    pipe = pipe.to(device)
-    image = pipe(prompt, num_inference_steps=steps, generator=torch.Generator(device=device).manual_seed(seed)).images[0]
-    out_path = out_dir / f"sdxl_{int(time.time())}.png"
-    image.save(out_path)
-    return [str(out_path)]
 
+def txt2img(prompt: str, out_dir: Path, steps: int = 20, seed: int = 42, **params: Any) -> List[str]:
+    norm = image_params({"steps": steps, "seed": seed, **params})
+    return txt2img_batch([(prompt, norm, out_dir)])[0]
 
-def generate_video_frames(prompt: str, out_frames_dir: Path, num_frames: int = 8) -> List[str]:
+
+def txt2img_batch(
+    jobs: List[Tuple[str, Dict[str, Any], Path]],
+    controls: Optional[List[Optional[JobControl]]] = None,
+) -> List[List[str]]:
+    """Generate images for several jobs that share resolution, steps and
+    guidance (see diffusion_params.image_batch_key). Each job contributes
+    num_images images; image k of a job uses seed + k, so results match
+    what the job would get on its own. Images are flattened across jobs and
+    run through the pipeline MAX_BATCH_IMAGES at a time. `controls` (one
+    per job) receive per-step progress and can cancel; see _step_callback.
+    Returns the image paths per job."""
+    controls = controls or [None] * len(jobs)
+    if not _have_model():
+        # Mock mode: generate empty placeholder files
+        results = []
+        for prompt, norm, out_dir in jobs:
+            out_dir = ensure_dir(out_dir)
+            paths = []
+            for k in range(norm["num_images"]):
+                p = out_dir / f"mock_{int(time.time())}_{k}.png"
+                with open(p, "wb") as f:
+                    f.write(b"PNG\n")
+                paths.append(str(p))
+            results.append(paths)
+        return results
+
+    first = jobs[0][1]
+    device, dtype = _device_and_dtype()
+    pipe = PIPELINES.get(SDXL_DIR, dtype, device, SCHEDULER)
+    # One entry per output image: (job index, image index within job)
+    flat = [(j, k) for j, (_, norm, _) in enumerate(jobs) for k in range(norm["num_images"])]
+    results: List[List[str]] = [[] for _ in jobs]
+    size = {k: first[k] for k in ("width", "height") if first[k]}
+    any_negative = any(norm["negative_prompt"] for _, norm, _ in jobs)
+    chunk_size = max(1, MAX_BATCH_IMAGES)
+    n_chunks = -(-len(flat) // chunk_size)
+    for c, start in enumerate(range(0, len(flat), chunk_size)):
+        chunk = flat[start:start + chunk_size]
+        kwargs: Dict[str, Any] = {}
+        if any_negative:
+            kwargs["negative_prompt"] = [jobs[j][1]["negative_prompt"] or "" for j, _ in chunk]
+        t0 = time.perf_counter()
+        images = pipe(
+            prompt=[jobs[j][0] for j, _ in chunk],
+            num_inference_steps=first["steps"],
+            guidance_scale=first["guidance_scale"],
+            generator=[_generator(device, jobs[j][1]["seed"] + k) for j, k in chunk],
+            callback_on_step_end=_step_callback(controls, first["steps"] * n_chunks, offset=c * first["steps"]),
+            **size,
+            **kwargs,
+        ).images
+        logger.info(f"txt2img batch of {len(chunk)} images in {time.perf_counter() - t0:.1f}s")
+        for (j, k), image in zip(chunk, images):
+            out_dir = ensure_dir(jobs[j][2])
+            out_path = out_dir / f"sdxl_{k:02d}.png"
+            image.save(out_path)
+            results[j].append(str(out_path))
+    return results
+
+
+class FrameEncoder:
+    """ffmpeg child encoding raw RGB24 frames written to its stdin into an
+    H.264 mp4, so frames never touch disk as images. ffmpeg's stderr goes
+    to a log file next to the output rather than a pipe that could fill up.
+    """
+
+    def __init__(self, out_path: Path, width: int, height: int, fps: int):
+        self.out_path = Path(out_path)
+        self.frame_bytes = width * height * 3
+        self.frames = 0
+        cmd = [
+            FFMPEG_BIN, "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+            "-c:v", "libx264", "-pix_fmt", "yuv420p", "-movflags", "+faststart", str(self.out_path),
+        ]
+        self._log = open(self.out_path.with_suffix(".ffmpeg.log"), "wb")
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._log)
+
+    def write(self, frame: bytes) -> None:
+        if len(frame) != self.frame_bytes:
+            raise ValueError(f"frame is {len(frame)} bytes, expected {self.frame_bytes}")
+        self._proc.stdin.write(frame)
+        self.frames += 1
+
+    def close(self, timeout: float = 300) -> None:
+        try:
+            self._proc.stdin.close()
+            rc = self._proc.wait(timeout=timeout)
+        except BaseException:
+            # Broken pipe or timeout: don't leave ffmpeg running
+            self._proc.kill()
+            self._proc.wait()
+            raise
+        finally:
+            self._log.close()
+        if rc != 0:
+            log = self.out_path.with_suffix(".ffmpeg.log").read_text(errors="replace")[-500:]
+            raise RuntimeError(f"ffmpeg exited with {rc}: {log}")
+
+    def abort(self) -> None:
+        self._proc.kill()
+        self._proc.wait()
+        self._log.close()
+
+    def __enter__(self) -> "FrameEncoder":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _have_video_model() -> bool:
+    return (torch is not None and AnimateDiffPipeline is not None
+            and Path(ANIM_BASE_DIR).exists() and Path(ANIM_MOTION).exists())
+
+
+def txt2video(prompt: str, out_path: Path, params: Optional[Dict[str, Any]] = None,
+              ctl: Optional[JobControl] = None) -> Dict[str, Any]:
+    """Generate all frames in one AnimateDiff call and stream them into ffmpeg.
+    Work happens in a private temp dir beside `out_path`; the mp4 is moved
+    into place only once encoding succeeded. `ctl` gets progress per
+    denoising step, then per encoded frame."""
+    norm = video_params(params)
+    device, dtype = _device_and_dtype()
+    pipe = VIDEO_PIPELINES.get(ANIM_BASE_DIR, dtype, device, SCHEDULER, motion_adapter=ANIM_MOTION)
+    kwargs = {"negative_prompt": norm["negative_prompt"]} if norm["negative_prompt"] else {}
+    t0 = time.perf_counter()
+    # output_type="np": (batch, frames, H, W, 3) floats in [0, 1]
+    frames = pipe(
+        prompt=prompt,
+        num_frames=norm["num_frames"],
+        num_inference_steps=norm["steps"],
+        guidance_scale=norm["guidance_scale"],
+        width=norm["width"],
+        height=norm["height"],
+        generator=_generator(device, norm["seed"]),
+        output_type="np",
+        callback_on_step_end=_step_callback([ctl], norm["steps"]) if ctl is not None else None,
+        **kwargs,
+    ).frames[0]
+    gen_s = time.perf_counter() - t0
+    out_path = Path(out_path)
+    work = Path(tempfile.mkdtemp(prefix=f".{out_path.stem}-", dir=ensure_dir(out_path.parent)))
+    try:
+        h, w = frames.shape[1], frames.shape[2]
+        with FrameEncoder(work / "video.mp4", w, h, norm["fps"]) as enc:
+            for i, frame in enumerate(frames):
+                enc.write((frame * 255).round().clip(0, 255).astype("uint8").tobytes())
+                if ctl is not None:
+                    ctl.report(i + 1, len(frames), phase="encode")
+        os.replace(work / "video.mp4", out_path)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    logger.info(f"txt2video {norm['num_frames']} frames: generate {gen_s:.1f}s, encode {time.perf_counter() - t0 - gen_s:.1f}s")
+    return {"video": str(out_path), "frames": norm["num_frames"], "fps": norm["fps"], "seed": norm["seed"], "params": norm}
+
+
+def generate_video_frames(prompt: str, out_frames_dir: Path, num_frames: int = 8,
+                          ctl: Optional[JobControl] = None) -> List[str]:
+    """Mock mode for video jobs: placeholder frame files only."""
     out_frames_dir = ensure_dir(out_frames_dir)
     paths = []
-    # If motion adapter exists, in real use you'd integrate AnimatedDiff here.
-    # Offline fallback: generate a sequence of placeholder frames.
     for i in range(num_frames):
         p = out_frames_dir / f"frame_{i:04d}.png"
         with open(p, "wb") as f:
             f.write(b"PNG\n")
         paths.append(str(p))
+        if ctl is not None:
+            ctl.report(i + 1, num_frames, phase="frames")
     return paths
 
 
 def main_loop():
     jq = JobQueue()
-    logger.info("Diffusion worker started (offline)")
+    wid = worker_id("diffusion")
+    logger.info(f"Diffusion worker started (offline) id={wid}")
+    if WARMUP:
+        try:
+            warmup()
+        except Exception as e:
+            logger.warning(f"warm-up failed: {e}")
     while True:
-        job = jq.dequeue()
-        if not job:
-            time.sleep(0.2)
+        # Only images batch; a video job is claimed alone so no claimed job
+        # waits without a JobControl renewing its lease
+        jobs = jq.dequeue_batch(types=JOB_TYPES, max_items=BATCH_JOBS, worker_id=wid, block=True, timeout=30,
+                                batch_types=["generate_image"])
+        if not jobs:
             continue
-        jid, type_, payload = job
+        if jobs[0][1] == "generate_image":
+            _run_image_jobs(jq, jobs, wid)
+            continue
+        for jid, type_, payload in jobs:
+            try:
+                if type_ == "generate_video" and _have_video_model():
+                    out_path = ensure_dir(OUT_VID) / f"{jid}.mp4"
+                    with jq.control(jid) as ctl:
+                        res = txt2video(payload.get("prompt", ""), out_path, payload.get("params"), ctl)
+                    jq.set_result(jid, "done", res, wid)
+                elif type_ == "generate_video":
+                    prompt = payload.get("prompt", "")
+                    frames_dir = OUT_VID / jid / "frames"
+                    with jq.control(jid) as ctl:
+                        frames = generate_video_frames(prompt, frames_dir, ctl=ctl)
+                    # ffmpeg example (offline, optional):
+                    ffmpeg_cmd = f"ffmpeg -framerate 8 -i {frames_dir}/frame_%04d.png -c:v libx264 -pix_fmt yuv420p {OUT_VID / (jid + '.mp4')}"
+                    jq.set_result(jid, "done", {"frames": frames, "ffmpeg_example": ffmpeg_cmd}, wid)
+                else:
+                    jq.set_result(jid, "error", {"error": "invalid_type"}, wid)
+            except JobCancelled:
+                logger.info(f"job {jid} cancelled")
+            except Exception as e:
+                jq.set_result(jid, "error", {"error": str(e)}, wid)
+
+
+def _run_image_jobs(jq: JobQueue, jobs: List[Tuple[str, str, Dict[str, Any]]], wid: Optional[str] = None) -> None:
+    """Run claimed generate_image jobs (same batch key) as one batched call."""
+    batch = []
+    for jid, _, payload in jobs:
         try:
-            if type_ == "generate_image":
-                prompt = payload.get("prompt", "")
-                out_dir = OUT_IMG / jid
-                paths = txt2img(prompt, out_dir)
-                jq.set_result(jid, "done", {"images": paths})
-            elif type_ == "generate_video":
-                prompt = payload.get("prompt", "")
-                frames_dir = OUT_VID / jid / "frames"
-                frames = generate_video_frames(prompt, frames_dir)
-                # ffmpeg example (offline, optional):
-                ffmpeg_cmd = f"ffmpeg -framerate 8 -i {frames_dir}/frame_%04d.png -c:v libx264 -pix_fmt yuv420p {OUT_VID / (jid + '.mp4')}"
-                jq.set_result(jid, "done", {"frames": frames, "ffmpeg_example": ffmpeg_cmd})
-            else:
-                jq.set_result(jid, "error", {"error": "invalid_type"})
+            norm = image_params(payload.get("params"))
+        except (TypeError, ValueError) as e:
+            jq.set_result(jid, "error", {"error": f"invalid params: {e}"}, wid)
+            continue
+        batch.append((jid, payload.get("prompt", ""), norm))
+    if not batch:
+        return
+    mock = not _have_model()  # placeholder images are never result-cached
+    with ExitStack() as stack:
+        controls = [stack.enter_context(jq.control(jid)) for jid, _, _ in batch]
+        try:
+            results = txt2img_batch([(prompt, norm, OUT_IMG / jid) for jid, prompt, norm in batch], controls)
+        except JobCancelled:
+            logger.info(f"image batch cancelled: {[jid for jid, _, _ in batch]}")
+            return
         except Exception as e:
-            jq.set_result(jid, "error", {"error": str(e)})
-
+            for jid, _, _ in batch:
+                jq.set_result(jid, "error", {"error": str(e)}, wid)
+            return
+    # set_result leaves jobs cancelled mid-batch untouched
+    for (jid, _, norm), paths in zip(batch, results):
+        jq.set_result(jid, "done", {"images": paths, "seed": norm["seed"], "params": norm}, wid, cacheable=not mock)
 
 if __name__ == "__main__":
     main_loop()
@@ -1,31 +1,254 @@
 from __future__ import annotations
+import hashlib
 import os
+import queue
+import re
 import sqlite3
 import json
+import logging
+import threading
 import time
 import uuid
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import notify
+
+logger = logging.getLogger("jobq")
 
 BASE_DIR = Path(__file__).resolve().parent.parent
-DB_PATH = BASE_DIR / "job_queue.sqlite3"
+DB_PATH = Path(os.environ.get("JOBQ_DB", str(BASE_DIR / "job_queue.sqlite3")))
+POOL_SIZE = int(os.environ.get("JOBQ_POOL_SIZE", "4"))
+BUSY_TIMEOUT_MS = int(os.environ.get("JOBQ_BUSY_TIMEOUT_MS", "5000"))
+# Blocking dequeue re-checks the DB at least this often in case a wakeup is lost
+POLL_INTERVAL = float(os.environ.get("JOBQ_POLL_INTERVAL", "5.0"))
+# Queued jobs gain one priority level per AGING_S seconds of waiting (0 = no aging)
+AGING_S = float(os.environ.get("JOBQ_AGING_S", "60"))
+# Concurrency caps enforced at claim time, e.g. "generate_video=1,generate_text_heavy=1"
+MAX_RUNNING = os.environ.get("JOBQ_MAX_RUNNING", "")
+# Cap on running jobs of GPU_TYPES together (helper's concurrency.max_gpu_jobs); 0 = none
+MAX_GPU_JOBS = int(os.environ.get("JOBQ_MAX_GPU_JOBS", "0"))
+GPU_TYPES = ("generate_image", "generate_video", "generate_text_heavy", "analyze_image")
+PRIORITY_CLASSES = {"low": 0, "normal": 5, "high": 10}
+DEFAULT_PRIORITY = PRIORITY_CLASSES["normal"]
+TERMINAL = ("done", "error", "cancelled")
+# Claims hold a lease that JobControl renews every LEASE_S/3; expired leases are requeued
+LEASE_S = float(os.environ.get("JOBQ_LEASE_S", "60"))
+MAX_ATTEMPTS = int(os.environ.get("JOBQ_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF_S = float(os.environ.get("JOBQ_RETRY_BACKOFF_S", "10"))
+RETRY_BACKOFF_MAX_S = float(os.environ.get("JOBQ_RETRY_BACKOFF_MAX_S", "600"))
+REAP_INTERVAL = float(os.environ.get("JOBQ_REAP_INTERVAL", "5"))
+# Finished jobs older than this move to jobs_archive on compact()
+RETAIN_S = float(os.environ.get("JOBQ_RETAIN_S", str(7 * 86400)))
+# Completed deterministic jobs served again to identical submissions (see submit())
+RESULT_CACHE_TTL_S = float(os.environ.get("JOBQ_RESULT_CACHE_TTL_S", "86400"))
+RESULT_CACHE_MAX = int(os.environ.get("JOBQ_RESULT_CACHE_MAX", "10000"))
+# Minimum spacing of progress writes per job; the final step is always written
+PROGRESS_INTERVAL = float(os.environ.get("JOBQ_PROGRESS_INTERVAL", "0.5"))
+
+# Fixed SQL strings hit sqlite3's per-connection prepared statement cache.
+SQL_INSERT = (
+    "INSERT INTO jobs(id, type, payload, status, result, created, updated, cancelled, batch_key, priority,"
+    " dedupe_key, cacheable) VALUES(?,?,?,?,?,?,?,0,?,?,?,?)"
+)
+SQL_INFLIGHT = "SELECT id FROM jobs WHERE dedupe_key=? AND status IN ('queued','running') LIMIT 1"
+SQL_CACHED = (
+    "SELECT id, result FROM jobs WHERE dedupe_key=? AND status='done' AND cacheable=1 AND updated>?"
+    " ORDER BY updated DESC LIMIT 1"
+)
+SQL_BUMP_PRIORITY = "UPDATE jobs SET priority=MAX(priority, ?) WHERE id=? AND status='queued'"
+SQL_CLAIM = (
+    "UPDATE jobs SET status='running', updated=?, worker_id=?, lease_until=?, attempts=attempts+1,"
+    " progress=NULL WHERE rowid=?"
+)
+SQL_HEARTBEAT = "UPDATE jobs SET lease_until=? WHERE id=? AND status='running'"
+# Leases are checked against lease_until via idx_status_lease
+SQL_EXPIRED = "SELECT id, attempts FROM jobs WHERE status='running' AND lease_until<?"
+SQL_REQUEUE = "UPDATE jobs SET status='queued', worker_id=NULL, not_before=?, updated=? WHERE id=? AND status='running'"
+SQL_EXHAUSTED = "UPDATE jobs SET status='error', result=?, updated=? WHERE id=? AND status='running'"
+SQL_CLAIMED = "SELECT id, type, payload FROM jobs WHERE rowid=?"
+SQL_BATCH_PEERS = (
+    "SELECT rowid FROM jobs WHERE status='queued' AND not_before<=? AND type=? AND batch_key=? AND rowid<>?"
+    " ORDER BY priority DESC, created ASC LIMIT ?"
+)
+SQL_RUNNING_BY_TYPE = "SELECT type, COUNT(*) FROM jobs WHERE status='running' GROUP BY type"
+# A cancelled job keeps its status even if the worker finishes it anyway, and
+# a worker whose lease was reaped can't overwrite the result of a later attempt
+SQL_SET_RESULT = (
+    "UPDATE jobs SET status=?, result=?, updated=?, cacheable=cacheable AND ?"
+    " WHERE id=? AND cancelled=0 AND status='running' AND worker_id IS ?"
+)
+SQL_SET_PROGRESS = "UPDATE jobs SET progress=?, updated=?, lease_until=? WHERE id=? AND status='running'"
+SQL_IS_CANCELLED = "SELECT cancelled FROM jobs WHERE id=?"
+STATUS_COLUMNS = "id, type, status, result, created, updated, cancelled, worker_id, progress, priority, attempts"
+SQL_STATUS = f"SELECT {STATUS_COLUMNS} FROM jobs WHERE id=?"
+SQL_STATUS_ARCHIVE = f"SELECT {STATUS_COLUMNS} FROM jobs_archive WHERE id=?"
+SQL_CANCEL = "UPDATE jobs SET cancelled=1, status='cancelled', updated=? WHERE id=? AND status IN ('queued','running')"
+
+
+def parse_priority(value: Any) -> int:
+    """Priority from a class name (low/normal/high) or an int 0..10; higher runs first."""
+    if value is None:
+        return DEFAULT_PRIORITY
+    if isinstance(value, str) and value in PRIORITY_CLASSES:
+        return PRIORITY_CLASSES[value]
+    if isinstance(value, bool):
+        raise ValueError(f"invalid priority: {value!r}")
+    try:
+        prio = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid priority: {value!r}") from None
+    if not 0 <= prio <= 10:
+        raise ValueError(f"priority out of range 0..10: {prio}")
+    return prio
+
+
+def canonical_key(type_: str, obj: Any) -> str:
+    """sha256 of the job type plus `obj` as canonical JSON (sorted keys, no
+    whitespace), so equal requests hash equal regardless of key order."""
+    blob = json.dumps([type_, obj], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _output_files(result: Any) -> List[str]:
+    """Paths a job result points at (images, video, frames)."""
+    if not isinstance(result, dict):
+        return []
+    files = []
+    for key in ("images", "frames"):
+        files.extend(p for p in result.get(key) or [] if isinstance(p, str))
+    if isinstance(result.get("video"), str):
+        files.append(result["video"])
+    return files
+
+
+def parse_caps(spec: str, max_gpu_jobs: int = 0) -> List[Tuple[frozenset, int]]:
+    """Concurrency caps as (types, limit) groups from a "type=N,type=N" spec
+    plus the shared GPU cap."""
+    caps = []
+    for part in spec.split(","):
+        if part.strip():
+            type_, _, n = part.partition("=")
+            caps.append((frozenset([type_.strip()]), int(n)))
+    if max_gpu_jobs > 0:
+        caps.append((frozenset(GPU_TYPES), max_gpu_jobs))
+    return caps
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker when the job it is running was cancelled."""
+
+
+class ConnectionPool:
+    """Thread-safe pool of long-lived SQLite connections.
+    Connections run in autocommit mode with WAL journaling, synchronous=NORMAL
+    and a busy timeout; multi-statement writes use explicit BEGIN IMMEDIATE.
+    """
+    def __init__(self, db_path: Path, size: int = POOL_SIZE, busy_timeout_ms: int = BUSY_TIMEOUT_MS):
+        self.db_path = Path(db_path)
+        self.size = max(1, size)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._all: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000.0,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=64,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = self._open()
+                self._all.append(conn)
+                return conn
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+        self._idle = queue.LifoQueue()
+
 
 class JobQueue:
-    """SQLite FIFO job queue (offline friendly).
+    """SQLite priority job queue (offline friendly).
     Schema:
-      jobs(id TEXT PRIMARY KEY, type TEXT, payload TEXT, status TEXT, result TEXT, created REAL, updated REAL, cancelled INTEGER)
+      jobs(id TEXT PRIMARY KEY, type TEXT, payload TEXT, status TEXT, result TEXT, created REAL, updated REAL, cancelled INTEGER, worker_id TEXT, batch_key TEXT, progress TEXT, priority INTEGER,
+           lease_until REAL, attempts INTEGER, not_before REAL, dedupe_key TEXT, cacheable INTEGER)
+      jobs_archive: same columns, finished jobs moved out by compact()
     Status: queued|running|done|error|cancelled
+    Claims are atomic (BEGIN IMMEDIATE), so several workers may share one queue.
+    Connections are pooled per instance; see ConnectionPool.
+    enqueue/set_result/cancel publish wakeups on a UNIX-socket channel (see notify),
+    which blocking dequeue() calls wait on instead of sleep-polling.
+    Jobs enqueued with the same batch_key may be claimed together by dequeue_batch().
+    Running jobs report progress and notice cancellation through control().
+    Claim order is highest effective priority first (priority plus one level
+    per `aging_s` seconds queued, so low priority work cannot starve), then
+    FIFO. Types whose concurrency cap (`caps`) is reached are skipped.
+    A claim holds a lease of LEASE_S (renewed by JobControl). When a worker
+    dies its lease runs out and the job is requeued with exponential backoff,
+    or fails after MAX_ATTEMPTS claims.
+    submit() deduplicates identical requests against in-flight and cached jobs.
     """
-    def __init__(self, db_path: Path = DB_PATH):
+    def __init__(
+        self,
+        db_path: Path = DB_PATH,
+        pool_size: int = POOL_SIZE,
+        caps: Optional[List[Tuple[frozenset, int]]] = None,
+        aging_s: float = AGING_S,
+    ):
         self.db_path = Path(db_path)
+        self.caps = parse_caps(MAX_RUNNING, MAX_GPU_JOBS) if caps is None else caps
+        self.aging_s = aging_s
+        # priority + (now - created) / aging_s ranks the same as
+        # priority * aging_s - created, which has no `now` and can be indexed.
+        # The literal must match the index expression for SQLite to use it.
+        if aging_s > 0:
+            self._rank_expr = f"priority * {float(aging_s)!r} - created"
+            self._rank_sql = f"{self._rank_expr} DESC"
+        else:
+            self._rank_expr = None
+            self._rank_sql = "priority DESC, created ASC"
+        self.channel = notify.channel_dir(self.db_path)
+        self._pool = ConnectionPool(self.db_path, size=pool_size)
+        self._last_reap = 0.0
         self._init_db()
 
     def _conn(self):
-        return sqlite3.connect(self.db_path)
+        return self._pool.connection()
+
+    def close(self) -> None:
+        self._pool.close()
 
     def _init_db(self):
-        conn = self._conn()
-        try:
+        with self._conn() as conn:
             cur = conn.cursor()
             cur.execute(
                 """
@@ -37,63 +260,361 @@ class JobQueue:
                     result TEXT,
                     created REAL,
                     updated REAL,
-                    cancelled INTEGER DEFAULT 0
+                    cancelled INTEGER DEFAULT 0,
+                    worker_id TEXT,
+                    batch_key TEXT,
+                    progress TEXT,
+                    priority INTEGER DEFAULT 5,
+                    lease_until REAL,
+                    attempts INTEGER DEFAULT 0,
+                    not_before REAL DEFAULT 0,
+                    dedupe_key TEXT,
+                    cacheable INTEGER DEFAULT 0
                 )
                 """
             )
+            cols = {r[1] for r in cur.execute("PRAGMA table_info(jobs)")}
+            if "worker_id" not in cols:
+                cur.execute("ALTER TABLE jobs ADD COLUMN worker_id TEXT")
+            if "batch_key" not in cols:
+                cur.execute("ALTER TABLE jobs ADD COLUMN batch_key TEXT")
+            if "progress" not in cols:
+                cur.execute("ALTER TABLE jobs ADD COLUMN progress TEXT")
+            if "priority" not in cols:
+                cur.execute(f"ALTER TABLE jobs ADD COLUMN priority INTEGER DEFAULT {DEFAULT_PRIORITY}")
+            if "lease_until" not in cols:
+                cur.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+                cur.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER DEFAULT 0")
+                cur.execute("ALTER TABLE jobs ADD COLUMN not_before REAL DEFAULT 0")
+                # Rows claimed before leases existed get one lease from their last update
+                cur.execute("UPDATE jobs SET lease_until=updated+?, attempts=1 WHERE status='running'", (LEASE_S,))
+            if "dedupe_key" not in cols:
+                cur.execute("ALTER TABLE jobs ADD COLUMN dedupe_key TEXT")
+                cur.execute("ALTER TABLE jobs ADD COLUMN cacheable INTEGER DEFAULT 0")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_status_lease ON jobs(status, lease_until)")
+            # Only deduplicated jobs carry a key; keep the index to those rows
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_dedupe ON jobs(dedupe_key, status, updated)"
+                " WHERE dedupe_key IS NOT NULL"
+            )
+            self._sync_archive(cur)
             cur.execute("CREATE INDEX IF NOT EXISTS idx_status_created ON jobs(status, created)")
-            conn.commit()
-        finally:
-            conn.close()
+            # Covers the type-routed claim: rowid is stored in every index entry.
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_status_type_created ON jobs(status, type, created)")
+            # Claim order: walk queued rows by rank instead of sorting all of them
+            if self._rank_expr is not None:
+                name = "idx_status_rank_" + re.sub(r"\W", "_", repr(float(self.aging_s)))
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON jobs(status, ({self._rank_expr}))")
+            else:
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_status_prio_created ON jobs(status, priority DESC, created)")
 
-    def enqueue(self, type_: str, payload: Dict[str, Any]) -> str:
-        jid = str(uuid.uuid4())
+    def _sync_archive(self, cur: sqlite3.Cursor) -> None:
+        """Create jobs_archive or add columns that jobs gained since."""
+        cols = [(r[1], r[2]) for r in cur.execute("PRAGMA table_info(jobs)")]
+        cur.execute("CREATE TABLE IF NOT EXISTS jobs_archive (id TEXT PRIMARY KEY)")
+        have = {r[1] for r in cur.execute("PRAGMA table_info(jobs_archive)")}
+        for name, decl in cols:
+            if name not in have:
+                cur.execute(f"ALTER TABLE jobs_archive ADD COLUMN {name} {decl}")
+        self._columns = ", ".join(name for name, _ in cols)
+
+    def enqueue(self, type_: str, payload: Dict[str, Any], batch_key: Optional[str] = None,
+                priority: Any = None, dedupe: bool = False) -> str:
+        """Queue a job. Jobs of one type sharing a non-None `batch_key` are
+        compatible and may be handed to a worker as one batch. `priority` is
+        a class name or 0..10 (see parse_priority). With dedupe=True an
+        identical queued/running job is reused instead (see submit())."""
+        if dedupe:
+            return self.submit(type_, payload, batch_key=batch_key, priority=priority)[0]
+        return self._insert(None, type_, payload, batch_key, parse_priority(priority), None, False)
+
+    def submit(
+        self,
+        type_: str,
+        payload: Dict[str, Any],
+        batch_key: Optional[str] = None,
+        priority: Any = None,
+        dedupe_key: Optional[str] = None,
+        cacheable: bool = False,
+        cache_ttl_s: float = RESULT_CACHE_TTL_S,
+    ) -> Tuple[str, str]:
+        """Idempotent enqueue. Returns (job_id, how) where how is:
+          "attached": an identical job is queued or running; its id is returned
+                      (and its priority raised to ours if higher)
+          "cached":   an identical cacheable job finished within `cache_ttl_s`
+                      and its output files still exist; its id is returned
+          "new":      a job was queued
+        Identity is `dedupe_key`, by default canonical_key(type_, payload).
+        Pass cacheable=True only when the output is deterministic (e.g. an
+        explicit seed), and a dedupe_key that covers the model in use.
+        """
+        key = dedupe_key or canonical_key(type_, payload)
+        prio = parse_priority(priority)
         now = time.time()
-        conn = self._conn()
-        try:
+        with self._conn() as conn:
             cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO jobs(id, type, payload, status, result, created, updated, cancelled) VALUES(?,?,?,?,?,?,?,0)",
-                (jid, type_, json.dumps(payload), "queued", None, now, now),
-            )
+            # Serializes concurrent double-submits: only one of them inserts
+            cur.execute("BEGIN IMMEDIATE")
+            row = cur.execute(SQL_INFLIGHT, (key,)).fetchone()
+            if row:
+                cur.execute(SQL_BUMP_PRIORITY, (prio, row[0]))
+                conn.commit()
+                return row[0], "attached"
+            if cacheable:
+                row = cur.execute(SQL_CACHED, (key, now - cache_ttl_s)).fetchone()
+                if row and all(os.path.exists(f) for f in _output_files(json.loads(row[1] or "null"))):
+                    conn.commit()
+                    return row[0], "cached"
+            jid = self._insert(cur, type_, payload, batch_key, prio, key, cacheable)
             conn.commit()
-        finally:
-            conn.close()
+        notify.publish(self.channel, {"event": "enqueued", "id": jid, "type": type_})
+        return jid, "new"
+
+    def _insert(self, cur: Optional[sqlite3.Cursor], type_: str, payload: Dict[str, Any], batch_key: Optional[str],
+                prio: int, dedupe_key: Optional[str], cacheable: bool) -> str:
+        jid = str(uuid.uuid4())
+        now = time.time()
+        args = (jid, type_, json.dumps(payload), "queued", None, now, now, batch_key, prio, dedupe_key, int(cacheable))
+        if cur is not None:
+            cur.execute(SQL_INSERT, args)
+            return jid
+        with self._conn() as conn:
+            conn.execute(SQL_INSERT, args)
+        notify.publish(self.channel, {"event": "enqueued", "id": jid, "type": type_})
         return jid
 
-    def dequeue(self) -> Optional[Tuple[str, str, Dict[str, Any]]]:
-        conn = self._conn()
-        try:
+    def evict_result_cache(self, ttl_s: float = RESULT_CACHE_TTL_S, max_entries: int = RESULT_CACHE_MAX) -> int:
+        """Stop serving completed jobs older than `ttl_s` or beyond the newest
+        `max_entries` from the result cache. The jobs and their files stay."""
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET cacheable=0 WHERE status='done' AND cacheable=1 AND dedupe_key IS NOT NULL AND ("
+                " updated<? OR rowid NOT IN (SELECT rowid FROM jobs WHERE status='done' AND cacheable=1"
+                " AND dedupe_key IS NOT NULL ORDER BY updated DESC LIMIT ?))",
+                (time.time() - ttl_s, max_entries),
+            )
+            return cur.rowcount
+
+    def dequeue(
+        self,
+        types: Optional[Iterable[str]] = None,
+        worker_id: Optional[str] = None,
+        block: bool = False,
+        timeout: Optional[float] = None,
+    ) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+        """Atomically claim the oldest queued job, optionally restricted to `types`.
+        With block=True, wait up to `timeout` seconds (forever if None) for a
+        matching enqueue before giving up.
+        """
+        items = self.dequeue_batch(types, 1, worker_id=worker_id, block=block, timeout=timeout)
+        return items[0] if items else None
+
+    def dequeue_batch(
+        self,
+        types: Optional[Iterable[str]] = None,
+        max_items: int = 1,
+        worker_id: Optional[str] = None,
+        block: bool = False,
+        timeout: Optional[float] = None,
+        batch_types: Optional[Iterable[str]] = None,
+    ) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """Claim the oldest queued job plus up to max_items-1 more queued jobs of
+        the same type and batch_key, in one transaction. Jobs without a
+        batch_key are always claimed alone, as are jobs whose type is not in
+        `batch_types` (when given). Blocking behaves as in dequeue(); whatever
+        is queued at wakeup is returned.
+        """
+        types = list(types) if types is not None else None
+        if types is not None and not types:
+            return []
+        batch_types = set(batch_types) if batch_types is not None else None
+        if not block:
+            return self._claim(types, worker_id, max_items, batch_types)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # Subscribe before the first claim attempt so no enqueue can slip in between
+        with notify.Subscriber(self.channel) as sub:
+            while True:
+                items = self._claim(types, worker_id, max_items, batch_types)
+                if items:
+                    return items
+                while True:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return []
+                    ev = sub.recv(POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining))
+                    if ev is None:
+                        break  # polling fallback
+                    if ev.get("event") == "enqueued" and (types is None or ev.get("type") in types):
+                        break
+                    if self.caps and ev.get("event") == "status" and ev.get("status") in TERMINAL:
+                        break  # a capped slot may have freed up
+
+    def _claim(self, types: Optional[list], worker_id: Optional[str], limit: int = 1,
+               batch_types: Optional[set] = None) -> List[Tuple[str, str, Dict[str, Any]]]:
+        # cancel() always flips status too, so status='queued' implies cancelled=0
+        now = time.time()
+        claimed = []
+        reaped: list = []
+        with self._conn() as conn:
             cur = conn.cursor()
-            cur.execute("SELECT id, type, payload FROM jobs WHERE status='queued' AND cancelled=0 ORDER BY created ASC LIMIT 1")
-            row = cur.fetchone()
+            # Take the write lock up front so no other worker can claim the same row
+            cur.execute("BEGIN IMMEDIATE")
+            if now - self._last_reap >= REAP_INTERVAL:
+                self._last_reap = now
+                reaped = self._reap(cur, now)
+            room = self._room(cur)
+            blocked: list = []
+            if room is not None:
+                blocked = sorted({t for grp, _ in self.caps for t in grp if room(t) <= 0})
+            sql = "SELECT rowid, type, batch_key FROM jobs WHERE status='queued' AND not_before<=?"
+            args: list = [now]
+            if types is not None:
+                allowed = [t for t in types if t not in blocked]
+                if not allowed:
+                    conn.commit()
+                    self._publish_reaped(reaped)
+                    return []
+                sql += f" AND type IN ({','.join('?' * len(allowed))})"
+                args.extend(allowed)
+            elif blocked:
+                sql += f" AND type NOT IN ({','.join('?' * len(blocked))})"
+                args.extend(blocked)
+            sql += f" ORDER BY {self._rank_sql} LIMIT 1"
+            row = cur.execute(sql, args).fetchone()
             if not row:
-                return None
-            jid, type_, payload = row[0], row[1], json.loads(row[2])
-            cur.execute("UPDATE jobs SET status='running', updated=? WHERE id=?", (time.time(), jid))
+                conn.commit()
+                self._publish_reaped(reaped)
+                return []
+            rowids = [row[0]]
+            if room is not None:
+                limit = min(limit, room(row[1]))
+            if row[2] is None or (batch_types is not None and row[1] not in batch_types):
+                limit = 1
+            if limit > 1:
+                peers = cur.execute(SQL_BATCH_PEERS, (now, row[1], row[2], row[0], limit - 1)).fetchall()
+                rowids.extend(r[0] for r in peers)
+            for rowid in rowids:
+                cur.execute(SQL_CLAIM, (now, worker_id, now + LEASE_S, rowid))
+                jid, type_, payload = cur.execute(SQL_CLAIMED, (rowid,)).fetchone()
+                claimed.append((jid, type_, json.loads(payload)))
             conn.commit()
-            return jid, type_, payload
-        finally:
-            conn.close()
+        self._publish_reaped(reaped)
+        for jid, _, _ in claimed:
+            notify.publish(self.channel, {"event": "status", "id": jid, "status": "running"})
+        return claimed
 
-    def set_result(self, job_id: str, status: str, result: Dict[str, Any]):
-        conn = self._conn()
-        try:
+    def _reap(self, cur: sqlite3.Cursor, now: float) -> List[Tuple[str, str]]:
+        """Requeue running jobs whose lease expired (their worker is gone), with
+        exponential backoff; fail them once MAX_ATTEMPTS claims were used.
+        Runs inside the claim transaction. Returns (job id, new status)."""
+        out = []
+        for jid, attempts in cur.execute(SQL_EXPIRED, (now,)).fetchall():
+            attempts = attempts or 1
+            if attempts >= MAX_ATTEMPTS:
+                err = json.dumps({"error": f"worker lost (lease expired) after {attempts} attempts"})
+                cur.execute(SQL_EXHAUSTED, (err, now, jid))
+                out.append((jid, "error"))
+            else:
+                backoff = min(RETRY_BACKOFF_MAX_S, RETRY_BACKOFF_S * 2 ** (attempts - 1))
+                cur.execute(SQL_REQUEUE, (now + backoff, now, jid))
+                out.append((jid, "queued"))
+        return out
+
+    def _publish_reaped(self, reaped: List[Tuple[str, str]]) -> None:
+        for jid, status in reaped:
+            logger.warning(f"job {jid} lease expired -> {status}")
+            notify.publish(self.channel, {"event": "status", "id": jid, "status": status})
+
+    def reap_expired(self) -> int:
+        """Run lease recovery now (claims also do it every REAP_INTERVAL)."""
+        with self._conn() as conn:
             cur = conn.cursor()
-            cur.execute(
-                "UPDATE jobs SET status=?, result=?, updated=? WHERE id=?",
-                (status, json.dumps(result), time.time(), job_id),
-            )
+            cur.execute("BEGIN IMMEDIATE")
+            reaped = self._reap(cur, time.time())
             conn.commit()
-        finally:
-            conn.close()
+        self._publish_reaped(reaped)
+        return len(reaped)
+
+    def heartbeat(self, job_id: str) -> bool:
+        """Extend the lease of a running job. False if it is no longer running."""
+        with self._conn() as conn:
+            return conn.execute(SQL_HEARTBEAT, (time.time() + LEASE_S, job_id)).rowcount > 0
+
+    def compact(self, retain_s: float = RETAIN_S, batch: int = 1000) -> int:
+        """Move finished jobs last updated more than `retain_s` ago to
+        jobs_archive, `batch` rows per transaction so claims are not blocked
+        for long. status() still finds archived jobs. Returns rows moved."""
+        cutoff = time.time() - retain_s
+        moved = 0
+        for st in TERMINAL:
+            while True:
+                with self._conn() as conn:
+                    cur = conn.cursor()
+                    cur.execute("BEGIN IMMEDIATE")
+                    # created <= updated, so the created bound lets idx_status_created do the range scan
+                    rowids = [r[0] for r in cur.execute(
+                        "SELECT rowid FROM jobs WHERE status=? AND created<? AND updated<? LIMIT ?",
+                        (st, cutoff, cutoff, batch))]
+                    if not rowids:
+                        conn.rollback()
+                        break
+                    marks = ",".join("?" * len(rowids))
+                    cur.execute(f"INSERT OR REPLACE INTO jobs_archive({self._columns}) "
+                                f"SELECT {self._columns} FROM jobs WHERE rowid IN ({marks})", rowids)
+                    cur.execute(f"DELETE FROM jobs WHERE rowid IN ({marks})", rowids)
+                    conn.commit()
+                moved += len(rowids)
+                if len(rowids) < batch:
+                    break
+        return moved
+
+    def _room(self, cur: sqlite3.Cursor) -> Optional[Callable[[str], int]]:
+        """Free slots per type under the concurrency caps (None when uncapped).
+        Runs inside the claim transaction, so counts cannot race."""
+        if not self.caps:
+            return None
+        running = dict(cur.execute(SQL_RUNNING_BY_TYPE).fetchall())
+        free = [(grp, n - sum(running.get(t, 0) for t in grp)) for grp, n in self.caps]
+
+        def room(type_: str) -> int:
+            return min([f for grp, f in free if type_ in grp], default=1 << 30)
+        return room
+
+    def set_result(self, job_id: str, status: str, result: Dict[str, Any], worker_id: Optional[str] = None,
+                   cacheable: bool = True):
+        """Finish a running job. Only the claim held by `worker_id` (the id
+        passed to dequeue) counts; anything else is ignored. cacheable=False
+        keeps the result out of the submit() cache even if the job was
+        submitted as cacheable (e.g. mock output)."""
+        with self._conn() as conn:
+            cur = conn.execute(SQL_SET_RESULT, (status, json.dumps(result), time.time(), int(cacheable), job_id, worker_id))
+            ok = cur.rowcount > 0
+        if ok:
+            notify.publish(self.channel, {"event": "status", "id": job_id, "status": status})
+
+    def set_progress(self, job_id: str, progress: Dict[str, Any]) -> None:
+        """Record progress of a running job (renewing its lease) and notify
+        status/event watchers."""
+        now = time.time()
+        with self._conn() as conn:
+            cur = conn.execute(SQL_SET_PROGRESS, (json.dumps(progress), now, now + LEASE_S, job_id))
+            ok = cur.rowcount > 0
+        if ok:
+            notify.publish(self.channel, {"event": "progress", "id": job_id, "progress": progress})
+
+    def is_cancelled(self, job_id: str) -> bool:
+        with self._conn() as conn:
+            row = conn.execute(SQL_IS_CANCELLED, (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def control(self, job_id: str) -> "JobControl":
+        return JobControl(self, job_id)
 
     def status(self, job_id: str) -> Dict[str, Any]:
-        conn = self._conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT id, type, status, result, created, updated, cancelled FROM jobs WHERE id=?", (job_id,))
-            row = cur.fetchone()
+        with self._conn() as conn:
+            row = conn.execute(SQL_STATUS, (job_id,)).fetchone()
+            if not row:
+                row = conn.execute(SQL_STATUS_ARCHIVE, (job_id,)).fetchone()
             if not row:
                 return {"error": "not_found"}
             return {
@@ -104,16 +625,113 @@ class JobQueue:
                 "created": row[4],
                 "updated": row[5],
                 "cancelled": bool(row[6]),
+                "worker_id": row[7],
+                "progress": json.loads(row[8]) if row[8] else None,
+                "priority": row[9],
+                "attempts": row[10],
             }
-        finally:
-            conn.close()
 
     def cancel(self, job_id: str) -> bool:
-        conn = self._conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("UPDATE jobs SET cancelled=1, status='cancelled', updated=? WHERE id=?", (time.time(), job_id))
-            conn.commit()
-            return cur.rowcount > 0
-        finally:
-            conn.close()
+        with self._conn() as conn:
+            cur = conn.execute(SQL_CANCEL, (time.time(), job_id))
+            ok = cur.rowcount > 0
+        if ok:
+            notify.publish(self.channel, {"event": "status", "id": job_id, "status": "cancelled"})
+        return ok
+
+
+class JobControl:
+    """Progress/cancel/lease handle for one running job, used as a context manager.
+
+    A watcher thread listens on the queue's notify channel (re-checking the DB
+    every POLL_INTERVAL in case a datagram is lost) and sets a flag when the
+    job is cancelled, so check() is a plain flag read that long-running loops
+    can call every step. Callbacks registered with on_cancel() run on that
+    thread as soon as the cancel arrives, e.g. to kill a child process.
+    The same thread renews the job's lease every lease_s/3 seconds.
+    """
+
+    def __init__(self, jq: JobQueue, job_id: str, min_interval_s: float = PROGRESS_INTERVAL,
+                 lease_s: float = LEASE_S):
+        self.jq = jq
+        self.heartbeat_s = lease_s / 3
+        self.job_id = job_id
+        self.min_interval_s = min_interval_s
+        self._cancelled = threading.Event()
+        self._closed = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+        self._sub = notify.Subscriber(jq.channel)
+        self._thread = threading.Thread(target=self._watch, name=f"jobctl-{job_id[:8]}", daemon=True)
+        self._thread.start()
+
+    def _watch(self) -> None:
+        last_beat = time.monotonic()
+        while not self._closed.is_set():
+            try:
+                ev = self._sub.recv(min(POLL_INTERVAL, self.heartbeat_s))
+            except OSError:
+                return  # socket closed by close()
+            if self._closed.is_set():
+                return
+            if time.monotonic() - last_beat >= self.heartbeat_s:
+                last_beat = time.monotonic()
+                self.jq.heartbeat(self.job_id)
+            if ev is None:
+                hit = self.jq.is_cancelled(self.job_id)
+            else:
+                hit = ev.get("id") == self.job_id and ev.get("status") == "cancelled"
+            if hit:
+                self._fire()
+                return
+
+    def _fire(self) -> None:
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self._cancelled.set()
+            callbacks = list(self._callbacks)
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                pass
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def on_cancel(self, fn: Callable[[], None]) -> None:
+        """Run `fn` when the job is cancelled (immediately if it already was)."""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def check(self) -> None:
+        if self._cancelled.is_set():
+            raise JobCancelled(self.job_id)
+
+    def report(self, step: int, total: int, phase: str = "run", **extra: Any) -> None:
+        """Record progress (throttled to one DB write per min_interval_s, the
+        last step always written) and raise JobCancelled if cancelled."""
+        self.check()
+        now = time.monotonic()
+        if step < total and now - self._last_write < self.min_interval_s:
+            return
+        self._last_write = now
+        progress = {"phase": phase, "step": step, "total": total,
+                    "fraction": round(step / total, 4) if total else None, **extra}
+        self.jq.set_progress(self.job_id, progress)
+
+    def close(self) -> None:
+        self._closed.set()
+        self._sub.close()
+
+    def __enter__(self) -> "JobControl":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -1,11 +1,20 @@
 import os
 import sys
+import json
+import math
+import time
+import uuid
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
+from .llm_batch import BatchRequest, BatchScheduler, LlamaBatchEngine, PrefixCache
 from .utils import set_offline_env_defaults
 
 set_offline_env_defaults()
@@ -20,15 +29,27 @@ class GenRequest(BaseModel):
     prompt: str
     max_tokens: int = 256
     temperature: float = 0.7
+    stream: bool = False
 
 class GenResponse(BaseModel):
     text: str
+    queue_ms: Optional[float] = None
+    compute_ms: Optional[float] = None
 
 LLM = None
 MODEL_PATH = os.environ.get("LLM20_MODEL", str((Path(__file__).resolve().parent.parent / "models" / "w8kxl-20b.gguf").resolve()))
 THREADS = int(os.environ.get("LLM20_THREADS", "6"))
 NGL = int(os.environ.get("LLM20_NGL", "35"))
 CTX = int(os.environ.get("LLM20_CTX", "4096"))
+# One llama context is not thread-safe, so inference threads default to 1
+WORKERS = int(os.environ.get("LLM20_WORKERS", "1"))
+QUEUE_MAX = int(os.environ.get("LLM20_QUEUE_MAX", "8"))
+# Continuous batching: sequences decoded together (each gets CTX tokens of KV); <=1 disables
+BATCH_SLOTS = int(os.environ.get("LLM20_BATCH_SLOTS", "4"))
+BATCH_WINDOW_MS = float(os.environ.get("LLM20_BATCH_WINDOW_MS", "10"))
+# Saved KV state for repeated prompt prefixes (system prompts, RAG context, history); 0 disables
+PREFIX_CACHE_MB = int(os.environ.get("LLM20_PREFIX_CACHE_MB", "2048"))
+PREFIX_BLOCK = int(os.environ.get("LLM20_PREFIX_BLOCK", "64"))
 
 try:
     from llama_cpp import Llama
@@ -49,19 +70,262 @@ try:
 except Exception as e:
     logger.warning(f"llama-cpp-python not available or failed: {e}. Using mock mode.")
 
-@app.post("/gen", response_model=GenResponse)
-async def gen(req: GenRequest):
-    prompt = req.prompt
+
+def _attach_ram_cache(llm, capacity_bytes: int):
+    """Prefix cache for the single-sequence path: llama-cpp-python restores the
+    saved state of the longest matching token prefix before evaluating a prompt.
+    Wrapped to count hits and misses."""
+    from llama_cpp import LlamaRAMCache
+
+    class CountingRAMCache(LlamaRAMCache):
+        hits = 0
+        misses = 0
+
+        def __getitem__(self, key):
+            try:
+                value = super().__getitem__(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            return value
+
+    cache = CountingRAMCache(capacity_bytes=capacity_bytes)
+    llm.set_cache(cache)
+    return cache
+
+
+RAM_CACHE = None
+if LLM is not None and PREFIX_CACHE_MB > 0:
+    try:
+        RAM_CACHE = _attach_ram_cache(LLM, PREFIX_CACHE_MB << 20)
+    except Exception as e:
+        logger.warning(f"prefix cache unavailable: {e}")
+
+class InferenceQueue:
+    """Runs blocking LLM calls on dedicated threads behind a bounded admission queue.
+    At most `workers` calls run and `max_queued` wait; callers beyond that are
+    rejected by try_admit() so the API can answer 429 immediately.
+    """
+    def __init__(self, workers: int = WORKERS, max_queued: int = QUEUE_MAX):
+        self.workers = max(1, workers)
+        self.capacity = self.workers + max(0, max_queued)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="llm20")
+        self._lock = threading.Lock()
+        self._pending = 0  # admitted and not finished (waiting + running)
+        self._avg_compute_s: Optional[float] = None
+
+    @property
+    def depth(self) -> int:
+        return self._pending
+
+    def eta_s(self) -> float:
+        """Rough time until a newly admitted request would start computing."""
+        avg = self._avg_compute_s if self._avg_compute_s is not None else 1.0
+        return avg * math.ceil(max(0, self._pending - self.workers + 1) / self.workers)
+
+    def try_admit(self) -> bool:
+        with self._lock:
+            if self._pending >= self.capacity:
+                return False
+            self._pending += 1
+            return True
+
+    def release(self, compute_s: Optional[float]) -> None:
+        with self._lock:
+            self._pending -= 1
+            if compute_s is not None:
+                prev = self._avg_compute_s
+                self._avg_compute_s = compute_s if prev is None else 0.8 * prev + 0.2 * compute_s
+
+    async def run(self, fn: Callable[..., Any], *args) -> Tuple[Any, float, float]:
+        """Run fn(*args) for an admitted request. Returns (result, queue_s, compute_s)."""
+        submitted = time.perf_counter()
+        timing = {}
+
+        def job():
+            start = time.perf_counter()
+            timing["queue_s"] = start - submitted
+            try:
+                return fn(*args)
+            finally:
+                timing["compute_s"] = time.perf_counter() - start
+
+        try:
+            res = await asyncio.wrap_future(self._executor.submit(job))
+        finally:
+            self.release(timing.get("compute_s"))
+        return res, timing["queue_s"], timing["compute_s"]
+
+
+BATCHER: Optional[BatchScheduler] = None
+if LLM is not None and BATCH_SLOTS > 1 and LlamaBatchEngine.supported():
+    try:
+        _engine = LlamaBatchEngine(LLM, BATCH_SLOTS, CTX, THREADS)
+        _prefix = PrefixCache(PREFIX_CACHE_MB << 20, PREFIX_BLOCK) if PREFIX_CACHE_MB > 0 and _engine.supports_state else None
+        BATCHER = BatchScheduler(_engine, BATCH_WINDOW_MS / 1000.0, prefix_cache=_prefix)
+        logger.info(f"Continuous batching enabled: {BATCH_SLOTS} slots, window {BATCH_WINDOW_MS} ms")
+    except Exception as e:
+        logger.warning(f"Continuous batching unavailable, using single-sequence inference: {e}")
+
+# With batching every slot counts as a running request for admission purposes
+INFER = InferenceQueue(workers=BATCH_SLOTS if BATCHER is not None else WORKERS)
+
+
+def _busy_response() -> JSONResponse:
+    eta = INFER.eta_s()
+    return JSONResponse(
+        {"error": "busy", "queue_depth": INFER.depth, "eta_s": round(eta, 2)},
+        status_code=429,
+        headers={
+            "Retry-After": str(max(1, math.ceil(eta))),
+            "X-Queue-Depth": str(INFER.depth),
+            "X-Queue-ETA-Ms": str(int(eta * 1000)),
+        },
+    )
+
+
+def _event(op: str, jobid: str, **kw) -> bytes:
+    # Same JSON-lines events as the UDS helper: {"op":"token","jobid":..,"data":..} / {"op":"done",..}
+    return (json.dumps({"op": op, "jobid": jobid, **kw}, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _generate(req: GenRequest) -> str:
     if LLM is None:
         # mock fallback
-        return GenResponse(text=f"[MOCK LLM20] {prompt[:64]}...")
-
-    out = LLM(prompt, temperature=req.temperature, max_tokens=req.max_tokens, stop=["</s>"])
+        return f"[MOCK LLM20] {req.prompt[:64]}..."
+    out = LLM(req.prompt, temperature=req.temperature, max_tokens=req.max_tokens, stop=["</s>"])
     if isinstance(out, dict):
-        text = out.get("choices", [{}])[0].get("text", "")
+        return out.get("choices", [{}])[0].get("text", "")
+    return str(out)
+
+
+def _iter_tokens(req: GenRequest) -> Iterator[str]:
+    if LLM is None:
+        for i, word in enumerate(f"[MOCK LLM20] {req.prompt[:64]}...".split(" ")):
+            yield word if i == 0 else " " + word
+        return
+    for chunk in LLM(req.prompt, temperature=req.temperature, max_tokens=req.max_tokens, stop=["</s>"], stream=True):
+        text = chunk.get("choices", [{}])[0].get("text", "") if isinstance(chunk, dict) else str(chunk)
+        if text:
+            yield text
+
+
+def _submit_batched(req: GenRequest, on_token: Optional[Callable[[str], None]] = None):
+    """Hand an admitted request to the batch scheduler.
+    Returns (future of (text, queue_s, compute_s), BatchRequest)."""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def on_done(text: str, error: Optional[str], queue_s: float, compute_s: float):
+        INFER.release(compute_s)
+
+        def resolve():
+            if fut.done():
+                return
+            if error:
+                fut.set_exception(RuntimeError(error))
+            else:
+                fut.set_result((text, queue_s, compute_s))
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            pass  # loop already closed
+
+    breq = BatchRequest(req.prompt, req.max_tokens, req.temperature, ["</s>"], on_done, on_token)
+    BATCHER.submit(breq)
+    return fut, breq
+
+
+def _start_stream(req: GenRequest, jobid: str):
+    """Start generating now, on the batch scheduler or the inference thread, so the
+    admitted slot is always released; return an async iterator of NDJSON events."""
+    loop = asyncio.get_running_loop()
+    q: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for text in _iter_tokens(req):
+                if stop.is_set():
+                    break  # client went away
+                loop.call_soon_threadsafe(q.put_nowait, _event("token", jobid, data=text))
+        finally:
+            loop.call_soon_threadsafe(q.put_nowait, None)
+
+    if BATCHER is not None:
+        def push(text: str):
+            loop.call_soon_threadsafe(q.put_nowait, _event("token", jobid, data=text))
+        task, breq = _submit_batched(req, on_token=push)
+        # Scheduled after the last token, so it arrives after it
+        task.add_done_callback(lambda _: q.put_nowait(None))
+
+        def cancel():
+            breq.cancelled = True
+    else:
+        task = asyncio.ensure_future(INFER.run(produce))
+        cancel = stop.set
+
+    async def events():
+        try:
+            while True:
+                item = await q.get()
+                if item is None:
+                    break
+                yield item
+            try:
+                _, queue_s, compute_s = await task
+            except Exception as e:
+                logger.warning(f"stream {jobid} failed: {e}")
+                yield _event("done", jobid, exit=1, error=str(e))
+                return
+            yield _event("done", jobid, exit=0, queue_ms=round(queue_s * 1000, 1), compute_ms=round(compute_s * 1000, 1))
+        finally:
+            cancel()
+
+    return events()
+
+
+@app.post("/gen", response_model=GenResponse)
+async def gen(req: GenRequest):
+    if not INFER.try_admit():
+        return _busy_response()
+    if req.stream:
+        jobid = uuid.uuid4().hex[:12]
+        return StreamingResponse(_start_stream(req, jobid), media_type="application/x-ndjson")
+    if BATCHER is not None:
+        fut, _ = _submit_batched(req)
+        text, queue_s, compute_s = await fut
     else:
-        text = str(out)
-    return GenResponse(text=text)
+        text, queue_s, compute_s = await INFER.run(_generate, req)
+    return GenResponse(text=text, queue_ms=round(queue_s * 1000, 1), compute_ms=round(compute_s * 1000, 1))
+
+
+def _prefix_cache_stats() -> Optional[Dict[str, Any]]:
+    if BATCHER is not None and BATCHER.prefix_cache is not None:
+        return BATCHER.prefix_cache.stats()
+    if RAM_CACHE is not None:
+        total = RAM_CACHE.hits + RAM_CACHE.misses
+        return {
+            "bytes": RAM_CACHE.cache_size,
+            "budget_bytes": RAM_CACHE.capacity_bytes,
+            "hits": RAM_CACHE.hits,
+            "misses": RAM_CACHE.misses,
+            "hit_rate": round(RAM_CACHE.hits / total, 3) if total else 0.0,
+        }
+    return None
+
+
+@app.get("/health")
+async def health():
+    return {
+        "ok": True,
+        "model_loaded": LLM is not None,
+        "batching": BATCH_SLOTS if BATCHER is not None else 0,
+        "queue_depth": INFER.depth,
+        "capacity": INFER.capacity,
+        "prefix_cache": _prefix_cache_stats(),
+    }
 
 """
 Alternative: llama.cpp CLI (commented example)
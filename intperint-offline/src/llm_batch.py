@@ -0,0 +1,394 @@
+"""Continuous batching for llm20_service.
+
+BatchScheduler gathers requests that arrive within a short window (up to
+one per sequence slot) and decodes all active sequences together: every
+step is a single llama_decode over one token per sequence. Finished
+sequences free their slot between steps, so waiting requests join a running
+batch without waiting for it to drain.
+
+LlamaBatchEngine owns a dedicated llama context on the already-loaded model
+with one KV-cache partition (seq_id) per slot. The scheduler only talks to
+the small engine interface (tokenize / eval / clear / ...), which keeps it
+testable without llama.cpp.
+
+PrefixCache keeps saved per-sequence KV state keyed by chained hashes of
+token-prefix blocks, so a prompt that shares a long prefix (system prompt,
+RAG context, chat history) with an earlier one only evaluates its suffix.
+"""
+from __future__ import annotations
+import codecs
+import ctypes
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("llm20.batch")
+
+TOP_K = 40
+
+
+def sample_token(logits: np.ndarray, temperature: float, rng: np.random.Generator) -> int:
+    """Greedy for temperature<=0, otherwise top-k softmax sampling."""
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    k = min(TOP_K, logits.shape[0])
+    top = np.argpartition(logits, -k)[-k:]
+    z = logits[top].astype(np.float64) / temperature
+    p = np.exp(z - z.max())
+    p /= p.sum()
+    return int(top[rng.choice(k, p=p)])
+
+
+def _stop_prefix_len(text: str, stops: Sequence[str]) -> int:
+    """Length of the longest suffix of `text` that is a proper prefix of a stop string."""
+    best = 0
+    for stop in stops:
+        for k in range(min(len(stop) - 1, len(text)), best, -1):
+            if text.endswith(stop[:k]):
+                best = k
+                break
+    return best
+
+
+class PrefixCache:
+    """LRU of saved sequence KV states within a byte budget.
+
+    Prompts are hashed block by block (sha1 chained over `block` tokens), and
+    every block boundary of a stored state is indexed, so a new prompt matches
+    the longest cached prefix even if it diverges from the stored prompt later.
+    """
+    def __init__(self, budget_bytes: int, block: int = 64):
+        self.budget_bytes = budget_bytes
+        self.block = block
+        self._entries: "OrderedDict[bytes, Tuple[int, bytes, List[bytes]]]" = OrderedDict()
+        self._index: Dict[bytes, Tuple[bytes, int]] = {}  # boundary digest -> (entry key, n tokens)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+
+    def _digests(self, tokens: Sequence[int]) -> List[Tuple[int, bytes]]:
+        # Only prefixes that leave at least one token to evaluate (we need its logits)
+        h = hashlib.sha1()
+        out = []
+        limit = len(tokens) - 1
+        for end in range(self.block, limit + 1, self.block):
+            h.update(np.asarray(tokens[end - self.block:end], dtype=np.int32).tobytes())
+            out.append((end, h.copy().digest()))
+        return out
+
+    def lookup(self, tokens: Sequence[int]) -> Optional[Tuple[int, bytes]]:
+        """(n_prefix_tokens, state) for the longest cached prefix of `tokens`, or None."""
+        for n, d in reversed(self._digests(tokens)):
+            hit = self._index.get(d)
+            if hit is not None and hit[0] in self._entries:
+                self._entries.move_to_end(hit[0])
+                self.hits += 1
+                self.tokens_saved += n
+                return n, self._entries[hit[0]][1]
+        self.misses += 1
+        return None
+
+    def store(self, tokens: Sequence[int], save: Callable[[], bytes]) -> None:
+        """Remember the state covering `tokens`; `save` is only called if it is new."""
+        ds = self._digests(tokens)
+        if not ds:
+            return
+        key = ds[-1][1]
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        data = save()
+        if not data or len(data) > self.budget_bytes:
+            return
+        self._entries[key] = (ds[-1][0], data, [d for _, d in ds])
+        for n, d in ds:
+            self._index[d] = (key, n)
+        self.bytes += len(data)
+        while self.bytes > self.budget_bytes and self._entries:
+            old_key, (_, old_data, old_ds) = self._entries.popitem(last=False)
+            self.bytes -= len(old_data)
+            for d in old_ds:
+                if self._index.get(d, (None,))[0] == old_key:
+                    del self._index[d]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "budget_bytes": self.budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+class BatchRequest:
+    """One generation request. Callbacks run on the scheduler thread:
+    on_token(piece) for every decoded text piece, then exactly one
+    on_done(text, error, queue_s, compute_s)."""
+    def __init__(
+        self,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        stop: Sequence[str],
+        on_done: Callable[[str, Optional[str], float, float], None],
+        on_token: Optional[Callable[[str], None]] = None,
+    ):
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.stop = list(stop)
+        self.on_done = on_done
+        self.on_token = on_token
+        self.cancelled = False
+        self.submitted = time.perf_counter()
+
+
+class _Seq:
+    def __init__(self, req: BatchRequest, slot: int):
+        self.req = req
+        self.slot = slot
+        self.pos = 0
+        self.last_token = -1
+        self.n_gen = 0
+        self.text = ""
+        self.emitted = 0  # chars of text already passed to on_token
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.started = time.perf_counter()
+
+
+class BatchScheduler:
+    def __init__(self, engine: Any, window_s: float = 0.01, seed: Optional[int] = None, prefix_cache: Optional[PrefixCache] = None):
+        self.engine = engine
+        self.window_s = window_s
+        self.prefix_cache = prefix_cache
+        self._pending: Deque[BatchRequest] = deque()
+        self._cv = threading.Condition()
+        self._rng = np.random.default_rng(seed)
+        self.steps = 0
+        self.max_active = 0
+        self._thread = threading.Thread(target=self._run, name="llm20-batch", daemon=True)
+        self._thread.start()
+
+    def submit(self, req: BatchRequest) -> None:
+        with self._cv:
+            self._pending.append(req)
+            self._cv.notify()
+
+    def _run(self) -> None:
+        active: Dict[int, _Seq] = {}
+        free: List[int] = list(range(self.engine.n_slots))[::-1]
+        while True:
+            with self._cv:
+                if not active:
+                    while not self._pending:
+                        self._cv.wait()
+                    # Batching window: let concurrent arrivals join the first step
+                    deadline = time.monotonic() + self.window_s
+                    while len(self._pending) < len(free):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cv.wait(remaining)
+                admitted = []
+                while self._pending and free:
+                    admitted.append(_Seq(self._pending.popleft(), free.pop()))
+            try:
+                if admitted:
+                    self._prefill(admitted, active, free)
+                if active:
+                    self._step(active, free)
+            except Exception as e:
+                logger.exception("batch decode failed")
+                for seq in list(active.values()):
+                    self._finish(seq, active, free, error=str(e))
+
+    def _prefill(self, seqs: List[_Seq], active: Dict[int, _Seq], free: List[int]) -> None:
+        entries = []
+        prompts = []
+        cache = self.prefix_cache
+        for seq in seqs:
+            active[seq.slot] = seq
+            tokens = self.engine.tokenize(seq.req.prompt)
+            # Leave room in the slot's context for the completion; keep the
+            # first token (BOS) and drop the oldest prompt tokens after it
+            room = self.engine.n_ctx_per_slot - max(1, seq.req.max_tokens)
+            if room > 0 and len(tokens) > room:
+                tokens = tokens[:1] + tokens[len(tokens) - (room - 1):]
+            start = 0
+            if cache is not None:
+                hit = cache.lookup(tokens)
+                if hit is not None and self.engine.load_seq(seq.slot, hit[1], hit[0]):
+                    start = hit[0]  # only the suffix needs evaluating
+            entries.append((seq.slot, tokens[start:], start))
+            prompts.append((seq.slot, tokens))
+            seq.pos = len(tokens)
+        logits = self.engine.eval(entries)
+        if cache is not None:
+            for slot, tokens in prompts:
+                cache.store(tokens, lambda slot=slot: self.engine.save_seq(slot))
+        for seq in seqs:
+            self._advance(seq, logits[seq.slot], active, free)
+
+    def _step(self, active: Dict[int, _Seq], free: List[int]) -> None:
+        seqs = list(active.values())
+        self.max_active = max(self.max_active, len(seqs))
+        logits = self.engine.eval([(s.slot, [s.last_token], s.pos) for s in seqs])
+        self.steps += 1
+        for seq in seqs:
+            seq.pos += 1
+            self._advance(seq, logits[seq.slot], active, free)
+
+    def _advance(self, seq: _Seq, logits: np.ndarray, active: Dict[int, _Seq], free: List[int]) -> None:
+        req = seq.req
+        if req.cancelled:
+            self._finish(seq, active, free)
+            return
+        tok = sample_token(logits, req.temperature, self._rng)
+        if self.engine.is_eog(tok):
+            self._finish(seq, active, free)
+            return
+        prev_len = len(seq.text)
+        seq.text += seq.decoder.decode(self.engine.token_bytes(tok))
+        seq.n_gen += 1
+        seq.last_token = tok
+        for stop in req.stop:
+            idx = seq.text.find(stop, max(0, prev_len - len(stop) + 1))
+            if idx >= 0:
+                seq.text = seq.text[:idx]
+                self._finish(seq, active, free)
+                return
+        # Hold back a tail that may still turn into a stop string
+        self._flush(seq, hold=_stop_prefix_len(seq.text, req.stop))
+        # seq.pos is where last_token gets evaluated next
+        if seq.n_gen >= req.max_tokens or seq.pos >= self.engine.n_ctx_per_slot:
+            self._finish(seq, active, free)
+
+    @staticmethod
+    def _flush(seq: _Seq, hold: int = 0) -> None:
+        end = len(seq.text) - hold
+        if end > seq.emitted:
+            if seq.req.on_token:
+                seq.req.on_token(seq.text[seq.emitted:end])
+            seq.emitted = end
+
+    def _finish(self, seq: _Seq, active: Dict[int, _Seq], free: List[int], error: Optional[str] = None) -> None:
+        active.pop(seq.slot, None)
+        if error is None:
+            self._flush(seq)
+        try:
+            self.engine.clear(seq.slot)
+        finally:
+            free.append(seq.slot)
+        now = time.perf_counter()
+        try:
+            seq.req.on_done(seq.text, error, seq.started - seq.req.submitted, now - seq.started)
+        except Exception:
+            logger.exception("on_done callback failed")
+
+
+class LlamaBatchEngine:
+    """Multi-sequence decoding on a llama-cpp-python model via the low-level API.
+    Creates its own context (n_seq_max = slots) on the model `llm` already loaded."""
+
+    def __init__(self, llm: Any, n_slots: int, n_ctx_per_slot: int, n_threads: int, n_batch: int = 512):
+        import llama_cpp  # type: ignore
+        self._lib = llama_cpp
+        self._llm = llm
+        self.n_slots = n_slots
+        self.n_ctx_per_slot = n_ctx_per_slot
+        self.n_batch = n_batch
+        self.n_vocab = llm.n_vocab()
+        self._eos = llm.token_eos()
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx_per_slot * n_slots
+        params.n_batch = n_batch
+        params.n_seq_max = n_slots
+        params.n_threads = n_threads
+        params.n_threads_batch = n_threads
+        self._ctx = llama_cpp.llama_new_context_with_model(llm._model.model, params)
+        if not self._ctx:
+            raise RuntimeError("failed to create batch context")
+        self._batch = llama_cpp.llama_batch_init(n_batch, 0, n_slots)
+
+    @staticmethod
+    def supported() -> bool:
+        try:
+            import llama_cpp  # type: ignore
+        except Exception:
+            return False
+        return all(hasattr(llama_cpp, name) for name in ("llama_batch_init", "llama_decode", "llama_get_logits_ith"))
+
+    def tokenize(self, text: str) -> List[int]:
+        return self._llm.tokenize(text.encode("utf-8"), add_bos=True)
+
+    def token_bytes(self, tok: int) -> bytes:
+        return self._llm.detokenize([tok])
+
+    def is_eog(self, tok: int) -> bool:
+        return tok == self._eos
+
+    def eval(self, entries: List[Tuple[int, List[int], int]]) -> Dict[int, np.ndarray]:
+        """Evaluate tokens for several slots. entries: (slot, tokens, start_pos).
+        Returns the logits after each slot's last token."""
+        lib, b = self._lib, self._batch
+        flat = [(slot, tok, pos + i, i == len(toks) - 1) for slot, toks, pos in entries for i, tok in enumerate(toks)]
+        out: Dict[int, np.ndarray] = {}
+        for start in range(0, len(flat), self.n_batch):
+            chunk = flat[start:start + self.n_batch]
+            b.n_tokens = len(chunk)
+            for i, (slot, tok, pos, want_logits) in enumerate(chunk):
+                b.token[i] = tok
+                b.pos[i] = pos
+                b.n_seq_id[i] = 1
+                b.seq_id[i][0] = slot
+                b.logits[i] = want_logits
+            rc = lib.llama_decode(self._ctx, b)
+            if rc != 0:
+                raise RuntimeError(f"llama_decode failed rc={rc}")
+            for i, (slot, _, _, want_logits) in enumerate(chunk):
+                if want_logits:
+                    ptr = lib.llama_get_logits_ith(self._ctx, i)
+                    out[slot] = np.ctypeslib.as_array(ptr, shape=(self.n_vocab,)).copy()
+        return out
+
+    def _seq_rm(self, slot: int, p0: int, p1: int) -> None:
+        lib = self._lib
+        if hasattr(lib, "llama_kv_cache_seq_rm"):
+            lib.llama_kv_cache_seq_rm(self._ctx, slot, p0, p1)
+        else:
+            lib.llama_memory_seq_rm(lib.llama_get_memory(self._ctx), slot, p0, p1)
+
+    def clear(self, slot: int) -> None:
+        self._seq_rm(slot, -1, -1)
+
+    @property
+    def supports_state(self) -> bool:
+        return hasattr(self._lib, "llama_state_seq_get_data")
+
+    def save_seq(self, slot: int) -> bytes:
+        """Serialized KV state of one sequence."""
+        lib = self._lib
+        size = lib.llama_state_seq_get_size(self._ctx, slot)
+        buf = (ctypes.c_uint8 * size)()
+        n = lib.llama_state_seq_get_data(self._ctx, buf, size, slot)
+        return bytes(buf[:n])
+
+    def load_seq(self, slot: int, data: bytes, n_keep: int) -> bool:
+        """Restore a saved state into `slot` and keep only its first n_keep positions."""
+        lib = self._lib
+        src = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+        if lib.llama_state_seq_set_data(self._ctx, src, len(data), slot) == 0:
+            self.clear(slot)
+            return False
+        self._seq_rm(slot, n_keep, -1)
+        return True
@@ -0,0 +1,157 @@
+"""Cross-process job notifications over UNIX datagram sockets.
+
+Each subscriber binds its own socket inside a per-queue channel directory;
+publish() sends one small JSON datagram to every socket found there.
+Delivery is best-effort (a full or dead receiver is skipped), so consumers
+keep a slow polling fallback.
+
+StatusHub turns the same channel into per-job asyncio queues for the API.
+"""
+from __future__ import annotations
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import socket
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Optional
+
+_seq = itertools.count()
+
+
+def channel_dir(db_path: Path | str) -> Path:
+    """Channel directory for a queue DB. Kept under the temp dir because
+    AF_UNIX paths are limited to ~104 bytes on macOS."""
+    key = hashlib.sha1(str(Path(db_path).resolve()).encode("utf-8")).hexdigest()[:12]
+    return Path(tempfile.gettempdir()) / f"intperint-jobq-{key}"
+
+
+def publish(channel: Path, event: Dict[str, Any]) -> int:
+    """Send `event` to every subscriber of `channel`. Returns the number reached."""
+    try:
+        targets = list(channel.glob("*.sock"))
+    except OSError:
+        return 0
+    if not targets:
+        return 0
+    data = json.dumps(event).encode("utf-8")
+    sent = 0
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+        s.setblocking(False)
+        for path in targets:
+            try:
+                s.sendto(data, str(path))
+                sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Subscriber died without cleaning up
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            except OSError:
+                # Receive buffer full; that subscriber falls back to polling
+                pass
+    return sent
+
+
+class Subscriber:
+    """Receiving end of a channel. Use as a context manager."""
+
+    def __init__(self, channel: Path):
+        channel.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.path = channel / f"{os.getpid()}-{next(_seq)}.sock"
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(str(self.path))
+
+    def recv(self, timeout: Optional[float]) -> Optional[Dict[str, Any]]:
+        """Next event, or None if nothing arrived within `timeout` seconds."""
+        self._sock.settimeout(timeout)
+        try:
+            data = self._sock.recv(65536)
+        except (socket.timeout, BlockingIOError):
+            return None
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            return None
+
+    def close(self) -> None:
+        self._sock.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self) -> "Subscriber":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class StatusHub:
+    """In-process fan-out of queue events to asyncio waiters.
+
+    One daemon thread listens on the channel; coroutines register per-job
+    asyncio queues via subscribe(). Waiting clients therefore cost one queue
+    each and never poll the DB.
+    """
+
+    def __init__(self, channel: Path):
+        self.channel = channel
+        self._waiters: Dict[str, set] = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, timeout: float = 5.0) -> bool:
+        """Start the listener thread and wait until it is bound. Blocks, so
+        call it at startup or from a worker thread, not on the event loop."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="status-hub", daemon=True)
+                self._thread.start()
+        return self._ready.wait(timeout)
+
+    def _run(self) -> None:
+        with Subscriber(self.channel) as sub:
+            self._ready.set()
+            while True:
+                ev = sub.recv(None)
+                if not ev or "id" not in ev:
+                    continue
+                with self._lock:
+                    targets = list(self._waiters.get(ev["id"], ()))
+                for loop, q in targets:
+                    try:
+                        loop.call_soon_threadsafe(q.put_nowait, ev)
+                    except RuntimeError:
+                        pass  # loop already closed
+
+    @asynccontextmanager
+    async def subscribe(self, job_id: str) -> AsyncIterator["asyncio.Queue[Dict[str, Any]]"]:
+        """Queue receiving every event for `job_id` while the context is open."""
+        loop = asyncio.get_running_loop()
+        if not self._ready.is_set():
+            # Normally done at startup; never block the loop waiting for the bind
+            await loop.run_in_executor(None, self.start)
+        entry = (loop, asyncio.Queue())
+        with self._lock:
+            self._waiters.setdefault(job_id, set()).add(entry)
+        try:
+            yield entry[1]
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(job_id)
+                if waiters is not None:
+                    waiters.discard(entry)
+                    if not waiters:
+                        del self._waiters[job_id]
@@ -1,16 +1,21 @@
+import asyncio
 import hashlib
 import json
 import os
 import shlex
+import socket
 import subprocess
 import threading
 import time
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Optional
 
 LOG_DIR = Path(__file__).resolve().parent.parent / "logs"
 BASE_DIR = Path(__file__).resolve().parent.parent
 OUTPUTS_DIR = BASE_DIR / "outputs"
+# Model locations, shared by the workers that load them and the API's dedupe keys
+DEEPSEEK67_MODEL = os.environ.get("DEEPSEEK67_MODEL", str((BASE_DIR / "models" / "deepseek-67b.gguf").resolve()))
+SDXL_MODEL_DIR = os.environ.get("SDXL_MODEL_DIR", str((BASE_DIR / "models" / "sdxl").resolve()))
 
 for d in [LOG_DIR, OUTPUTS_DIR / "text", OUTPUTS_DIR / "image", OUTPUTS_DIR / "video"]:
     d.mkdir(parents=True, exist_ok=True)
@@ -42,6 +47,19 @@ def checksum_file(path: Path | str, algo: str = "sha256", chunk_size: int = 1024
     return h.hexdigest()
 
 
+def store_content_addressed(tmp_path: Path | str, root: Path | str, digest: str, suffix: str = "") -> tuple[Path, bool]:
+    """Move a fully written temp file to root/<digest[:2]>/<digest><suffix>.
+    If identical content is already stored the temp file is dropped.
+    Returns (stored path, deduplicated)."""
+    dst = Path(root) / digest[:2] / f"{digest}{suffix}"
+    if dst.exists():
+        os.unlink(tmp_path)
+        return dst, True
+    ensure_dir(dst.parent)
+    os.replace(tmp_path, dst)
+    return dst, False
+
+
 def checksum_verify(file_path: Path | str, expected_hex: str, algo: str = "sha256") -> bool:
     return checksum_file(file_path, algo) == expected_hex.lower()
 
@@ -56,12 +74,21 @@ def read_json(path: Path | str) -> Any:
         return json.load(f)
 
 
-def run_cmd_with_timeout(cmd: list[str] | str, timeout: int = 300, cwd: Optional[str] = None) -> tuple[int, str, str]:
+def run_cmd_with_timeout(
+    cmd: list[str] | str,
+    timeout: int = 300,
+    cwd: Optional[str] = None,
+    on_spawn: Optional[Callable[[subprocess.Popen], None]] = None,
+) -> tuple[int, str, str]:
+    """Run `cmd`, killing it after `timeout` seconds. `on_spawn` receives the
+    Popen right after start (e.g. to register a cancel hook that kills it)."""
     if isinstance(cmd, str):
         cmd_list = shlex.split(cmd)
     else:
         cmd_list = cmd
     proc = subprocess.Popen(cmd_list, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if on_spawn is not None:
+        on_spawn(proc)
 
     timer = threading.Timer(timeout, proc.kill)
     try:
@@ -72,6 +99,10 @@ def run_cmd_with_timeout(cmd: list[str] | str, timeout: int = 300, cwd: Optional
         timer.cancel()
 
 
+def is_local_url(url: str) -> bool:
+    return url.startswith("http://127.0.0.1") or url.startswith("http://localhost")
+
+
 class LocalOnlySession:
     """Very small guard to avoid accidental external HTTP calls.
     Only allows http://127.0.0.1 or http://localhost requests via requests.
@@ -81,16 +112,137 @@ class LocalOnlySession:
         self._s = requests.Session()
 
     def post(self, url: str, *args, **kwargs):
-        if not (url.startswith("http://127.0.0.1") or url.startswith("http://localhost")):
+        if not is_local_url(url):
             raise RuntimeError("External HTTP is forbidden in offline mode")
         return self._s.post(url, *args, **kwargs)
 
     def get(self, url: str, *args, **kwargs):
-        if not (url.startswith("http://127.0.0.1") or url.startswith("http://localhost")):
+        if not is_local_url(url):
             raise RuntimeError("External HTTP is forbidden in offline mode")
         return self._s.get(url, *args, **kwargs)
 
 
+class CircuitOpenError(RuntimeError):
+    """Raised without touching the network while a service is considered down."""
+    def __init__(self, retry_after_s: float):
+        super().__init__(f"circuit open, retry in {retry_after_s:.1f}s")
+        self.retry_after_s = retry_after_s
+
+
+class AsyncLocalOnlyClient:
+    """Async keep-alive connection pool (httpx) for one localhost service.
+
+    Same localhost-only guard as LocalOnlySession. Requests are retried only
+    when they cannot have reached the service (connect errors) or it answers
+    503, so generation is never run twice. After `failure_threshold`
+    consecutive failures the circuit opens and calls fail fast with
+    CircuitOpenError for `reset_after_s`. Then it is half-open: exactly one
+    trial request goes through while the others keep failing fast; its
+    success closes the circuit, its failure reopens it.
+    """
+    RETRY_STATUS = {503}
+
+    def __init__(
+        self,
+        base_url: str,
+        timeout_s: float = 300.0,
+        connect_timeout_s: float = 2.0,
+        retries: int = 2,
+        backoff_s: float = 0.2,
+        failure_threshold: int = 5,
+        reset_after_s: float = 15.0,
+        max_connections: int = 32,
+        transport: Any = None,
+    ):
+        import httpx
+        if not is_local_url(base_url):
+            raise RuntimeError("External HTTP is forbidden in offline mode")
+        self._httpx = httpx
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.failure_threshold = failure_threshold
+        self.reset_after_s = reset_after_s
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_inflight = False
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout_s, connect=connect_timeout_s),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            trust_env=False,  # never pick up proxy settings
+            transport=transport,
+        )
+
+    @property
+    def circuit_open(self) -> bool:
+        return self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_after_s
+
+    def _check_circuit(self) -> bool:
+        """Raise while open; True if the caller is the half-open trial request."""
+        if self._opened_at is None:
+            return False
+        if self.circuit_open:
+            raise CircuitOpenError(self.reset_after_s - (time.monotonic() - self._opened_at))
+        if self._trial_inflight:
+            raise CircuitOpenError(1.0)
+        self._trial_inflight = True
+        return True
+
+    def _record(self, ok: bool) -> None:
+        if ok:
+            self._failures = 0
+            self._opened_at = None
+        else:
+            self._failures += 1
+            if self._failures >= self.failure_threshold or self._opened_at is not None:
+                self._opened_at = time.monotonic()
+
+    async def _send(self, method: str, path: str, stream: bool, **kwargs):
+        if path.startswith("http") and not is_local_url(path):
+            raise RuntimeError("External HTTP is forbidden in offline mode")
+        trial = self._check_circuit()
+        httpx = self._httpx
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    req = self._client.build_request(method, path, **kwargs)
+                    r = await self._client.send(req, stream=stream)
+                except (httpx.ConnectError, httpx.ConnectTimeout):
+                    self._record(False)
+                    if attempt >= self.retries or self.circuit_open:
+                        raise
+                except httpx.TransportError:
+                    self._record(False)
+                    raise
+                else:
+                    if r.status_code in self.RETRY_STATUS and attempt < self.retries:
+                        await r.aclose()
+                        await asyncio.sleep(self.backoff_s * (2 ** attempt))
+                        continue
+                    self._record(r.status_code < 500)
+                    return r
+                await asyncio.sleep(self.backoff_s * (2 ** attempt))
+            raise RuntimeError("unreachable")
+        finally:
+            if trial:
+                self._trial_inflight = False
+
+    async def post(self, path: str, **kwargs):
+        """POST and read the whole response."""
+        return await self._send("POST", path, stream=False, **kwargs)
+
+    async def get(self, path: str, **kwargs):
+        return await self._send("GET", path, stream=False, **kwargs)
+
+    async def open_stream(self, method: str, path: str, **kwargs):
+        """Send a request and return the response with its body unread.
+        The caller must `await response.aclose()`."""
+        return await self._send(method, path, stream=True, **kwargs)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
 def set_offline_env_defaults():
     # Enforce offline for huggingface ecosystem
     os.environ.setdefault("HF_HUB_OFFLINE", "1")
@@ -105,3 +257,8 @@ def set_offline_env_defaults():
 
 def now_ts() -> float:
     return time.time()
+
+
+def worker_id(role: str) -> str:
+    """Identity recorded on claimed jobs, e.g. 'diffusion@host:1234'."""
+    return f"{role}@{socket.gethostname()}:{os.getpid()}"
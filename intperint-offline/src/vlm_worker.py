@@ -1,12 +1,19 @@
 import os
+import re
 import sys
 import time
 import json
+import shutil
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Sequence
 
-from .utils import set_offline_env_defaults, ensure_dir, write_json
+from .job_queue import JobQueue
+from .utils import set_offline_env_defaults, ensure_dir, write_json, safe_file_write, checksum_file, worker_id
 
 set_offline_env_defaults()
 
@@ -17,6 +24,22 @@ logger = logging.getLogger("vlm")
 BASE_DIR = Path(__file__).resolve().parent.parent
 OUT_DIR = BASE_DIR / "outputs" / "vlm"
 MODEL_DIR = os.environ.get("LLAVA_DIR", str((BASE_DIR / "models" / "llava").resolve()))
+CACHE_DIR = Path(os.environ.get("VLM_CACHE_DIR", str(BASE_DIR / "cache" / "vlm")))
+CACHE_MEM_ITEMS = int(os.environ.get("VLM_CACHE_MEM_ITEMS", "512"))
+CACHE_MAX_MB = int(os.environ.get("VLM_CACHE_MAX_MB", "64"))
+# Each worker process publishes its cache counters here for /metrics/vlm_cache
+STATS_DIR = Path(os.environ.get("VLM_STATS_DIR", str(CACHE_DIR) + ".stats"))
+STATS_STALE_S = float(os.environ.get("VLM_STATS_STALE_S", "300"))  # older files belong to dead workers
+DEFAULT_PROMPT = "Describe the image, list the main objects and transcribe any text."
+# LLaVA-1.5 chat format; {prompt} is the user text
+PROMPT_TEMPLATE = os.environ.get("VLM_PROMPT_TEMPLATE", "USER: <image>\n{prompt} ASSISTANT:")
+DTYPE = os.environ.get("VLM_DTYPE", "auto")  # auto|fp32|bf16|fp16
+THREADS = int(os.environ.get("VLM_THREADS", "0"))  # 0 = torch default
+BATCH = int(os.environ.get("VLM_BATCH", "4"))
+MAX_NEW_TOKENS = int(os.environ.get("VLM_MAX_NEW_TOKENS", "256"))
+PRELOAD = os.environ.get("VLM_PRELOAD", "0") == "1"
+
+JOB_TYPES = ["analyze_image"]
 
 try:
     from transformers import AutoProcessor  # type: ignore
@@ -24,28 +47,367 @@ try:
 except Exception:
     HAVE_TFM = False
 
+try:
+    from transformers import LlavaForConditionalGeneration  # type: ignore
+except Exception:
+    LlavaForConditionalGeneration = None
 
-def analyze_image(path: str) -> Dict[str, Any]:
-    p = Path(path)
-    if not p.exists():
-        raise FileNotFoundError(path)
+try:
+    import torch  # type: ignore
+except Exception:
+    torch = None
 
-    # Real VLM loading would go here with local_files_only=True
-    if HAVE_TFM and Path(MODEL_DIR).exists():
-        # Placeholder logic: we are offline, so avoid real model calls.
-        caption = f"A plausible description of {p.name} (offline placeholder)"
-        objects = ["object1", "object2"]
-        ocr_text = ""
-    else:
-        # Mock mode
-        caption = f"[MOCK VLM] A mock caption for {p.name}"
-        objects = ["mock-object"]
-        ocr_text = "mock-ocr"
+try:
+    from PIL import Image  # type: ignore
+except Exception:
+    Image = None
 
-    return {"caption": caption, "objects": objects, "ocr_text": ocr_text}
 
+class VLMEngine:
+    """LLaVA-style model loaded once per process from `model_dir`.
+    generate() runs a list of images through the model in batches of
+    `batch_size`, one padded forward pass (and one generate call) per batch.
+    """
 
-if __name__ == "__main__":
+    def __init__(self, model_dir: str, dtype: str = DTYPE, threads: int = THREADS, batch_size: int = BATCH):
+        self.model_dir = model_dir
+        self.dtype_name = dtype
+        self.threads = threads
+        self.batch_size = max(1, batch_size)
+        self.processor = None
+        self.model = None
+        self.device = "cpu"
+        self._lock = threading.Lock()
+        self._generate_lock = threading.Lock()
+
+    def available(self) -> bool:
+        return (HAVE_TFM and LlavaForConditionalGeneration is not None and torch is not None
+                and Image is not None and (Path(self.model_dir) / "config.json").exists())
+
+    def _device_and_dtype(self):
+        if torch.cuda.is_available():
+            device = "cuda"
+        elif getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
+            device = "mps"
+        else:
+            device = "cpu"
+        name = self.dtype_name
+        if name == "auto":
+            # fp16 matmuls are slow or unsupported on most CPUs
+            name = "fp32" if device == "cpu" else "fp16"
+        dtype = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[name]
+        return device, dtype
+
+    def load(self) -> None:
+        with self._lock:
+            if self.model is not None:
+                return
+            t0 = time.time()
+            if self.threads > 0:
+                torch.set_num_threads(self.threads)
+            self.device, dtype = self._device_and_dtype()
+            self.processor = AutoProcessor.from_pretrained(self.model_dir, local_files_only=True)
+            # Decoder-only generation needs prompts aligned on the right edge
+            self.processor.tokenizer.padding_side = "left"
+            self.model = LlavaForConditionalGeneration.from_pretrained(
+                self.model_dir, local_files_only=True, torch_dtype=dtype, low_cpu_mem_usage=True
+            ).to(self.device).eval()
+            logger.info(f"VLM loaded from {self.model_dir} on {self.device}/{dtype} in {time.time() - t0:.1f}s")
+
+    def generate(self, paths: Sequence[Path], prompts: Sequence[str]) -> List[str]:
+        """Callers may be threads (inline /analyze_image); one runs the model at a time."""
+        self.load()
+        with self._generate_lock:
+            return self._generate(paths, prompts)
+
+    def _generate(self, paths: Sequence[Path], prompts: Sequence[str]) -> List[str]:
+        out: List[str] = []
+        for i in range(0, len(paths), self.batch_size):
+            images = [Image.open(p).convert("RGB") for p in paths[i:i + self.batch_size]]
+            texts = [PROMPT_TEMPLATE.format(prompt=pr) for pr in prompts[i:i + self.batch_size]]
+            inputs = self.processor(text=texts, images=images, return_tensors="pt", padding=True)
+            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            inputs["pixel_values"] = inputs["pixel_values"].to(self.model.dtype)
+            with torch.inference_mode():
+                ids = self.model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS, do_sample=False)
+            new_tokens = ids[:, inputs["input_ids"].shape[1]:]
+            out.extend(t.strip() for t in self.processor.batch_decode(new_tokens, skip_special_tokens=True))
+        return out
+
+
+ENGINE = VLMEngine(MODEL_DIR)
+
+
+def model_fingerprint(model_dir: str) -> str:
+    """Identity of the weights in `model_dir`: resolved path plus name, size
+    and mtime of its top-level files. Changes when LLAVA_DIR is pointed
+    elsewhere or the checkpoint is replaced."""
+    root = Path(model_dir).resolve()
+    h = hashlib.sha1(str(root).encode("utf-8"))
+    if root.is_dir():
+        for f in sorted(root.iterdir()):
+            if f.is_file():
+                st = f.stat()
+                h.update(f"{f.name}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Two-level LRU of analysis results: an in-memory OrderedDict in front of
+    one JSON file per key under `root`. Disk entries are evicted oldest-first
+    (by mtime, refreshed on hit) once they exceed `max_bytes`. The whole disk
+    cache is dropped when the model fingerprint differs from the one it was
+    built with."""
+
+    def __init__(self, root: Path, mem_items: int, max_bytes: int, fingerprint: str):
+        self.root = Path(root)
+        self.mem_items = mem_items
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint
+        self._mem: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes: Optional[int] = None
+        self.hits = 0
+        self.mem_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._check_fingerprint()
+
+    def _check_fingerprint(self) -> None:
+        marker = self.root / "model.json"
+        try:
+            current = json.loads(marker.read_text(encoding="utf-8")).get("fingerprint")
+        except (OSError, ValueError):
+            current = None
+        if current != self.fingerprint:
+            if self.root.exists():
+                logger.info(f"VLM cache invalidated (model changed): {self.root}")
+                shutil.rmtree(self.root, ignore_errors=True)
+            ensure_dir(self.root)
+            write_json(marker, {"fingerprint": self.fingerprint, "model_dir": MODEL_DIR})
+
+    def key(self, image_hash: str, options: Dict[str, Any]) -> str:
+        blob = json.dumps({"image": image_hash, "model": self.fingerprint, "options": options},
+                          sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def get(self, key: str, image_bytes: int = 0) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            res = self._mem.get(key)
+            if res is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                self.mem_hits += 1
+                self.bytes_saved += image_bytes
+                return dict(res)
+        p = self._path(key)
+        try:
+            res = json.loads(p.read_text(encoding="utf-8"))
+            os.utime(p)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self._remember(key, res)
+            self.hits += 1
+            self.bytes_saved += image_bytes
+        return dict(res)
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        data = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        p = self._path(key)
+        ensure_dir(p.parent)
+        existed = p.stat().st_size if p.exists() else 0
+        safe_file_write(p, data)
+        with self._lock:
+            self._remember(key, result)
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data) - existed
+        self._evict_disk()
+
+    def _remember(self, key: str, result: Dict[str, Any]) -> None:
+        self._mem[key] = dict(result)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_items:
+            self._mem.popitem(last=False)
+
+    def _entries(self) -> list:
+        return [f for f in self.root.glob("*/*.json")]
+
+    def _evict_disk(self) -> None:
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(f.stat().st_size for f in self._entries())
+            if self._disk_bytes <= self.max_bytes:
+                return
+            files = sorted(((f.stat().st_mtime, f.stat().st_size, f) for f in self._entries()), key=lambda e: e[0])
+            for _, size, f in files:
+                if self._disk_bytes <= self.max_bytes:
+                    break
+                try:
+                    f.unlink()
+                except OSError:
+                    continue
+                self._disk_bytes -= size
+                self._mem.pop(f.stem, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "mem_hits": self.mem_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "mem_entries": len(self._mem),
+                "disk_bytes": self._disk_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_cache: Optional[ResultCache] = None
+_cache_lock = threading.Lock()
+
+
+def result_cache() -> ResultCache:
+    """Process-wide cache, created on first use so importing stays cheap."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(CACHE_DIR, CACHE_MEM_ITEMS, CACHE_MAX_MB << 20, model_fingerprint(MODEL_DIR))
+        return _cache
+
+
+def publish_stats(name: str) -> None:
+    """Write this process's cache counters to STATS_DIR as <name>.json."""
+    safe_file_write(STATS_DIR / (re.sub(r"[^\w.-]", "_", name) + ".json"),
+                    json.dumps({**result_cache().stats(), "updated": time.time()}).encode("utf-8"))
+
+
+def cache_stats() -> Dict[str, Any]:
+    """Counters of this process's cache merged with those published by live
+    VLM workers, which do all the lookups for queued analysis."""
+    parts = [result_cache().stats()]
+    now = time.time()
+    for f in sorted(STATS_DIR.glob("*.json")) if STATS_DIR.is_dir() else []:
+        try:
+            st = json.loads(f.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        if now - st.get("updated", 0) > STATS_STALE_S:
+            f.unlink(missing_ok=True)
+            continue
+        parts.append(st)
+    out = {k: sum(p.get(k) or 0 for p in parts) for k in ("hits", "mem_hits", "misses", "bytes_saved", "mem_entries")}
+    lookups = out["hits"] + out["misses"]
+    out["hit_rate"] = round(out["hits"] / lookups, 4) if lookups else 0.0
+    # All processes share one disk cache
+    out["disk_bytes"] = max((p["disk_bytes"] for p in parts if p.get("disk_bytes") is not None), default=None)
+    out["max_bytes"] = parts[0]["max_bytes"]
+    out["processes"] = len(parts)
+    return out
+
+
+def analyze_image(path: str, prompt: Optional[str] = None, image_hash: Optional[str] = None) -> Dict[str, Any]:
+    """Analyze an image, answering from the result cache when the same image
+    was already analyzed with the same model and prompt. Pass `image_hash`
+    (sha256 of the file) when the caller already has it."""
+    return analyze_batch([path], [prompt], [image_hash])[0]
+
+
+def analyze_batch(
+    paths: Sequence[str],
+    prompts: Optional[Sequence[Optional[str]]] = None,
+    image_hashes: Optional[Sequence[Optional[str]]] = None,
+) -> List[Dict[str, Any]]:
+    """analyze_image() for several images; cache misses go to the model together."""
+    n = len(paths)
+    prompts = [pr or DEFAULT_PROMPT for pr in (prompts or [None] * n)]
+    image_hashes = list(image_hashes or [None] * n)
+    cache = result_cache()
+    results: List[Optional[Dict[str, Any]]] = [None] * n
+    misses = []
+    for i, path in enumerate(paths):
+        p = Path(path)
+        if not p.exists():
+            raise FileNotFoundError(path)
+        key = cache.key(image_hashes[i] or checksum_file(p), {"prompt": prompts[i]})
+        results[i] = cache.get(key, p.stat().st_size)
+        if results[i] is None:
+            misses.append((i, p, key))
+    if misses:
+        fresh = _analyze_many([p for _, p, _ in misses], [prompts[i] for i, _, _ in misses])
+        for (i, _, key), res in zip(misses, fresh):
+            cache.put(key, res)
+            results[i] = res
+    return results  # type: ignore[return-value]
+
+
+def _analyze_many(paths: List[Path], prompts: List[str]) -> List[Dict[str, Any]]:
+    if ENGINE.available():
+        texts = ENGINE.generate(paths, prompts)
+        return [{"caption": t, "objects": [], "ocr_text": ""} for t in texts]
+    # Mock mode
+    return [{"caption": f"[MOCK VLM] A mock caption for {p.name}", "objects": ["mock-object"], "ocr_text": "mock-ocr"}
+            for p in paths]
+
+
+def main_loop():
+    jq = JobQueue()
     ensure_dir(OUT_DIR)
-    sample = analyze_image(str(BASE_DIR / "uploads" / "sample.png"))
-    write_json(OUT_DIR / "sample.json", sample)
+    wid = worker_id("vlm")
+    logger.info(f"VLM worker started (offline) id={wid} batch={BATCH}")
+    if PRELOAD and ENGINE.available():
+        ENGINE.load()
+    while True:
+        jobs = jq.dequeue_batch(types=JOB_TYPES, max_items=BATCH, worker_id=wid, block=True, timeout=30)
+        if not jobs:
+            publish_stats(wid)  # keeps the file fresh while idle
+            continue
+        # A missing upload fails its own job, not the whole batch
+        ready = []
+        for jid, type_, pl in jobs:
+            if Path(pl.get("path", "")).is_file():
+                ready.append((jid, type_, pl))
+            else:
+                jq.set_result(jid, "error", {"error": f"image not found: {pl.get('path')}"}, wid)
+        if not ready:
+            continue
+        with ExitStack() as stack:
+            # Keeps the claim leases alive while the batch runs
+            for jid, _, _ in ready:
+                stack.enter_context(jq.control(jid))
+            results = _run_batch(ready)
+        for (jid, _, _), res in zip(ready, results):
+            if isinstance(res, Exception):
+                jq.set_result(jid, "error", {"error": str(res)}, wid)
+                continue
+            write_json(OUT_DIR / f"{jid}.json", {"job_id": jid, "result": res})
+            jq.set_result(jid, "done", res, wid)
+        publish_stats(wid)
+
+
+def _run_batch(ready: List[Any]) -> List[Any]:
+    """Result (or exception) per job; a failed batch is retried job by job."""
+    try:
+        return analyze_batch([pl["path"] for _, _, pl in ready],
+                             [pl.get("prompt") for _, _, pl in ready],
+                             [pl.get("image_sha256") for _, _, pl in ready])
+    except Exception as e:
+        logger.warning(f"batch of {len(ready)} failed ({e}); retrying jobs one by one")
+    results: List[Any] = []
+    for _, _, pl in ready:
+        try:
+            results.append(analyze_image(pl["path"], pl.get("prompt"), pl.get("image_sha256")))
+        except Exception as e1:
+            results.append(e1)
+    return results
+
+
+if __name__ == "__main__":
+    main_loop()
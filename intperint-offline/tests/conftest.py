@@ -1,10 +1,15 @@
 import os
 import sys
+import tempfile
 
 # Ensure offline env for tests
 os.environ.setdefault("HF_HUB_OFFLINE", "1")
 os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
 os.environ.setdefault("DIFFUSERS_OFFLINE", "1")
 os.environ.setdefault("HF_DATASETS_OFFLINE", "1")
+# Keep the API's module-level JobQueue and caches out of the working tree
+_tmp = tempfile.mkdtemp(prefix="intperint-test-")
+os.environ.setdefault("JOBQ_DB", os.path.join(_tmp, "jobs.sqlite3"))
+os.environ.setdefault("VLM_CACHE_DIR", os.path.join(_tmp, "vlm-cache"))
 
 sys.path.insert(0, '.')
@@ -0,0 +1,139 @@
+import sys
+import threading
+import time
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, '.')
+import src.api_server as api  # noqa: E402
+from src.job_queue import JobQueue  # noqa: E402
+
+
+def _finish_later(jid, delay=0.3):
+    def run():
+        time.sleep(delay)
+        worker_q = JobQueue(api.jq.db_path)
+        worker_q.dequeue(types=["generate_image"], worker_id="test")
+        worker_q.set_result(jid, "done", {"images": ["x.png"]}, worker_id="test")
+    t = threading.Thread(target=run)
+    t.start()
+    return t
+
+
+def test_job_status_long_poll_returns_on_change():
+    client = TestClient(api.app)
+    jid = client.post('/generate_image', json={'prompt': 'cat'}).json()['job_id']
+    t = _finish_later(jid)
+    start = time.monotonic()
+    st = client.get(f'/job_status/{jid}', params={'wait': 10}).json()
+    t.join()
+    assert st['status'] in ('running', 'done')
+    assert time.monotonic() - start < 5
+
+
+def test_job_events_streams_until_done():
+    client = TestClient(api.app)
+    jid = client.post('/generate_image', json={'prompt': 'dog'}).json()['job_id']
+    t = _finish_later(jid)
+    events = []
+    with client.stream('GET', f'/jobs/{jid}/events') as r:
+        assert r.headers['content-type'].startswith('text/event-stream')
+        for line in r.iter_lines():
+            if line.startswith('data: '):
+                events.append(line)
+    t.join()
+    assert '"queued"' in events[0]
+    assert '"done"' in events[-1] and 'x.png' in events[-1]
+
+
+def _llm20_client(handler, **kw):
+    import httpx
+    from src.utils import AsyncLocalOnlyClient
+    return AsyncLocalOnlyClient("http://127.0.0.1:8001", backoff_s=0, transport=httpx.MockTransport(handler), **kw)
+
+
+def test_generate_text_draft_streams_from_llm20(monkeypatch):
+    import httpx
+    import json
+
+    def handler(request):
+        body = json.loads(request.content)
+        assert body["stream"] is True
+        lines = [{"op": "token", "jobid": "j", "data": "Hi"}, {"op": "done", "jobid": "j", "exit": 0}]
+        return httpx.Response(200, content="".join(json.dumps(e) + "\n" for e in lines).encode())
+
+    monkeypatch.setattr(api, "llm20", _llm20_client(handler))
+    client = TestClient(api.app)
+    with client.stream('POST', '/generate_text', json={'prompt': 'p', 'stream': True}) as r:
+        events = [json.loads(line) for line in r.iter_lines() if line]
+    assert [e['op'] for e in events] == ['token', 'done']
+
+
+def test_generate_text_draft_503_when_llm20_down(monkeypatch):
+    import httpx
+
+    def handler(request):
+        raise httpx.ConnectError("refused", request=request)
+
+    monkeypatch.setattr(api, "llm20", _llm20_client(handler, retries=0))
+    client = TestClient(api.app)
+    r = client.post('/generate_text', json={'prompt': 'p'})
+    assert r.status_code == 503
+    assert r.json()['error'] == 'llm20_unavailable'
+    assert 'Retry-After' in r.headers
+
+
+def test_analyze_image_content_addressed_and_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "UPLOADS", tmp_path)
+    client = TestClient(api.app)
+    data = b"PNG\n" + b"x" * 5000
+    r1 = client.post('/analyze_image', files={'file': ('a.png', data, 'image/png')}).json()
+    r2 = client.post('/analyze_image', files={'file': ('other-name.png', data, 'image/png')}).json()
+    assert r1['image_sha256'] == r2['image_sha256']
+    assert r1['bytes'] == len(data)
+    assert not r1['deduplicated'] and r2['deduplicated']
+    stored = [p for p in tmp_path.rglob('*.png')]
+    assert len(stored) == 1 and stored[0].name == r1['image_sha256'] + '.png'
+    assert 'caption' in r1
+
+    monkeypatch.setattr(api, "UPLOAD_MAX_BYTES", 1000)
+    r3 = client.post('/analyze_image', files={'file': ('big.png', data, 'image/png')})
+    assert r3.status_code == 413
+    assert not any((tmp_path / '.tmp').iterdir())
+
+
+def test_analyze_image_queue_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "UPLOADS", tmp_path)
+    client = TestClient(api.app)
+    r = client.post('/analyze_image?queue=true', files={'file': ('a.jpg', b'jpeg-bytes', 'image/jpeg')},
+                    data={'prompt': 'Read the sign.'}).json()
+    st = api.jq.status(r['job_id'])
+    assert st['type'] == 'analyze_image' and st['status'] == 'queued'
+    job = api.jq.dequeue(types=['analyze_image'])
+    assert job[2]['prompt'] == 'Read the sign.'
+    assert job[2]['image_sha256'] == r['image_sha256']
+    assert job[2]['path'].endswith(r['image_sha256'] + '.jpg')
+
+
+def test_generate_image_priority():
+    client = TestClient(api.app)
+    r = client.post('/generate_image', json={'prompt': 'p', 'priority': 'high'}).json()
+    assert api.jq.status(r['job_id'])['priority'] == 10
+    assert client.post('/generate_video', json={'prompt': 'p', 'priority': 42}).status_code == 422
+
+
+def test_generate_image_double_submit_attaches():
+    client = TestClient(api.app)
+    body = {'prompt': 'dedupe me', 'params': {'steps': 4}}
+    first = client.post('/generate_image', json=body).json()
+    second = client.post('/generate_image', json=body).json()
+    assert second == {'job_id': first['job_id'], 'dedupe': 'attached'}
+    third = client.post('/generate_image', json={**body, 'dedupe': False}).json()
+    assert third['job_id'] != first['job_id']
+
+
+def test_generate_image_dedupe_keyed_on_model(monkeypatch):
+    client = TestClient(api.app)
+    body = {'prompt': 'same prompt, other model', 'params': {'steps': 4}}
+    first = client.post('/generate_image', json=body).json()
+    monkeypatch.setattr(api, 'SDXL_MODEL_DIR', '/models/other-sdxl')
+    assert client.post('/generate_image', json=body).json()['job_id'] != first['job_id']
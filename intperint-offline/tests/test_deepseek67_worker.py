@@ -0,0 +1,106 @@
+import sys
+import time
+sys.path.insert(0, '.')
+import src.deepseek67_worker as dw  # noqa: E402
+
+
+class CountingLlama:
+    loads = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingLlama.loads += 1
+        assert kwargs.get("use_mmap") is True
+
+    def __call__(self, prompt, **kwargs):
+        if kwargs.get("stream"):
+            return ({"choices": [{"text": t}]} for t in ("REPLY:", prompt))
+        return {"choices": [{"text": f"REPLY:{prompt}"}]}
+
+
+def test_resident_model_loads_once(tmp_path, monkeypatch):
+    model = tmp_path / "m.gguf"
+    model.write_bytes(b"GGUF")
+    monkeypatch.setattr(dw, "Llama", CountingLlama)
+    monkeypatch.setattr(dw, "MODEL", str(model))
+    monkeypatch.setattr(dw, "RESIDENT", dw.ResidentModel(str(model), idle_unload_s=60))
+    CountingLlama.loads = 0
+
+    first = dw.process_job("j1", {"prompt": "a"})
+    second = dw.process_job("j2", {"prompt": "b"})
+    assert first["text"] == "REPLY:a" and second["text"] == "REPLY:b"
+    assert CountingLlama.loads == 1
+    assert first["metrics"]["source"] == "resident"
+    assert second["metrics"]["load_s"] == 0.0
+
+    assert not dw.RESIDENT.unload_if_idle()
+    dw.RESIDENT.idle_unload_s = 0.01
+    time.sleep(0.02)
+    assert dw.RESIDENT.unload_if_idle()
+    assert not dw.RESIDENT.loaded
+
+
+def test_mock_without_model(monkeypatch):
+    monkeypatch.setattr(dw, "MODEL", "/nonexistent/model.gguf")
+    res = dw.process_job("j", {"prompt": "hello"})
+    assert res["text"].startswith("[MOCK 67B]")
+
+
+def test_cancel_stops_resident_generation(tmp_path, monkeypatch):
+    from src.job_queue import JobQueue, JobCancelled
+    model = tmp_path / "m.gguf"
+    model.write_bytes(b"GGUF")
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    jid = jq.enqueue("generate_text_heavy", {"prompt": "x", "max_tokens": 1000})
+    jq.dequeue()
+    produced = []
+
+    class EndlessLlama(CountingLlama):
+        def __call__(self, prompt, **kwargs):
+            for i in range(kwargs["max_tokens"]):
+                produced.append(i)
+                if i == 3:
+                    jq.cancel(jid)
+                    time.sleep(0.2)  # let the watcher pick up the cancel event
+                yield {"choices": [{"text": "t"}]}
+
+    monkeypatch.setattr(dw, "Llama", EndlessLlama)
+    monkeypatch.setattr(dw, "MODEL", str(model))
+    monkeypatch.setattr(dw, "RESIDENT", dw.ResidentModel(str(model), idle_unload_s=60))
+    with jq.control(jid) as ctl:
+        ctl.min_interval_s = 0
+        try:
+            dw.process_job(jid, {"prompt": "x", "max_tokens": 1000}, ctl)
+            raise AssertionError("not cancelled")
+        except JobCancelled:
+            pass
+    assert len(produced) <= 5
+    st = jq.status(jid)
+    assert st["status"] == "cancelled"
+    assert st["progress"]["step"] == 3 and st["progress"]["phase"] == "generate"
+    jq.set_result(jid, "done", {})
+    assert jq.status(jid)["status"] == "cancelled"
+
+
+def test_cancel_kills_cli_child(tmp_path, monkeypatch):
+    from src.job_queue import JobQueue, JobCancelled
+    model = tmp_path / "m.gguf"
+    model.write_bytes(b"GGUF")
+    cli = tmp_path / "main"
+    cli.write_text("#!/bin/sh\nexec sleep 30\n")
+    cli.chmod(0o755)
+    monkeypatch.setattr(dw, "Llama", None)
+    monkeypatch.setattr(dw, "MODEL", str(model))
+    monkeypatch.setattr(dw, "LLAMA_CPP_MAIN", str(cli))
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    jid = jq.enqueue("generate_text_heavy", {"prompt": "x"})
+    jq.dequeue()
+    import threading
+    threading.Timer(0.3, jq.cancel, args=(jid,)).start()
+    t0 = time.monotonic()
+    with jq.control(jid) as ctl:
+        try:
+            dw.process_job(jid, {"prompt": "x"}, ctl)
+            raise AssertionError("not cancelled")
+        except JobCancelled:
+            pass
+    assert time.monotonic() - t0 < 5
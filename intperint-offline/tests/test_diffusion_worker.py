@@ -7,3 +7,179 @@ def test_txt2img_mock(tmp_path):
     paths = dw.txt2img('a prompt', tmp_path)
     assert len(paths) >= 1
     assert tmp_path.exists()
+
+
+class FakePipeline:
+    loads = 0
+    events = []
+
+    @classmethod
+    def from_pretrained(cls, model_dir, **kwargs):
+        assert kwargs.get("local_files_only") is True
+        cls.loads += 1
+        cls.events.append("load")
+        p = cls()
+        p.model_dir = model_dir
+        return p
+
+    def to(self, device):
+        return self
+
+
+def test_pipeline_cache_reuses_and_evicts(monkeypatch):
+    import src.diffusion_worker as dw
+    monkeypatch.setattr(dw, "DiffusionPipeline", FakePipeline)
+    monkeypatch.setattr(dw, "_release_device_memory", lambda: FakePipeline.events.append("release"))
+    FakePipeline.loads = 0
+    FakePipeline.events = []
+    cache = dw.PipelineCache(max_size=1)
+    a = cache.get("sdxl", "fp32", "cpu")
+    assert cache.get("sdxl", "fp32", "cpu") is a
+    assert FakePipeline.loads == 1
+    b = cache.get("other", "fp32", "cpu")
+    assert b is not a and len(cache) == 1
+    assert cache.get("sdxl", "fp32", "cpu") is not a
+    assert FakePipeline.loads == 3
+    # The old pipeline is gone and memory released before the next load
+    assert FakePipeline.events == ["load", "release", "load", "release", "load"]
+
+
+class FakeImage:
+    def __init__(self, tag):
+        self.tag = tag
+
+    def save(self, path):
+        with open(path, "w") as f:
+            f.write(self.tag)
+
+
+class FakeBatchPipe:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, prompt, num_inference_steps, guidance_scale, generator, **kw):
+        self.calls.append({"prompt": prompt, "steps": num_inference_steps, "guidance": guidance_scale, **kw})
+
+        class Out:
+            images = [FakeImage(f"{p}|{g}") for p, g in zip(prompt, generator)]
+        return Out()
+
+
+def test_txt2img_batch_coalesces_jobs_with_per_job_seeds(tmp_path, monkeypatch):
+    import src.diffusion_worker as dw
+    from src.diffusion_params import image_params, image_batch_key
+    pipe = FakeBatchPipe()
+    monkeypatch.setattr(dw, "_have_model", lambda: True)
+    monkeypatch.setattr(dw, "_device_and_dtype", lambda: ("cpu", "fp32"))
+    monkeypatch.setattr(dw, "_generator", lambda device, seed: seed)
+    monkeypatch.setattr(dw.PIPELINES, "get", lambda *a: pipe)
+    monkeypatch.setattr(dw, "MAX_BATCH_IMAGES", 4)
+
+    a = image_params({"width": 1030, "height": 768, "steps": 8, "seed": 100, "num_images_per_prompt": 2})
+    b = image_params({"width": 1024, "height": 768, "steps": 8, "seed": 7, "num_images": 3})
+    assert a["width"] == 1024 and image_batch_key(a) == image_batch_key(b)
+    assert image_batch_key(a) != image_batch_key(image_params({"width": 512, "height": 768, "steps": 8}))
+
+    res = dw.txt2img_batch([("cat", a, tmp_path / "a"), ("dog", b, tmp_path / "b")])
+    assert [len(r) for r in res] == [2, 3]
+    # Five images, at most four per UNet batch
+    assert [c["prompt"] for c in pipe.calls] == [["cat", "cat", "dog", "dog"], ["dog"]]
+    assert pipe.calls[0]["width"] == 1024 and pipe.calls[0]["steps"] == 8
+    assert [open(p).read() for p in res[1]] == ["dog|7", "dog|8", "dog|9"]
+    assert [open(p).read() for p in res[0]] == ["cat|100", "cat|101"]
+
+
+def test_txt2img_mock_honors_num_images(tmp_path):
+    import src.diffusion_worker as dw
+    assert len(dw.txt2img('a prompt', tmp_path, num_images_per_prompt=3)) == 3
+
+
+FAKE_FFMPEG = """#!/usr/bin/env python3
+import sys
+data = sys.stdin.buffer.read()
+size = sys.argv[sys.argv.index("-s") + 1]
+with open(sys.argv[-1], "w") as f:
+    f.write(f"{size} {len(data)}")
+"""
+
+
+def test_txt2video_pipes_frames_into_encoder(tmp_path, monkeypatch):
+    import numpy as np
+    import src.diffusion_worker as dw
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text(FAKE_FFMPEG)
+    ffmpeg.chmod(0o755)
+    calls = []
+
+    class FakeAnimPipe:
+        def __call__(self, prompt, num_frames, width, height, **kw):
+            calls.append(num_frames)
+
+            class Out:
+                frames = np.full((1, num_frames, height, width, 3), 0.5, dtype=np.float32)
+            return Out()
+
+    monkeypatch.setattr(dw, "FFMPEG_BIN", str(ffmpeg))
+    monkeypatch.setattr(dw, "_device_and_dtype", lambda: ("cpu", "fp32"))
+    monkeypatch.setattr(dw, "_generator", lambda device, seed: seed)
+    monkeypatch.setattr(dw.VIDEO_PIPELINES, "get", lambda *a, **kw: FakeAnimPipe())
+
+    out = tmp_path / "videos" / "job1.mp4"
+    res = dw.txt2video("a cat", out, {"num_frames": 6, "width": 256, "height": 264, "seed": 3})
+    assert calls == [6]  # all frames in one pipeline call
+    assert out.read_text() == f"256x264 {6 * 256 * 264 * 3}"
+    assert res["video"] == str(out) and res["seed"] == 3
+    # The per-job work dir is gone and no frame images were written
+    assert [p.name for p in out.parent.iterdir()] == ["job1.mp4"]
+
+
+def test_step_callback_reports_and_aborts_when_all_cancelled(tmp_path):
+    import src.diffusion_worker as dw
+    from src.job_queue import JobQueue, JobCancelled
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    a = jq.enqueue("generate_image", {}, batch_key="k")
+    b = jq.enqueue("generate_image", {}, batch_key="k")
+    jq.dequeue_batch(max_items=2)
+    with jq.control(a) as ca, jq.control(b) as cb:
+        ca.min_interval_s = cb.min_interval_s = 0
+        cb_fn = dw._step_callback([ca, cb], total=10)
+        assert cb_fn(None, 0, None, {"k": 1}) == {"k": 1}
+        assert jq.status(a)["progress"] == {"phase": "denoise", "step": 1, "total": 10, "fraction": 0.1}
+        ca._fire()  # as if the cancel event arrived
+        cb_fn(None, 1, None, {})
+        assert jq.status(b)["progress"]["step"] == 2
+        cb._fire()
+        try:
+            cb_fn(None, 2, None, {})
+            raise AssertionError("expected JobCancelled")
+        except JobCancelled:
+            pass
+
+
+def test_frame_encoder_kills_ffmpeg_on_timeout(tmp_path, monkeypatch):
+    import subprocess
+    import src.diffusion_worker as dw
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text("#!/usr/bin/env python3\nimport sys, time\nsys.stdin.buffer.read()\ntime.sleep(60)\n")
+    ffmpeg.chmod(0o755)
+    monkeypatch.setattr(dw, "FFMPEG_BIN", str(ffmpeg))
+    enc = dw.FrameEncoder(tmp_path / "out.mp4", 2, 2, 8)
+    enc.write(b"\0" * 12)
+    try:
+        enc.close(timeout=0.5)
+        raise AssertionError("expected TimeoutExpired")
+    except subprocess.TimeoutExpired:
+        pass
+    assert enc._proc.returncode is not None
+
+
+def test_mock_video_frames_progress_reaches_total(tmp_path):
+    import src.diffusion_worker as dw
+    from src.job_queue import JobQueue
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    jid = jq.enqueue("generate_video", {})
+    jq.dequeue()
+    with jq.control(jid) as ctl:
+        ctl.min_interval_s = 0
+        assert len(dw.generate_video_frames("p", tmp_path / "frames", num_frames=4, ctl=ctl)) == 4
+    assert jq.status(jid)["progress"] == {"phase": "frames", "step": 4, "total": 4, "fraction": 1.0}
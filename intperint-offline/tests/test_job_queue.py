@@ -0,0 +1,269 @@
+import sys
+import threading
+sys.path.insert(0, '.')
+
+from src.job_queue import JobQueue  # noqa: E402
+
+
+def test_dequeue_filters_by_type(tmp_path):
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    img = jq.enqueue("generate_image", {"prompt": "cat"})
+    txt = jq.enqueue("generate_text_heavy", {"prompt": "hi"})
+
+    item = jq.dequeue(types=["generate_text_heavy"], worker_id="llm-1")
+    assert item is not None
+    assert item[0] == txt
+    assert jq.dequeue(types=["generate_text_heavy"]) is None
+
+    st = jq.status(txt)
+    assert st["status"] == "running"
+    assert st["worker_id"] == "llm-1"
+    assert jq.status(img)["status"] == "queued"
+
+
+def test_concurrent_claims_are_unique(tmp_path):
+    db = tmp_path / "q.sqlite3"
+    jq = JobQueue(db)
+    ids = {jq.enqueue("generate_image", {"i": i}) for i in range(40)}
+    claimed = []
+    lock = threading.Lock()
+
+    def worker(n):
+        q = JobQueue(db)
+        while True:
+            item = q.dequeue(types=["generate_image"], worker_id=f"w{n}")
+            if item is None:
+                return
+            with lock:
+                claimed.append(item[0])
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(claimed) == sorted(ids)
+
+
+def test_pool_uses_wal_and_reuses_connections(tmp_path):
+    jq = JobQueue(tmp_path / "q.sqlite3", pool_size=2)
+    with jq._conn() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        first = conn
+    jid = jq.enqueue("generate_image", {})
+    assert jq.status(jid)["status"] == "queued"
+    with jq._conn() as conn:
+        assert conn is first
+    jq.close()
+
+
+def test_blocking_dequeue_wakes_on_enqueue(tmp_path, monkeypatch):
+    import time
+    import src.job_queue as jqmod
+    # Make the polling fallback too slow to explain a fast wakeup
+    monkeypatch.setattr(jqmod, "POLL_INTERVAL", 30.0)
+    db = tmp_path / "q.sqlite3"
+    producer = JobQueue(db)
+    got = {}
+
+    def worker():
+        got["item"] = JobQueue(db).dequeue(types=["generate_image"], block=True, timeout=10)
+        got["t"] = time.monotonic()
+
+    t = threading.Thread(target=worker)
+    t.start()
+    time.sleep(0.2)
+    producer.enqueue("generate_text_heavy", {})  # other type: must not be claimed
+    start = time.monotonic()
+    jid = producer.enqueue("generate_image", {})
+    t.join(5)
+    assert got["item"][0] == jid
+    assert got["t"] - start < 1.0
+
+
+def test_blocking_dequeue_times_out(tmp_path):
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    assert jq.dequeue(types=["generate_image"], block=True, timeout=0.2) is None
+
+
+def test_dequeue_batch_groups_by_type_and_key(tmp_path):
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    a1 = jq.enqueue("generate_image", {"i": 1}, batch_key="sdxl-1024")
+    jq.enqueue("generate_image", {"i": 2}, batch_key="sdxl-512")
+    jq.enqueue("analyze_image", {"i": 3})
+    a4 = jq.enqueue("generate_image", {"i": 4}, batch_key="sdxl-1024")
+    a5 = jq.enqueue("generate_image", {"i": 5}, batch_key="sdxl-1024")
+
+    batch = jq.dequeue_batch(types=["generate_image"], max_items=2, worker_id="w")
+    assert [b[0] for b in batch] == [a1, a4]
+    assert all(jq.status(b[0])["status"] == "running" for b in batch)
+    batch = jq.dequeue_batch(types=["generate_image"], max_items=8)
+    assert [b[2]["i"] for b in batch] == [2]
+    assert [b[0] for b in jq.dequeue_batch(types=["generate_image"], max_items=8)] == [a5]
+    assert [b[2]["i"] for b in jq.dequeue_batch(max_items=8)] == [3]
+    assert jq.dequeue_batch(max_items=8) == []
+
+
+def test_dequeue_batch_needs_a_key_and_batch_type(tmp_path):
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    # Key-less jobs may differ in size/steps: never claimed together
+    a = jq.enqueue("generate_image", {"w": 512})
+    b = jq.enqueue("generate_image", {"w": 1024})
+    assert [x[0] for x in jq.dequeue_batch(max_items=4)] == [a]
+    assert [x[0] for x in jq.dequeue_batch(max_items=4)] == [b]
+    v = [jq.enqueue("generate_video", {}, batch_key="v") for _ in range(3)]
+    i = [jq.enqueue("generate_image", {}, batch_key="k") for _ in range(2)]
+    kinds = ["generate_image"]
+    assert [x[0] for x in jq.dequeue_batch(max_items=4, batch_types=kinds)] == v[:1]
+    assert [x[0] for x in jq.dequeue_batch(max_items=4, batch_types=kinds)] == v[1:2]
+    jq.dequeue_batch(max_items=4, batch_types=kinds)
+    assert [x[0] for x in jq.dequeue_batch(max_items=4, batch_types=kinds)] == i
+
+
+def test_priority_order_and_aging(tmp_path):
+    import src.job_queue as jqmod
+    jq = JobQueue(tmp_path / "q.sqlite3", aging_s=0)
+    low = jq.enqueue("generate_image", {}, priority="low")
+    normal = jq.enqueue("generate_image", {})
+    high = jq.enqueue("generate_image", {}, priority=10)
+    assert [jq.dequeue()[0] for _ in range(3)] == [high, normal, low]
+    try:
+        jq.enqueue("generate_image", {}, priority="urgent")
+        raise AssertionError("expected ValueError")
+    except ValueError:
+        pass
+
+    aged = JobQueue(tmp_path / "q2.sqlite3", aging_s=60)
+    old_low = aged.enqueue("generate_image", {}, priority="low")
+    with aged._conn() as conn:  # queued 10 minutes ago: +10 levels
+        conn.execute("UPDATE jobs SET created=created-600 WHERE id=?", (old_low,))
+    fresh_high = aged.enqueue("generate_image", {}, priority="high")
+    assert aged.dequeue()[0] == old_low
+    assert aged.dequeue()[0] == fresh_high
+    assert aged.status(fresh_high)["priority"] == jqmod.PRIORITY_CLASSES["high"]
+
+
+def test_concurrency_caps_at_claim_time(tmp_path):
+    from src.job_queue import parse_caps
+    jq = JobQueue(tmp_path / "q.sqlite3", caps=parse_caps("generate_video=1", max_gpu_jobs=3))
+    v1 = jq.enqueue("generate_video", {})
+    jq.enqueue("generate_video", {})
+    imgs = [jq.enqueue("generate_image", {}, batch_key="k") for _ in range(4)]
+    assert jq.dequeue()[0] == v1
+    # Second video is capped; the GPU group has room for two more jobs
+    batch = jq.dequeue_batch(max_items=4)
+    assert [b[0] for b in batch] == imgs[:2]
+    assert jq.dequeue() is None
+    jq.set_result(v1, "done", {})
+    assert jq.dequeue()[1] == "generate_video"
+    assert jq.dequeue(types=["generate_image"]) is None
+
+
+def test_expired_lease_requeues_with_backoff_then_fails(tmp_path, monkeypatch):
+    import time
+    import src.job_queue as jqmod
+    monkeypatch.setattr(jqmod, "LEASE_S", 0.05)
+    monkeypatch.setattr(jqmod, "REAP_INTERVAL", 0)
+    monkeypatch.setattr(jqmod, "RETRY_BACKOFF_S", 0.2)
+    monkeypatch.setattr(jqmod, "MAX_ATTEMPTS", 2)
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    jid = jq.enqueue("generate_image", {})
+    assert jq.dequeue(worker_id="dead")[0] == jid
+    time.sleep(0.1)  # worker "crashed": no heartbeat
+    assert jq.dequeue() is None  # requeued, but still backing off
+    st = jq.status(jid)
+    assert st["status"] == "queued" and st["attempts"] == 1 and st["worker_id"] is None
+    # Nor is it picked up as a batch peer of a fresh job during the backoff
+    fresh = jq.enqueue("generate_image", {}, batch_key="k")
+    with jq._conn() as conn:
+        conn.execute("UPDATE jobs SET batch_key='k' WHERE id=?", (jid,))
+    assert [b[0] for b in jq.dequeue_batch(max_items=2, worker_id="w3")] == [fresh]
+    jq.set_result(fresh, "done", {}, worker_id="w3")
+    assert jq.status(fresh)["status"] == "done"
+    time.sleep(0.25)
+    assert jq.dequeue(worker_id="w2")[0] == jid
+    # The crashed first attempt can't overwrite the retry's result
+    jq.set_result(jid, "done", {"stale": True}, worker_id="dead")
+    assert jq.status(jid)["status"] == "running"
+    time.sleep(0.1)
+    assert jq.reap_expired() == 1
+    st = jq.status(jid)
+    assert st["status"] == "error" and "2 attempts" in st["result"]["error"]
+
+
+def test_heartbeat_keeps_lease(tmp_path, monkeypatch):
+    import time
+    import src.job_queue as jqmod
+    monkeypatch.setattr(jqmod, "LEASE_S", 0.3)
+    monkeypatch.setattr(jqmod, "REAP_INTERVAL", 0)
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    jid = jq.enqueue("generate_image", {})
+    jq.dequeue()
+    with jqmod.JobControl(jq, jid, lease_s=0.3):
+        time.sleep(0.8)
+        assert jq.reap_expired() == 0
+    assert jq.status(jid)["status"] == "running"
+
+
+def test_compact_moves_finished_jobs_to_archive(tmp_path):
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    done = jq.enqueue("generate_image", {"p": 1})
+    queued = jq.enqueue("generate_image", {"p": 2})
+    jq.dequeue()
+    jq.set_result(done, "done", {"images": ["a.png"]})
+    assert jq.compact(retain_s=3600) == 0
+    assert jq.compact(retain_s=-1, batch=1) == 1
+    with jq._conn() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 1
+    st = jq.status(done)
+    assert st["status"] == "done" and st["result"] == {"images": ["a.png"]}
+    assert jq.status(queued)["status"] == "queued"
+
+
+def test_submit_attaches_and_serves_cached_results(tmp_path):
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    payload = {"prompt": "cat", "params": {"seed": 1, "steps": 20}}
+    jid, how = jq.submit("generate_image", payload, cacheable=True, priority="low")
+    assert how == "new"
+    # Same payload with another key order: attaches, and bumps priority
+    same = {"params": {"steps": 20, "seed": 1}, "prompt": "cat"}
+    assert jq.submit("generate_image", same, cacheable=True, priority="high") == (jid, "attached")
+    assert jq.status(jid)["priority"] == 10
+    assert jq.enqueue("generate_image", same, dedupe=True) == jid
+
+    jq.dequeue()
+    img = tmp_path / "out.png"
+    img.write_bytes(b"PNG")
+    jq.set_result(jid, "done", {"images": [str(img)]})
+    assert jq.submit("generate_image", same, cacheable=True) == (jid, "cached")
+    # Not cacheable (no fixed seed) or past the TTL: a new job
+    new_id, how = jq.submit("generate_image", same)
+    assert how == "new"
+    jq.cancel(new_id)
+    assert jq.submit("generate_image", same, cacheable=True, cache_ttl_s=-1)[1] == "new"
+
+
+def test_mock_results_are_not_cached(tmp_path):
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    payload = {"prompt": "hi", "seed": 7}
+    jid, _ = jq.submit("generate_text_heavy", payload, cacheable=True)
+    jq.dequeue(worker_id="w")
+    jq.set_result(jid, "done", {"text": "[MOCK 67B] hi"}, "w", cacheable=False)
+    assert jq.status(jid)["status"] == "done"
+    new_id, how = jq.submit("generate_text_heavy", payload, cacheable=True)
+    assert how == "new" and new_id != jid
+
+
+def test_cached_result_needs_output_files_and_respects_eviction(tmp_path):
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    a, _ = jq.submit("generate_image", {"p": "a"}, cacheable=True)
+    b, _ = jq.submit("generate_image", {"p": "b"}, cacheable=True)
+    for jid in (a, b):
+        jq.dequeue()
+    img = tmp_path / "a.png"
+    img.write_bytes(b"PNG")
+    jq.set_result(a, "done", {"images": [str(img)]})
+    jq.set_result(b, "done", {"images": [str(tmp_path / "gone.png")]})
+    assert jq.submit("generate_image", {"p": "b"}, cacheable=True)[1] == "new"
+    assert jq.evict_result_cache(max_entries=0) == 2
+    assert jq.submit("generate_image", {"p": "a"}, cacheable=True)[1] == "new"
@@ -20,3 +20,88 @@ def test_gen_mock():
     data = r.json()
     assert 'text' in data
     assert 'MOCK_REPLY:' in data['text']
+
+
+class MockStreamingLlama:
+    def __call__(self, prompt, stream=False, **kwargs):
+        assert stream
+        return iter([{"choices": [{"text": t}]} for t in ("Hel", "lo", "!")])
+
+
+def test_gen_stream_ndjson():
+    import json
+    svc.LLM = MockStreamingLlama()
+    client = TestClient(svc.app)
+    with client.stream('POST', '/gen', json={'prompt': 'hi', 'stream': True}) as r:
+        assert r.status_code == 200
+        events = [json.loads(line) for line in r.iter_lines() if line]
+    assert [e['op'] for e in events] == ['token', 'token', 'token', 'done']
+    assert ''.join(e['data'] for e in events if e['op'] == 'token') == 'Hello!'
+    assert events[-1]['exit'] == 0
+    assert len({e['jobid'] for e in events}) == 1
+
+
+def test_gen_rejects_over_capacity(monkeypatch):
+    svc.LLM = MockLlama()
+    monkeypatch.setattr(svc, "INFER", svc.InferenceQueue(workers=1, max_queued=0))
+    assert svc.INFER.try_admit()  # occupy the only slot
+    client = TestClient(svc.app)
+    r = client.post('/gen', json={'prompt': 'x'})
+    assert r.status_code == 429
+    assert r.headers['X-Queue-Depth'] == '1'
+    assert int(r.headers['Retry-After']) >= 1
+
+
+def test_gen_reports_queue_and_compute_time():
+    svc.LLM = MockLlama()
+    client = TestClient(svc.app)
+    data = client.post('/gen', json={'prompt': 'x'}).json()
+    assert data['queue_ms'] >= 0 and data['compute_ms'] >= 0
+    assert client.get('/health').json()['queue_depth'] == 0
+
+
+class EchoEngine:
+    """Batch engine that replays the prompt's characters, then EOS (token 0)."""
+    n_slots = 2
+    n_ctx_per_slot = 64
+
+    def tokenize(self, text):
+        return [ord(c) for c in text]
+
+    def token_bytes(self, tok):
+        return chr(tok).encode()
+
+    def is_eog(self, tok):
+        return tok == 0
+
+    def eval(self, entries):
+        import numpy as np
+        out = {}
+        for slot, toks, pos in entries:
+            logits = np.zeros(128, dtype=np.float32)
+            self.seqs = getattr(self, "seqs", {})
+            if pos == 0:
+                self.seqs[slot] = list(toks)
+            src = self.seqs[slot]
+            nxt = pos + len(toks) - len(src)
+            logits[src[nxt] if nxt < len(src) else 0] = 1.0
+            out[slot] = logits
+        return out
+
+    def clear(self, slot):
+        pass
+
+
+def test_gen_uses_batch_scheduler(monkeypatch):
+    import json
+    from src.llm_batch import BatchScheduler
+    monkeypatch.setattr(svc, "BATCHER", BatchScheduler(EchoEngine(), window_s=0.0))
+    monkeypatch.setattr(svc, "INFER", svc.InferenceQueue(workers=2, max_queued=2))
+    client = TestClient(svc.app)
+    data = client.post('/gen', json={'prompt': 'abc', 'temperature': 0}).json()
+    assert data['text'] == 'abc'
+    with client.stream('POST', '/gen', json={'prompt': 'xy', 'temperature': 0, 'stream': True}) as r:
+        events = [json.loads(line) for line in r.iter_lines() if line]
+    assert ''.join(e['data'] for e in events if e['op'] == 'token') == 'xy'
+    assert events[-1]['op'] == 'done' and events[-1]['exit'] == 0
+    assert svc.INFER.depth == 0
@@ -0,0 +1,160 @@
+import sys
+import threading
+import numpy as np
+
+sys.path.insert(0, '.')
+from src.llm_batch import BatchRequest, BatchScheduler  # noqa: E402
+
+EOS = 0
+VOCAB = 16
+
+
+class FakeEngine:
+    """Each prompt char c becomes token ord(c) % VOCAB; the 'model' then counts
+    up by one per step until it reaches 15, then emits EOS."""
+    n_slots = 4
+    n_ctx_per_slot = 64
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.cleared = []
+
+    def tokenize(self, text):
+        return [max(1, ord(c) % VOCAB) for c in text]
+
+    def token_bytes(self, tok):
+        return format(tok, "x").encode()
+
+    def is_eog(self, tok):
+        return tok == EOS
+
+    def eval(self, entries):
+        self.batch_sizes.append(len(entries))
+        out = {}
+        for slot, toks, _ in entries:
+            logits = np.zeros(VOCAB, dtype=np.float32)
+            nxt = toks[-1] + 1
+            logits[nxt if nxt < VOCAB else EOS] = 1.0
+            out[slot] = logits
+        return out
+
+    def clear(self, slot):
+        self.cleared.append(slot)
+
+
+def _run(sched, prompts, max_tokens=32):
+    results = {}
+    done = threading.Event()
+
+    def make_cb(i):
+        def on_done(text, error, queue_s, compute_s):
+            results[i] = (text, error)
+            if len(results) == len(prompts):
+                done.set()
+        return on_done
+
+    for i, p in enumerate(prompts):
+        sched.submit(BatchRequest(p, max_tokens, 0.0, [], make_cb(i)))
+    assert done.wait(5)
+    return results
+
+
+def test_concurrent_requests_share_decode_steps():
+    engine = FakeEngine()
+    sched = BatchScheduler(engine, window_s=0.05)
+    # chr(10) -> token 10 -> "bcdef"; chr(12) -> "def"
+    res = _run(sched, ["\n", "\x0c", "\n"])
+    assert res == {0: ("bcdef", None), 1: ("def", None), 2: ("bcdef", None)}
+    assert max(engine.batch_sizes) >= 2
+    assert sched.max_active >= 2
+    assert len(engine.cleared) == 3
+
+
+def test_max_tokens_and_stop_strings():
+    engine = FakeEngine()
+    sched = BatchScheduler(engine, window_s=0.0)
+    res = _run(sched, ["\x01"], max_tokens=3)
+    assert res[0] == ("234", None)
+
+    out = {}
+    ev = threading.Event()
+    tokens = []
+
+    def on_done(text, error, q, c):
+        out["text"] = text
+        ev.set()
+
+    sched.submit(BatchRequest("\x01", 32, 0.0, ["56"], on_done, on_token=tokens.append))
+    assert ev.wait(5)
+    assert out["text"] == "234"
+    assert "".join(tokens) == "234"
+
+
+def test_more_requests_than_slots():
+    engine = FakeEngine()
+    sched = BatchScheduler(engine, window_s=0.01)
+    prompts = [chr(c) for c in range(1, 11)]
+    res = _run(sched, prompts)
+    assert len(res) == 10 and all(err is None for _, err in res.values())
+    assert max(engine.batch_sizes) <= engine.n_slots
+
+
+def test_long_prompt_truncation_keeps_first_token():
+    class RecordingEngine(FakeEngine):
+        prefills = []
+
+        def eval(self, entries):
+            self.prefills.extend(toks for _, toks, pos in entries if pos == 0)
+            return super().eval(entries)
+
+    engine = RecordingEngine()
+    sched = BatchScheduler(engine, window_s=0.0)
+    # 101 prompt tokens, room for 64 - 4 = 60 of them
+    res = _run(sched, ["\x03" + "\x01" * 99 + "\x05"], max_tokens=4)
+    assert res[0] == ("6789", None)
+    assert engine.prefills[0] == [3] + [1] * 58 + [5]
+
+
+class StateEngine(FakeEngine):
+    def __init__(self):
+        super().__init__()
+        self.starts = []
+        self.loaded = []
+
+    def eval(self, entries):
+        self.starts.extend(pos for _, _, pos in entries)
+        return super().eval(entries)
+
+    def save_seq(self, slot):
+        return b"kv" * 100
+
+    def load_seq(self, slot, data, n_keep):
+        self.loaded.append(n_keep)
+        return True
+
+
+def test_prefix_cache_skips_shared_prefix():
+    from src.llm_batch import PrefixCache
+    engine = StateEngine()
+    cache = PrefixCache(budget_bytes=10_000, block=16)
+    sched = BatchScheduler(engine, window_s=0.0, prefix_cache=cache)
+    system = "\x01" * 40  # shared "system prompt"
+    _run(sched, [system + "\x02\x03"], max_tokens=2)
+    assert cache.stats()["misses"] == 1 and cache.stats()["entries"] == 1
+    engine.starts.clear()
+    _run(sched, [system + "\x05\x06\x07"], max_tokens=2)
+    # 40 shared tokens -> 32 reusable (2 blocks of 16); only the rest is evaluated
+    assert engine.loaded == [32]
+    assert engine.starts[0] == 32
+    assert cache.stats()["hits"] == 1 and cache.stats()["tokens_saved"] == 32
+
+
+def test_prefix_cache_budget_evicts_lru():
+    from src.llm_batch import PrefixCache
+    cache = PrefixCache(budget_bytes=250, block=4)
+    a, b, c = [1] * 9, [2] * 9, [3] * 9
+    for toks in (a, b, c):
+        cache.store(toks, lambda: b"x" * 100)
+    assert cache.stats()["entries"] == 2 and cache.bytes == 200
+    assert cache.lookup(a) is None
+    assert cache.lookup(c)[0] == 8
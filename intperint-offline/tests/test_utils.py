@@ -0,0 +1,93 @@
+import asyncio
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, '.')
+from src.utils import AsyncLocalOnlyClient, CircuitOpenError  # noqa: E402
+
+
+def test_async_client_rejects_external_urls():
+    with pytest.raises(RuntimeError):
+        AsyncLocalOnlyClient("http://example.com")
+
+
+def test_async_client_retries_connect_errors_then_succeeds():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        if len(calls) < 2:
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200, json={"text": "ok"})
+
+    async def run():
+        c = AsyncLocalOnlyClient("http://127.0.0.1:8001", backoff_s=0, transport=httpx.MockTransport(handler))
+        r = await c.post("/gen", json={})
+        await c.aclose()
+        return r.json()
+
+    assert asyncio.run(run()) == {"text": "ok"}
+    assert calls == ["/gen", "/gen"]
+
+
+def test_async_client_circuit_opens_and_fails_fast():
+    calls = []
+
+    def handler(request):
+        calls.append(1)
+        raise httpx.ConnectError("refused", request=request)
+
+    async def run():
+        c = AsyncLocalOnlyClient(
+            "http://127.0.0.1:8001", retries=0, backoff_s=0, failure_threshold=2,
+            reset_after_s=60, transport=httpx.MockTransport(handler),
+        )
+        for _ in range(2):
+            with pytest.raises(httpx.ConnectError):
+                await c.post("/gen", json={})
+        with pytest.raises(CircuitOpenError):
+            await c.post("/gen", json={})
+        await c.aclose()
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_async_client_half_open_admits_one_trial():
+    calls = []
+    healthy = False
+
+    async def handler(request):
+        calls.append(1)
+        if not healthy:
+            raise httpx.ConnectError("refused", request=request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"text": "ok"})
+
+    async def run():
+        nonlocal healthy
+        c = AsyncLocalOnlyClient(
+            "http://127.0.0.1:8001", retries=0, backoff_s=0, failure_threshold=2,
+            reset_after_s=60, transport=httpx.MockTransport(handler),
+        )
+        for _ in range(2):
+            with pytest.raises(httpx.ConnectError):
+                await c.post("/gen", json={})
+        # Reset window over: one trial fails and reopens the circuit at once
+        c._opened_at -= 60
+        with pytest.raises(httpx.ConnectError):
+            await c.post("/gen", json={})
+        with pytest.raises(CircuitOpenError):
+            await c.post("/gen", json={})
+        # Next window: of concurrent callers only the trial reaches the service
+        c._opened_at -= 60
+        healthy = True
+        results = await asyncio.gather(*(c.post("/gen", json={}) for _ in range(3)), return_exceptions=True)
+        assert sum(isinstance(r, CircuitOpenError) for r in results) == 2
+        assert not c.circuit_open and (await c.post("/gen", json={})).status_code == 200
+        await c.aclose()
+
+    asyncio.run(run())
+    assert len(calls) == 5
@@ -0,0 +1,121 @@
+import sys
+sys.path.insert(0, '.')
+
+import src.vlm_worker as vw  # noqa: E402
+
+
+def test_analyze_image_uses_result_cache(tmp_path, monkeypatch):
+    cache = vw.ResultCache(tmp_path / "cache", mem_items=4, max_bytes=1 << 20, fingerprint="m1")
+    monkeypatch.setattr(vw, "_cache", cache)
+    calls = []
+    real = vw._analyze_many
+    monkeypatch.setattr(vw, "_analyze_many", lambda paths, prompts: calls.extend(prompts) or real(paths, prompts))
+    img = tmp_path / "a.png"
+    img.write_bytes(b"x" * 100)
+
+    first = vw.analyze_image(str(img))
+    assert vw.analyze_image(str(img)) == first
+    assert len(calls) == 1
+    vw.analyze_image(str(img), prompt="Read the text only.")
+    assert len(calls) == 2
+
+    # Disk level survives a fresh process (new in-memory LRU)
+    monkeypatch.setattr(vw, "_cache", vw.ResultCache(tmp_path / "cache", 4, 1 << 20, "m1"))
+    assert vw.analyze_image(str(img)) == first
+    assert len(calls) == 2
+    st = vw.result_cache().stats()
+    assert st["hits"] == 1 and st["mem_hits"] == 0 and st["bytes_saved"] == 100
+
+
+def test_result_cache_invalidates_on_model_change_and_evicts(tmp_path):
+    c = vw.ResultCache(tmp_path, mem_items=2, max_bytes=1 << 20, fingerprint="m1")
+    k = c.key("img", {"prompt": "p"})
+    c.put(k, {"caption": "old"})
+    assert vw.ResultCache(tmp_path, 2, 1 << 20, "m1").get(k) == {"caption": "old"}
+    c2 = vw.ResultCache(tmp_path, 2, 1 << 20, "m2")
+    assert c2.get(c2.key("img", {"prompt": "p"})) is None
+    assert c2.get(k) is None
+
+    small = vw.ResultCache(tmp_path / "small", mem_items=1, max_bytes=200, fingerprint="m")
+    keys = [small.key(str(i), {}) for i in range(10)]
+    for key in keys:
+        small.put(key, {"caption": "y" * 40})
+    assert small.stats()["disk_bytes"] <= 200
+    assert small.get(keys[-1]) is not None
+    assert small.get(keys[0]) is None
+
+
+class FakeEngine:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.forward_passes = 0
+
+    def available(self):
+        return True
+
+    def generate(self, paths, prompts):
+        self.forward_passes += -(-len(paths) // self.batch_size)
+        return [f"{p.name}:{pr}" for p, pr in zip(paths, prompts)]
+
+
+def test_worker_batches_queued_jobs(tmp_path, monkeypatch):
+    from src.job_queue import JobQueue
+    monkeypatch.setattr(vw, "_cache", vw.ResultCache(tmp_path / "cache", 16, 1 << 20, "m"))
+    monkeypatch.setattr(vw, "OUT_DIR", tmp_path / "out")
+    monkeypatch.setattr(vw, "BATCH", 8)
+    engine = FakeEngine(batch_size=8)
+    monkeypatch.setattr(vw, "ENGINE", engine)
+    jq = JobQueue(tmp_path / "q.sqlite3")
+    ids = []
+    for i in range(4):
+        img = tmp_path / f"{i}.png"
+        img.write_bytes(bytes([i]) * 10)
+        ids.append(jq.enqueue("analyze_image", {"path": str(img), "prompt": "what?"}, batch_key="llava"))
+    ids.append(jq.enqueue("analyze_image", {"path": str(tmp_path / "missing.png")}, batch_key="llava"))
+
+    monkeypatch.setattr(vw, "JobQueue", lambda: jq)
+    monkeypatch.setattr(jq, "dequeue_batch", _once(jq.dequeue_batch))
+    try:
+        vw.main_loop()
+    except StopIteration:
+        pass
+    assert jq.status(ids[0])["result"]["caption"] == "0.png:what?"
+    assert jq.status(ids[3])["status"] == "done"
+    assert jq.status(ids[4])["status"] == "error"
+    # The missing image is rejected up front; the other four share one pass
+    assert engine.forward_passes == 1
+
+
+def _once(fn):
+    state = {"calls": 0}
+
+    def wrapper(*args, **kwargs):
+        state["calls"] += 1
+        if state["calls"] > 1:
+            raise StopIteration
+        kwargs["block"] = False
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def test_cache_stats_merge_published_worker_counters(tmp_path, monkeypatch):
+    import json
+    import time
+    monkeypatch.setattr(vw, "STATS_DIR", tmp_path / "stats")
+    api_cache = vw.ResultCache(tmp_path / "cache", 4, 1 << 20, "m1")
+    worker_cache = vw.ResultCache(tmp_path / "cache", 4, 1 << 20, "m1")
+    k = worker_cache.key("img", {"prompt": "p"})
+    worker_cache.put(k, {"caption": "c"})
+    worker_cache.get(k, 100)
+    worker_cache.get(worker_cache.key("other", {}))
+
+    monkeypatch.setattr(vw, "_cache", worker_cache)
+    vw.publish_stats("vlm@host:1")
+    (tmp_path / "stats" / "dead.json").write_text(json.dumps({"hits": 50, "updated": time.time() - 3600}))
+    monkeypatch.setattr(vw, "_cache", api_cache)
+    api_cache.get(k, 10)
+
+    st = vw.cache_stats()
+    assert (st["hits"], st["misses"], st["bytes_saved"], st["processes"]) == (2, 1, 110, 2)
+    assert st["hit_rate"] == round(2 / 3, 4)
+    assert not (tmp_path / "stats" / "dead.json").exists()